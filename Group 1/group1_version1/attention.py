@@ -3,6 +3,65 @@ from torch import nn
 from torch.nn import functional as F
 import math
 
+# Backend used by scaled_dot_product_attention, see set_attention_backend
+#   "math":    the explicit softmax(q @ k.T / sqrt(d)) @ v, which builds the full (Batch_Size, H, Seq_Len_Q, Seq_Len_KV) matrix
+#   "sdpa":    the fused torch kernel, which never materializes the full matrix when a flash/memory-efficient kernel is available
+#   "chunked": the math path evaluated over chunks of queries, which bounds the matrix to (Batch_Size, H, Chunk_Size, Seq_Len_KV)
+ATTENTION_BACKENDS = ("math", "sdpa", "chunked")
+attention_backend = "sdpa" if hasattr(F, "scaled_dot_product_attention") else "chunked"
+attention_chunk_size = 1024
+
+def set_attention_backend(backend, chunk_size=None):
+    global attention_backend, attention_chunk_size
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError("Unknown attention backend %s, expected one of %s" % (backend, ", ".join(ATTENTION_BACKENDS)))
+    if backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+        raise ValueError("The sdpa attention backend requires torch>=2.0")
+    attention_backend = backend
+    if chunk_size is not None:
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        attention_chunk_size = chunk_size
+
+def scaled_dot_product_attention(q, k, v, causal_mask=False):
+    # q: (Batch_Size, H, Seq_Len_Q, Dim / H)
+    # k: (Batch_Size, H, Seq_Len_KV, Dim / H)
+    # v: (Batch_Size, H, Seq_Len_KV, Dim / H)
+    if attention_backend == "sdpa":
+        # The causal mask of the fused kernel is aligned to the top-left corner, same as triu(1) below
+        return F.scaled_dot_product_attention(q, k, v, is_causal=causal_mask)
+
+    if attention_backend == "chunked" and q.shape[-2] > attention_chunk_size:
+        output = torch.empty_like(q)
+        for start in range(0, q.shape[-2], attention_chunk_size):
+            end = min(start + attention_chunk_size, q.shape[-2])
+            output[..., start:end, :] = math_attention(q[..., start:end, :], k, v, causal_mask=causal_mask, query_offset=start)
+        return output
+
+    return math_attention(q, k, v, causal_mask=causal_mask)
+
+def math_attention(q, k, v, causal_mask=False, query_offset=0):
+    # query_offset is the position of the first query in the full sequence, needed to mask a chunk of queries
+
+    # (Batch_Size, H, Seq_Len_Q, Dim / H) @ (Batch_Size, H, Dim / H, Seq_Len_KV) -> (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
+    weight = q @ k.transpose(-1, -2)
+    
+    if causal_mask:
+        # Mask where the upper triangle (above the principal diagonal) is 1
+        mask = torch.ones(weight.shape[-2:], dtype=torch.bool, device=weight.device).triu(1 + query_offset) 
+        # Fill the upper triangle with -inf
+        weight.masked_fill_(mask, -torch.inf) 
+    
+    # Divide by d_k (Dim / H). 
+    # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV) -> (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
+    weight /= math.sqrt(q.shape[-1]) 
+
+    # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV) -> (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
+    weight = F.softmax(weight, dim=-1) 
+
+    # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV) @ (Batch_Size, H, Seq_Len_KV, Dim / H) -> (Batch_Size, H, Seq_Len_Q, Dim / H)
+    return weight @ v
+
 class SelfAttention(nn.Module):
     def __init__(self, n_heads, d_embed, in_proj_bias=True, out_proj_bias=True):
         super().__init__()
@@ -33,24 +92,8 @@ class SelfAttention(nn.Module):
         k = k.view(interim_shape).transpose(1, 2)
         v = v.view(interim_shape).transpose(1, 2)
 
-        # (Batch_Size, H, Seq_Len, Dim / H) @ (Batch_Size, H, Dim / H, Seq_Len) -> (Batch_Size, H, Seq_Len, Seq_Len)
-        weight = q @ k.transpose(-1, -2)
-        
-        if causal_mask:
-            # Mask where the upper triangle (above the principal diagonal) is 1
-            mask = torch.ones_like(weight, dtype=torch.bool).triu(1) 
-            # Fill the upper triangle with -inf
-            weight.masked_fill_(mask, -torch.inf) 
-        
-        # Divide by d_k (Dim / H). 
-        # (Batch_Size, H, Seq_Len, Seq_Len) -> (Batch_Size, H, Seq_Len, Seq_Len)
-        weight /= math.sqrt(self.d_head) 
-
-        # (Batch_Size, H, Seq_Len, Seq_Len) -> (Batch_Size, H, Seq_Len, Seq_Len)
-        weight = F.softmax(weight, dim=-1) 
-
-        # (Batch_Size, H, Seq_Len, Seq_Len) @ (Batch_Size, H, Seq_Len, Dim / H) -> (Batch_Size, H, Seq_Len, Dim / H)
-        output = weight @ v
+        # (Batch_Size, H, Seq_Len, Dim / H) -> (Batch_Size, H, Seq_Len, Dim / H)
+        output = scaled_dot_product_attention(q, k, v, causal_mask=causal_mask)
 
         # (Batch_Size, H, Seq_Len, Dim / H) -> (Batch_Size, Seq_Len, H, Dim / H)
         output = output.transpose(1, 2) 
@@ -73,6 +116,9 @@ class CrossAttention(nn.Module):
         self.out_proj = nn.Linear(d_embed, d_embed, bias=out_proj_bias)
         self.n_heads = n_heads
         self.d_head = d_embed // n_heads
+        # Inference-only cache of the keys and values projected from the last context, see set_kv_cache
+        self.use_kv_cache = False
+        self.kv_cache = None
     
     def forward(self, x, y):
         # x (latent): # (Batch_Size, Seq_Len_Q, Dim_Q)
@@ -85,29 +131,29 @@ class CrossAttention(nn.Module):
         
         # (Batch_Size, Seq_Len_Q, Dim_Q) -> (Batch_Size, Seq_Len_Q, Dim_Q)
         q = self.q_proj(x)
-        # (Batch_Size, Seq_Len_KV, Dim_KV) -> (Batch_Size, Seq_Len_KV, Dim_Q)
-        k = self.k_proj(y)
-        # (Batch_Size, Seq_Len_KV, Dim_KV) -> (Batch_Size, Seq_Len_KV, Dim_Q)
-        v = self.v_proj(y)
-
         # (Batch_Size, Seq_Len_Q, Dim_Q) -> (Batch_Size, Seq_Len_Q, H, Dim_Q / H) -> (Batch_Size, H, Seq_Len_Q, Dim_Q / H)
         q = q.view(interim_shape).transpose(1, 2) 
-        # (Batch_Size, Seq_Len_KV, Dim_Q) -> (Batch_Size, Seq_Len_KV, H, Dim_Q / H) -> (Batch_Size, H, Seq_Len_KV, Dim_Q / H)
-        k = k.view(interim_shape).transpose(1, 2) 
-        # (Batch_Size, Seq_Len_KV, Dim_Q) -> (Batch_Size, Seq_Len_KV, H, Dim_Q / H) -> (Batch_Size, H, Seq_Len_KV, Dim_Q / H)
-        v = v.view(interim_shape).transpose(1, 2) 
-        
-        # (Batch_Size, H, Seq_Len_Q, Dim_Q / H) @ (Batch_Size, H, Dim_Q / H, Seq_Len_KV) -> (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
-        weight = q @ k.transpose(-1, -2)
-        
-        # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
-        weight /= math.sqrt(self.d_head)
-        
-        # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV)
-        weight = F.softmax(weight, dim=-1)
+
+        # The context does not change between denoising steps, so its keys and values can be reused as long as
+        # the very same (and unmodified) context tensor is passed again
+        if self.use_kv_cache and self.kv_cache is not None and self.kv_cache[0] is y and self.kv_cache[1] == y._version:
+            k, v = self.kv_cache[2], self.kv_cache[3]
+        else:
+            # (Batch_Size, Seq_Len_KV, Dim_KV) -> (Batch_Size, Seq_Len_KV, Dim_Q)
+            k = self.k_proj(y)
+            # (Batch_Size, Seq_Len_KV, Dim_KV) -> (Batch_Size, Seq_Len_KV, Dim_Q)
+            v = self.v_proj(y)
+
+            # (Batch_Size, Seq_Len_KV, Dim_Q) -> (Batch_Size, Seq_Len_KV, H, Dim_Q / H) -> (Batch_Size, H, Seq_Len_KV, Dim_Q / H)
+            k = k.view(interim_shape).transpose(1, 2) 
+            # (Batch_Size, Seq_Len_KV, Dim_Q) -> (Batch_Size, Seq_Len_KV, H, Dim_Q / H) -> (Batch_Size, H, Seq_Len_KV, Dim_Q / H)
+            v = v.view(interim_shape).transpose(1, 2) 
+
+            if self.use_kv_cache:
+                self.kv_cache = (y, y._version, k, v)
         
-        # (Batch_Size, H, Seq_Len_Q, Seq_Len_KV) @ (Batch_Size, H, Seq_Len_KV, Dim_Q / H) -> (Batch_Size, H, Seq_Len_Q, Dim_Q / H)
-        output = weight @ v
+        # (Batch_Size, H, Seq_Len_Q, Dim_Q / H) -> (Batch_Size, H, Seq_Len_Q, Dim_Q / H)
+        output = scaled_dot_product_attention(q, k, v)
         
         # (Batch_Size, H, Seq_Len_Q, Dim_Q / H) -> (Batch_Size, Seq_Len_Q, H, Dim_Q / H)
         output = output.transpose(1, 2).contiguous()
@@ -119,4 +165,12 @@ class CrossAttention(nn.Module):
         output = self.out_proj(output)
 
         # (Batch_Size, Seq_Len_Q, Dim_Q)
-        return output
\ No newline at end of file
+        return output
+
+def set_kv_cache(model, enabled=True):
+    # Enable or disable the key/value cache of every CrossAttention in the model. The cache is cleared in both cases,
+    # so it should be enabled once per generation call and disabled afterwards to release the cached tensors.
+    for module in model.modules():
+        if isinstance(module, CrossAttention):
+            module.use_kv_cache = enabled
+            module.kv_cache = None
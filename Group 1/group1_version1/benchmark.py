@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import argparse
+import resource
+import subprocess
+import torch
+import torch.nn.functional as F
+from clip import CLIP
+from encoder import VAE_Encoder
+from decoder import VAE_Decoder
+from diffusion import Diffusion
+from pipeline import get_time_embedding
+
+# Per-component latency and memory benchmark of the generation pipeline.
+# The models are randomly initialized, so it runs without weights, e.g. on CPU:
+#   python benchmark.py --device cpu --dtype bfloat16 --width 256 --height 256 --steps 5 --output before.json
+# and the JSON results of two commits can be diffed.
+
+MODEL_CLASSES = {
+    "clip": CLIP,
+    "encoder": VAE_Encoder,
+    "diffusion": Diffusion,
+    "decoder": VAE_Decoder,
+}
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+def time_call(fn, device):
+    # Returns the result of fn() and its wall time in seconds
+    synchronize(device)
+    start_time = time.perf_counter()
+    result = fn()
+    synchronize(device)
+    return result, time.perf_counter() - start_time
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    # Linear interpolation between the closest ranks
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def summarize(times):
+    return {
+        "n": len(times),
+        "p50_ms": percentile(times, 50) * 1000,
+        "p95_ms": percentile(times, 95) * 1000,
+        "mean_ms": sum(times) / max(len(times), 1) * 1000,
+    }
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def tensor_bytes(module):
+    return sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+
+def reset_peak_memory(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+def peak_memory(device):
+    # Peak memory of the tensors allocated on the device, only tracked for CUDA
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    return None
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def build_models(names, device, dtype, seed=0):
+    # Randomly initialized models, no checkpoint is needed
+    # The parameters are created in the benchmark dtype, so a half precision UNET never exists in float32
+    torch.manual_seed(seed)
+    default_dtype = torch.get_default_dtype()
+    models = {}
+    try:
+        torch.set_default_dtype(dtype)
+        for name in names:
+            models[name] = MODEL_CLASSES[name]().to(device).eval()
+    finally:
+        torch.set_default_dtype(default_dtype)
+    return models
+
+class ComponentBenchmark:
+    # Collects the timings and the memory of the pipeline components
+
+    def __init__(self, device):
+        self.device = device
+        self.times = {}
+        self.memory = {}
+
+    def run(self, name, fn):
+        reset_peak_memory(self.device)
+        result, elapsed = time_call(fn, self.device)
+        self.times.setdefault(name, []).append(elapsed)
+        memory = peak_memory(self.device)
+        if memory is not None:
+            self.memory[name] = max(self.memory.get(name, 0), memory)
+        return result
+
+    def results(self):
+        results = {}
+        for name, times in self.times.items():
+            results[name] = summarize(times)
+            if name in self.memory:
+                results[name]["peak_tensor_bytes"] = self.memory[name]
+        return results
+
+def benchmark(models, device, dtype, idle_device=None, batch_size=1, width=512, height=512, steps=10, repeats=3,
+              do_cfg=True, warmup=1):
+    latents_shape = (batch_size, 4, height // 8, width // 8)
+    cfg_batch_size = 2 * batch_size if do_cfg else batch_size
+    bench = ComponentBenchmark(device)
+
+    def transfer(name, model, target):
+        if idle_device is not None:
+            bench.run(f"{name}.to_{'device' if target == device else 'idle'}", lambda: model.to(target))
+
+    with torch.no_grad():
+        for repeat in range(warmup + repeats):
+            if repeat == warmup:
+                # The warmup runs are not reported
+                bench = ComponentBenchmark(device)
+
+            if "clip" in models:
+                clip = models["clip"]
+                transfer("clip", clip, device)
+                tokens = torch.randint(0, 49408, (cfg_batch_size, 77), device=device)
+                context = bench.run("clip", lambda: clip(tokens))
+                transfer("clip", clip, idle_device)
+            else:
+                context = torch.randn((cfg_batch_size, 77, 768), device=device, dtype=dtype)
+
+            if "encoder" in models:
+                encoder = models["encoder"]
+                transfer("encoder", encoder, device)
+                images = torch.randn((batch_size, 3, height, width), device=device, dtype=dtype)
+                noise = torch.randn(latents_shape, device=device, dtype=dtype)
+                latents = bench.run("encoder", lambda: encoder(images, noise))
+                transfer("encoder", encoder, idle_device)
+            else:
+                latents = torch.randn(latents_shape, device=device, dtype=dtype)
+
+            if "diffusion" in models:
+                diffusion = models["diffusion"]
+                transfer("diffusion", diffusion, device)
+                text_time_embeddings = torch.zeros((1, 192), device=device, dtype=dtype)
+                text_query = F.normalize(context.mean(dim=1), p=2, dim=-1)
+                for timestep in torch.linspace(999, 0, steps).long():
+                    time_embedding = get_time_embedding(timestep).to(device, dtype)
+                    model_input = latents.repeat(2, 1, 1, 1) if do_cfg else latents
+                    model_output, _ = bench.run(
+                        "diffusion_step",
+                        lambda: diffusion(model_input, context, time_embedding, text_time_embeddings, text_query),
+                    )
+                    if do_cfg:
+                        model_output = model_output.chunk(2)[0]
+                    # Stand-in for the sampler step, keeps the latents in a realistic range
+                    latents = latents - 0.01 * model_output
+                transfer("diffusion", diffusion, idle_device)
+
+            if "decoder" in models:
+                decoder = models["decoder"]
+                transfer("decoder", decoder, device)
+                # The decoder divides its input in place
+                bench.run("decoder", lambda: decoder(latents.clone()))
+                transfer("decoder", decoder, idle_device)
+
+    results = {"components": bench.results()}
+    if "diffusion_step" in results["components"]:
+        results["steps_per_second"] = 1000 / results["components"]["diffusion_step"]["mean_ms"]
+    results["peak_rss_bytes"] = peak_rss_bytes()
+    results["model_tensor_bytes"] = {name: tensor_bytes(model) for name, model in models.items()}
+    return results
+
+def add_common_arguments(parser):
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+
+def write_results(results, output=None):
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_common_arguments(parser)
+    parser.add_argument("--idle-device", default=None, help="Move every model to this device when it is not used")
+    parser.add_argument("--components", nargs="+", default=list(MODEL_CLASSES), choices=list(MODEL_CLASSES))
+    parser.add_argument("--no-cfg", action="store_true")
+    parser.add_argument("--token-merging-ratio", type=float, default=0, help="See token_merging.apply_token_merging")
+    parser.add_argument("--token-merging-levels", type=int, nargs="+", default=[0])
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+    # The models start on the idle device when offloading, like in the pipeline
+    models = build_models(args.components, args.idle_device or args.device, dtype, seed=args.seed)
+    if args.token_merging_ratio > 0 and "diffusion" in models:
+        from token_merging import apply_token_merging
+        apply_token_merging(models["diffusion"], args.token_merging_ratio, levels=args.token_merging_levels)
+
+    results = benchmark(
+        models, args.device, dtype, idle_device=args.idle_device, batch_size=args.batch_size, width=args.width,
+        height=args.height, steps=args.steps, repeats=args.repeats, do_cfg=not args.no_cfg,
+    )
+    results["config"] = vars(args)
+    results["torch"] = torch.__version__
+    results["commit"] = git_commit()
+    write_results(results, args.output)
+
+if __name__ == "__main__":
+    main()
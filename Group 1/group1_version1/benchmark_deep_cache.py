@@ -0,0 +1,92 @@
+import math
+import argparse
+import torch
+import torch.nn.functional as F
+from pipeline import get_time_embedding
+from samplers import get_sampler, SAMPLERS
+from benchmark import add_common_arguments, build_models, time_call, summarize, write_results, git_commit
+
+# Quality against speed of the DeepCache mode (see UNET.forward) at fixed seeds.
+# Every reuse interval runs the same denoising loop as the pipeline, from the same initial noise and context, and is
+# compared with the full computation (interval 1) by the relative error of the final latents (and the PSNR of the decoded images with --decode).
+# The models are randomly initialized unless --weights-dir points to converted weights (see model_converter.py).
+#   python benchmark_deep_cache.py --device cuda --dtype float16 --steps 25 --intervals 1 2 3 5 --weights-dir weights
+
+def psnr(reference, output, data_range):
+    mse = F.mse_loss(output.float(), reference.float()).item()
+    return float("inf") if mse == 0 else 10 * math.log10(data_range ** 2 / mse)
+
+def denoise(diffusion, sampler, latents, context, cfg_scale, interval, device, dtype):
+    text_time_embeddings = torch.zeros((1, 192), device=device, dtype=dtype)
+    text_query = F.normalize(context.mean(dim=1), p=2, dim=-1)
+    deep_cache = {} if interval > 1 else None
+
+    step_times = []
+    for i, timestep in enumerate(sampler.timesteps):
+        time_embedding = get_time_embedding(timestep).to(device, dtype)
+        model_input = latents.repeat(2, 1, 1, 1)
+        (model_output, _), elapsed = time_call(
+            lambda: diffusion(model_input, context, time_embedding, text_time_embeddings, text_query,
+                              deep_cache=deep_cache, reuse_deep_cache=deep_cache is not None and i % interval != 0),
+            device,
+        )
+        step_times.append(elapsed)
+        output_cond, output_uncond = model_output.chunk(2)
+        model_output = cfg_scale * (output_cond - output_uncond) + output_uncond
+        latents = sampler.step(timestep, latents, model_output)
+    return latents, step_times
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_common_arguments(parser)
+    parser.add_argument("--intervals", type=int, nargs="+", default=[1, 2, 3, 5])
+    parser.add_argument("--sampler", default="ddim", choices=list(SAMPLERS))
+    parser.add_argument("--cfg-scale", type=float, default=7.5)
+    parser.add_argument("--decode", action="store_true", help="Also compare the decoded images")
+    parser.add_argument("--weights-dir", default=None)
+    args = parser.parse_args()
+
+    device = args.device
+    dtype = getattr(torch, args.dtype)
+    names = ["diffusion", "decoder"] if args.decode else ["diffusion"]
+    if args.weights_dir:
+        from model_loader import load_converted_model
+        models = {name: load_converted_model(args.weights_dir, name, device).to(dtype).eval() for name in names}
+    else:
+        models = build_models(names, device, dtype, seed=args.seed)
+
+    # The full computation (interval 1) runs first, it is the reference
+    args.intervals = sorted(set(args.intervals) | {1})
+
+    results = {"intervals": {}}
+    reference = {}
+    with torch.no_grad():
+        for interval in args.intervals:
+            generator = torch.Generator(device=device).manual_seed(args.seed)
+            latents = torch.randn((args.batch_size, 4, args.height // 8, args.width // 8), generator=generator, device=device, dtype=dtype)
+            # Conditional and unconditional context, like the pipeline with classifier-free guidance
+            context = torch.randn((2 * args.batch_size, 77, 768), generator=generator, device=device, dtype=dtype)
+            sampler = get_sampler(args.sampler, generator, args.steps)
+
+            latents, step_times = denoise(models["diffusion"], sampler, latents, context, args.cfg_scale, interval, device, dtype)
+            result = {"step": summarize(step_times), "total_ms": sum(step_times) * 1000}
+            outputs = {"latents": latents}
+            if args.decode:
+                outputs["images"] = models["decoder"](latents.clone()).clamp(-1, 1)
+
+            if interval == 1:
+                reference = outputs
+            else:
+                result["speedup"] = results["intervals"]["1"]["total_ms"] / result["total_ms"]
+                result["latents_relative_error"] = ((outputs["latents"].float() - reference["latents"].float()).norm() / reference["latents"].float().norm()).item()
+                if args.decode:
+                    result["images_psnr"] = psnr(reference["images"], outputs["images"], data_range=2)
+            results["intervals"][str(interval)] = result
+
+    results["config"] = vars(args)
+    results["torch"] = torch.__version__
+    results["commit"] = git_commit()
+    write_results(results, args.output)
+
+if __name__ == "__main__":
+    main()
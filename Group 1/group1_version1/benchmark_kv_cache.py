@@ -0,0 +1,68 @@
+import argparse
+import time
+import torch
+import torch.nn.functional as F
+from diffusion import Diffusion
+from attention import set_kv_cache
+from pipeline import get_time_embedding
+
+# Measures the per-step latency of the UNET with and without the cross-attention key/value cache.
+# The model is randomly initialized, so no weights are needed.
+
+def run_steps(diffusion, latents, context, timesteps, use_kv_cache):
+    device = latents.device
+    text_time_embeddings = torch.zeros((1, 192), device=device, dtype=latents.dtype)
+    text_query = F.normalize(context.mean(dim=1), p=2, dim=-1)
+
+    set_kv_cache(diffusion, use_kv_cache)
+    step_times = []
+    outputs = []
+    with torch.no_grad():
+        for timestep in timesteps:
+            time_embedding = get_time_embedding(timestep).to(device, latents.dtype)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+            model_output, text_output = diffusion(latents, context, time_embedding, text_time_embeddings, text_query)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            step_times.append(time.perf_counter() - start_time)
+            outputs.append(model_output)
+    set_kv_cache(diffusion, False)
+
+    return step_times, outputs
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--latent-size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+
+    torch.manual_seed(0)
+    diffusion = Diffusion().to(device, dtype).eval()
+    latents = torch.randn((args.batch_size, 4, args.latent_size, args.latent_size), device=device, dtype=dtype)
+    context = torch.randn((args.batch_size, 77, 768), device=device, dtype=dtype)
+    timesteps = torch.linspace(999, 0, args.steps).long()
+
+    # The first step of each run projects the keys and values, so it is reported separately
+    baseline_times, baseline_outputs = run_steps(diffusion, latents, context, timesteps, use_kv_cache=False)
+    cached_times, cached_outputs = run_steps(diffusion, latents, context, timesteps, use_kv_cache=True)
+
+    max_diff = max((a - b).abs().max().item() for a, b in zip(baseline_outputs, cached_outputs))
+    baseline_step = sum(baseline_times[1:]) / max(len(baseline_times) - 1, 1)
+    cached_step = sum(cached_times[1:]) / max(len(cached_times) - 1, 1)
+
+    print(f"device={args.device} dtype={args.dtype} batch_size={args.batch_size} latent_size={args.latent_size}")
+    print(f"without cache: {baseline_step * 1000:.2f} ms/step")
+    print(f"with cache:    {cached_step * 1000:.2f} ms/step (first step {cached_times[0] * 1000:.2f} ms)")
+    print(f"saving:        {(baseline_step - cached_step) * 1000:.2f} ms/step ({100 * (1 - cached_step / baseline_step):.1f}%)")
+    print(f"max abs difference: {max_diff}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import torch
+import torch.nn.functional as F
+from pipeline import get_time_embedding
+from offload import enable_sequential_offload, disable_sequential_offload
+from benchmark import (
+    add_common_arguments, build_models, time_call, summarize, reset_peak_memory, peak_memory, peak_rss_bytes,
+    tensor_bytes, write_results, git_commit,
+)
+
+# Peak memory against per-step latency of the UNET, fully resident on the device and with sequential block offload
+# (with and without prefetching the next block). The model is randomly initialized, so no weights are needed.
+#   python benchmark_offload.py --device cuda --dtype float16 --steps 10 --output offload.json
+
+def run_steps(diffusion, device, dtype, batch_size, width, height, steps):
+    latents = torch.randn((batch_size, 4, height // 8, width // 8), device=device, dtype=dtype)
+    context = torch.randn((batch_size, 77, 768), device=device, dtype=dtype)
+    text_time_embeddings = torch.zeros((1, 192), device=device, dtype=dtype)
+    text_query = F.normalize(context.mean(dim=1), p=2, dim=-1)
+
+    step_times = []
+    with torch.no_grad():
+        for timestep in torch.linspace(999, 0, steps).long():
+            time_embedding = get_time_embedding(timestep).to(device, dtype)
+            (model_output, _), elapsed = time_call(
+                lambda: diffusion(latents, context, time_embedding, text_time_embeddings, text_query), device
+            )
+            latents = latents - 0.01 * model_output
+            step_times.append(elapsed)
+    return step_times
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_common_arguments(parser)
+    parser.add_argument("--offload-device", default="cpu")
+    parser.add_argument("--modes", nargs="+", default=["resident", "offload", "offload_prefetch"],
+                        choices=["resident", "offload", "offload_prefetch"])
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+    diffusion = build_models(["diffusion"], args.offload_device, dtype, seed=args.seed)["diffusion"]
+
+    results = {"modes": {}, "model_tensor_bytes": tensor_bytes(diffusion)}
+    for mode in args.modes:
+        if mode == "resident":
+            disable_sequential_offload(diffusion)
+            diffusion.to(args.device)
+        else:
+            diffusion.to(args.offload_device)
+            offload = enable_sequential_offload(diffusion, args.device, args.offload_device, prefetch=mode == "offload_prefetch")
+
+        # One warmup step, then the measured steps
+        run_steps(diffusion, args.device, dtype, args.batch_size, args.width, args.height, 1)
+        reset_peak_memory(args.device)
+        step_times = []
+        for _ in range(args.repeats):
+            step_times += run_steps(diffusion, args.device, dtype, args.batch_size, args.width, args.height, args.steps)
+
+        result = {"step": summarize(step_times), "steps_per_second": len(step_times) / sum(step_times)}
+        result["peak_tensor_bytes"] = peak_memory(args.device)
+        if mode != "resident":
+            result.update(offload.stats())
+            disable_sequential_offload(diffusion)
+        results["modes"][mode] = result
+
+    diffusion.to(args.offload_device)
+    results["peak_rss_bytes"] = peak_rss_bytes()
+    results["config"] = vars(args)
+    results["torch"] = torch.__version__
+    results["commit"] = git_commit()
+    write_results(results, args.output)
+
+if __name__ == "__main__":
+    main()
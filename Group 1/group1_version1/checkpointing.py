@@ -0,0 +1,128 @@
+import os
+import re
+import time
+import threading
+import torch
+
+# Asynchronous checkpoints for the training loop.
+# save() only blocks the training for the copy of the state to host memory, the file is written by a background thread.
+# A checkpoint is written to "<name>.tmp" and renamed to "<name>" once it is complete (os.replace is atomic), so a
+# checkpoint without the .tmp suffix is always complete, even if the process is killed while writing.
+# The oldest checkpoints are removed after a successful write, so there are never fewer than total_limit complete ones.
+# At most one write is in flight: save() first waits for the previous one, which bounds the host memory to one snapshot.
+
+CHECKPOINT_PATTERN = re.compile(r"^checkpoint-(\d+)$")
+
+def list_checkpoints(output_dir):
+    # Complete checkpoints of the directory, sorted by step: [(step, path)]
+    if not os.path.isdir(output_dir):
+        return []
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        match = CHECKPOINT_PATTERN.match(name)
+        if match:
+            checkpoints.append((int(match.group(1)), os.path.join(output_dir, name)))
+    return sorted(checkpoints)
+
+def latest_checkpoint(output_dir):
+    checkpoints = list_checkpoints(output_dir)
+    return checkpoints[-1][1] if checkpoints else None
+
+def load_latest_checkpoint(output_dir, map_location="cpu"):
+    # Loads the most recent checkpoint that can be read, older ones are tried if the latest one is unreadable
+    # Returns (path, state) or (None, None)
+    for _, path in reversed(list_checkpoints(output_dir)):
+        try:
+            return path, torch.load(path, map_location=map_location)
+        except Exception as e:
+            print(f"Skipping unreadable checkpoint {path}: {e}")
+    return None, None
+
+class AsyncCheckpointWriter:
+
+    def __init__(self, output_dir, total_limit=None):
+        self.output_dir = output_dir
+        self.total_limit = total_limit
+        self.thread = None
+        self.error = None
+        # Host buffers of the snapshot, reused between saves (pinned for a fast copy from CUDA)
+        self.buffers = {}
+        self.stats = {"saves": 0, "snapshot_seconds": 0.0, "write_seconds": 0.0, "bytes": 0}
+
+        os.makedirs(output_dir, exist_ok=True)
+        # Leftovers of an interrupted write
+        for name in os.listdir(output_dir):
+            if name.endswith(".tmp") and CHECKPOINT_PATTERN.match(name[:-len(".tmp")]):
+                os.remove(os.path.join(output_dir, name))
+
+    def _to_host(self, key, tensor):
+        tensor = tensor.detach()
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=tensor.is_cuda)
+            self.buffers[key] = buffer
+        buffer.copy_(tensor, non_blocking=tensor.is_cuda)
+        return buffer
+
+    def snapshot(self, state, prefix=""):
+        # Copy of the (nested dicts / lists of) tensors in host memory, the other values are kept as they are
+        if isinstance(state, torch.Tensor):
+            return self._to_host(prefix, state)
+        if isinstance(state, dict):
+            return {key: self.snapshot(value, f"{prefix}/{key}") for key, value in state.items()}
+        if isinstance(state, (list, tuple)):
+            return type(state)(self.snapshot(value, f"{prefix}/{i}") for i, value in enumerate(state))
+        return state
+
+    def save(self, step, state):
+        # Returns the path the checkpoint will have once written
+        self.wait()
+        start_time = time.perf_counter()
+        state = self.snapshot(state)
+        if torch.cuda.is_available():
+            # The non-blocking copies to the pinned buffers must be complete before the thread reads them
+            torch.cuda.synchronize()
+        self.stats["snapshot_seconds"] = time.perf_counter() - start_time
+
+        path = os.path.join(self.output_dir, f"checkpoint-{step}")
+        self.thread = threading.Thread(target=self._write, args=(state, path), name="checkpoint-writer")
+        self.thread.start()
+        return path
+
+    def _write(self, state, path):
+        try:
+            start_time = time.perf_counter()
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            self.stats["saves"] += 1
+            self.stats["write_seconds"] = time.perf_counter() - start_time
+            self.stats["bytes"] = os.path.getsize(path)
+            print(f"Saved state to {path}")
+            self._prune()
+        except Exception as e:
+            self.error = e
+
+    def _prune(self):
+        if self.total_limit is None:
+            return
+        checkpoints = list_checkpoints(self.output_dir)
+        for _, path in checkpoints[:max(0, len(checkpoints) - self.total_limit)]:
+            print(f"Removing checkpoint {path}")
+            os.remove(path)
+
+    def wait(self):
+        # Waits for the write in flight, and raises its error if it failed
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing the checkpoint failed") from error
+
+    def close(self):
+        self.wait()
+        self.buffers = {}
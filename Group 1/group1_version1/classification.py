@@ -0,0 +1,192 @@
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from ddpm import DDPMSampler
+from encoder import sample_latents
+from attention import set_kv_cache
+from pipeline import get_time_embedding
+
+class DiffDisEncoder:
+    """
+        Embeds prompts and images into the space of the DiffDis text queries.
+        A prompt is the normalized average of its CLIP output (see train.py). An image is the text query predicted by the
+        UNET (the text_output of Diffusion.forward) from a pure-noise text query conditioned on the image,
+        averaged over the timesteps.
+    """
+
+    def __init__(self, models, tokenizer, timesteps=1, max_timestep=500, device="cpu", seed=0):
+        self.models = models
+        self.tokenizer = tokenizer
+        self.device = device
+        self.seed = seed
+
+        # Either the number of evenly spaced timesteps in (0, max_timestep] or an explicit sequence of timesteps
+        if isinstance(timesteps, int):
+            timesteps = torch.linspace(max_timestep, 0, timesteps + 1)[:-1].round().long().tolist()
+        self.timesteps = list(timesteps)
+
+        self.sampler = DDPMSampler(None)
+
+        # The image is embedded without a text prompt: (1, Seq_Len, Dim)
+        self.uncond_context = self.encode_contexts([""])
+        # The expanded context is kept per batch size, so the cross-attention key/value cache can reuse it
+        self._contexts = {}
+
+    def encode_contexts(self, prompts):
+        # (Batch_Size, Seq_Len, Dim)
+        text_cache = self.models.get("text_cache")
+        if text_cache is not None:
+            return text_cache.encode(prompts, device=self.device)
+
+        clip = self.models["clip"]
+        clip.to(self.device)
+        tokens = self.tokenizer.batch_encode_plus(list(prompts), padding="max_length", max_length=77).input_ids
+        tokens = torch.tensor(tokens, dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            return clip(tokens)
+
+    def encode_text_queries(self, prompts_per_class):
+        # The text query is the normalized average of the CLIP output (see train.py), averaged over the templates
+        num_templates = len(prompts_per_class[0])
+        prompts = [prompt for prompts in prompts_per_class for prompt in prompts]
+        # (Classes * Templates, Seq_Len, Dim) -> (Classes * Templates, Dim)
+        queries = F.normalize(self.encode_contexts(prompts).mean(dim=1), p=2, dim=-1)
+        # (Classes * Templates, Dim) -> (Classes, Templates, Dim) -> (Classes, Dim)
+        queries = queries.view(len(prompts_per_class), num_templates, -1).mean(dim=1)
+        return F.normalize(queries, p=2, dim=-1)
+
+    def _context(self, batch_size):
+        if batch_size not in self._contexts:
+            self._contexts[batch_size] = self.uncond_context.expand(batch_size, -1, -1).contiguous()
+        return self._contexts[batch_size]
+
+    def encode_images(self, images, generator=None):
+        # images: (Batch_Size, Channel, Height, Width) in [-1, 1]
+        # Returns the predicted text queries averaged over the timesteps: (Batch_Size, Dim)
+        encoder = self.models["encoder"]
+        diffusion = self.models["diffusion"]
+        encoder.to(self.device)
+        diffusion.to(self.device)
+
+        with torch.no_grad():
+            images = images.to(self.device)
+            batch_size = images.shape[0]
+
+            # Use the mean of the latent distribution, so the same image always gets the same latents
+            # (Batch_Size, Channel, Height, Width) -> (Batch_Size, 4, Height / 8, Width / 8)
+            mean, log_variance = encoder.encode_moments(images)
+            latents = sample_latents(mean, log_variance, torch.zeros_like(mean))
+
+            context = self._context(batch_size)
+            self.sampler.generator = generator
+
+            text_outputs = 0
+            for timestep in self.timesteps:
+                timestep = torch.tensor(timestep)
+                # (1, 320)
+                image_time_embedding = get_time_embedding(timestep, is_image=True).to(self.device)
+                # (1, 192)
+                text_time_embedding = get_time_embedding(timestep, is_image=False).to(self.device)
+
+                # (Batch_Size, 4, Height / 8, Width / 8)
+                noisy_latents, _ = self.sampler.add_noise(latents, timestep)
+                # The text query starts from pure noise and is predicted from the image
+                # (Batch_Size, Dim)
+                text_query = torch.randn((batch_size, self.uncond_context.shape[-1]), generator=generator, device=self.device)
+                text_query = F.normalize(text_query, p=2, dim=-1)
+
+                _, text_output = diffusion(noisy_latents, context, image_time_embedding, text_time_embedding, text_query)
+                text_outputs = text_outputs + text_output
+
+            # (Batch_Size, Dim)
+            return F.normalize(text_outputs, p=2, dim=-1)
+
+class ZeroShotClassifier(DiffDisEncoder):
+    """
+        Zero-shot image classification with the DiffDis text branch.
+        The class prompts are encoded once into normalized text queries (Classes, Dim). An image is classified by letting
+        the UNET denoise a pure-noise text query conditioned on the image, and comparing the predicted text query
+        (the text_output of Diffusion.forward) with the class queries. The UNET cost per image is one forward per
+        timestep, independent of the number of classes.
+    """
+
+    def __init__(self, models, tokenizer, class_names, templates=("a photo of a {}.",), timesteps=1, max_timestep=500,
+                 device="cpu", seed=0):
+        super().__init__(models, tokenizer, timesteps=timesteps, max_timestep=max_timestep, device=device, seed=seed)
+        self.class_names = list(class_names)
+
+        # (Classes, Dim)
+        self.class_queries = self.encode_text_queries(
+            [[template.format(name) for template in templates] for name in self.class_names]
+        )
+
+    def logits(self, images, generator=None):
+        # (Batch_Size, Dim) @ (Dim, Classes) -> (Batch_Size, Classes)
+        return self.encode_images(images, generator) @ self.class_queries.T
+
+    def evaluate(self, dataloader, top_k=(1, 5)):
+        # Stream over a dataloader of (images, labels) batches and report the top-k accuracies and the throughput
+        generator = torch.Generator(device=self.device)
+        generator.manual_seed(self.seed)
+
+        diffusion = self.models["diffusion"]
+        set_kv_cache(diffusion, True)
+
+        correct = {k: 0 for k in top_k}
+        num_images = 0
+        start_time = time.time()
+        for images, labels in tqdm(dataloader, desc="Classify"):
+            labels = labels.to(self.device)
+            logits = self.logits(images, generator)
+            # (Batch_Size, Max_K)
+            predictions = logits.topk(min(max(top_k), logits.shape[-1]), dim=-1).indices
+            for k in top_k:
+                correct[k] += (predictions[:, :k] == labels[:, None]).any(dim=-1).sum().item()
+            num_images += labels.shape[0]
+
+        if self.device != "cpu" and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        elapsed = time.time() - start_time
+        set_kv_cache(diffusion, False)
+
+        results = {f"top{k}": correct[k] / max(num_images, 1) for k in top_k}
+        results["images"] = num_images
+        results["images_per_second"] = num_images / elapsed
+        return results
+
+if __name__ == "__main__":
+    import model_loader
+    import torchvision
+    from torch.utils.data import DataLoader
+    from torchvision import transforms
+    from transformers import CLIPTokenizer
+    from config import WIDTH, HEIGHT
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default="cifar10", choices=["cifar10", "cifar100"])
+    parser.add_argument("--data-root", default="./data")
+    parser.add_argument("--ckpt", default="./data/v1-5-pruned.ckpt")
+    parser.add_argument("--timesteps", type=int, default=1)
+    parser.add_argument("--max-timestep", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    transform = transforms.Compose([
+        transforms.Resize((HEIGHT, WIDTH), interpolation=transforms.InterpolationMode.BILINEAR),
+        transforms.ToTensor(),
+        transforms.Normalize([0.5], [0.5]),
+    ])
+    dataset_class = torchvision.datasets.CIFAR10 if args.dataset == "cifar10" else torchvision.datasets.CIFAR100
+    dataset = dataset_class(args.data_root, train=False, download=True, transform=transform)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, num_workers=4)
+
+    tokenizer = CLIPTokenizer("./data/vocab.json", merges_file="./data/merges.txt")
+    models = model_loader.preload_models_from_standard_weights(args.ckpt, args.device, tokenizer=tokenizer)
+
+    class_names = [name.replace("_", " ") for name in dataset.classes]
+    classifier = ZeroShotClassifier(models, tokenizer, class_names, timesteps=args.timesteps,
+                                    max_timestep=args.max_timestep, device=args.device)
+    print(classifier.evaluate(dataloader))
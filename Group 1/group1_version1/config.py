@@ -10,6 +10,9 @@ first_epoch = 0
 num_train_epochs = 10
 latents_shape = (1, 4, LATENTS_HEIGHT, LATENTS_WIDTH)
 Lambda = 1.0
+mixed_precision = "no"  # "no", "fp16" or "bf16"
+gradient_accumulation_steps = 1
+gradient_checkpointing = False
 
 # optimizer parameters
 learning_rate = 1e-4
@@ -18,6 +21,33 @@ adam_beta2 = 0.999
 adam_weight_decay = 0.0
 adam_epsilon = 1e-8
 
+# LoRA fine-tuning, see lora.py
+lora_rank = None  # rank of the adapters of the UNET_AttentionBlock linears (None fine-tunes every UNET parameter)
+lora_alpha = None  # the adapter update is scaled by lora_alpha / lora_rank (None uses lora_rank)
+lora_dropout = 0.0
+
+# metrics and profiling, see metrics.py
+metrics_file = "metrics.jsonl"  # per-step metrics appended to output_dir (None disables the file)
+phase_sync_interval = None  # synchronize the device at the phase boundaries every N steps for exact phase times (None never)
+profile_start_step = None  # torch.profiler runs from this optimizer step (None disables profiling)
+profile_stop_step = None  # to this optimizer step (excluded), the traces are written to output_dir/profile
+
 # checkpoint parameters
 checkpoints_total_limit = 1
-output_dir = "output"
\ No newline at end of file
+output_dir = "output"
+resume_from_checkpoint = None  # path of a checkpoint, or "latest" for the latest complete checkpoint of output_dir
+
+# dataset parameters
+train_shards = None  # glob of the tar shards, e.g. "./data/cc3m/*.tar" (None uses the dummy dataset)
+resume_shard_offset = 0  # number of shards of first_epoch that were already consumed (a resumed checkpoint records its own)
+tokenizer_vocab_file = "./data/vocab.json"
+tokenizer_merges_file = "./data/merges.txt"
+shuffle_buffer_size = 1000
+num_workers = 4
+data_seed = 0
+aspect_ratio_buckets = False  # batch images by aspect ratio instead of cropping them to WIDTH x HEIGHT
+bucket_step = 64  # the bucket sides are multiples of bucket_step (a multiple of 64)
+bucket_max_ratio = 2.0  # largest aspect ratio of a bucket
+
+# precomputed VAE latents and CLIP hidden states, see precompute.py (None encodes every batch during training)
+precomputed_dir = None  # not compatible with aspect_ratio_buckets, the precomputed latents have a single shape
\ No newline at end of file
@@ -19,27 +19,297 @@ train_dataloader = None # TODO: define the train dataloader
 #         examples["input_ids"] = tokenize_captions(examples)
 #         return examples
 
+import io
+import os
+import glob
+import random
+import itertools
+import tarfile
+import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset, IterableDataset, RandomSampler, get_worker_info
 import torch.nn.functional as F
 from random import randint
 
 class DummyDataset(Dataset):
-    def __init__(self, num_samples=100, image_dim=(512, 512), num_tokens=10):
+    def __init__(self, num_samples=100, image_dim=(512, 512), num_tokens=10, image_dims=None):
         self.num_samples = num_samples
         self.image_dim = image_dim
         self.num_tokens = num_tokens
+        # Optional (Width, Height) of every sample, for aspect ratio bucketing
+        self.image_dims = image_dims
     
     def __len__(self):
         return self.num_samples
     
     def __getitem__(self, idx):
+        width, height = self.image_dims[idx] if self.image_dims is not None else self.image_dim
         # Generate a dummy image
-        image = torch.rand(3, *self.image_dim)  # Random image
+        image = torch.rand(3, height, width)  # Random image
         # Generate dummy tokenized text (integer IDs)
         text = torch.randint(1, 1000, (self.num_tokens,))  # Random token IDs
         return {"pixel_values": image, "input_ids": text}
 
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "webp")
+CAPTION_EXTENSIONS = ("txt", "caption")
+
+def iterate_tar_samples(path):
+    # Stream a tar shard (webdataset layout: "<key>.jpg" and "<key>.txt" next to each other) and yield one dict per key
+    # without extracting the archive or listing its members first
+    sample, current_key = {}, None
+    with tarfile.open(path, "r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, _, extension = os.path.basename(member.name).partition(".")
+            key = os.path.join(os.path.dirname(member.name), key)
+            if key != current_key:
+                if sample:
+                    yield sample
+                sample, current_key = {"__key__": key}, key
+            sample[extension.lower()] = tar.extractfile(member).read()
+    if sample:
+        yield sample
+
+def preprocess_image(image, image_dim, center_crop=True, random_flip=False, rng=random):
+    # Resize the shorter side to the target size, crop, and convert to a (Channel, Height, Width) tensor in [-1, 1]
+    width, height = image_dim
+    image = image.convert("RGB")
+    scale = max(width / image.width, height / image.height)
+    image = image.resize((max(width, round(image.width * scale)), max(height, round(image.height * scale))), Image.BILINEAR)
+    if center_crop:
+        left, top = (image.width - width) // 2, (image.height - height) // 2
+    else:
+        left, top = rng.randint(0, image.width - width), rng.randint(0, image.height - height)
+    image = image.crop((left, top, left + width, top + height))
+    if random_flip and rng.random() < 0.5:
+        image = image.transpose(Image.FLIP_LEFT_RIGHT)
+    # (Height, Width, Channel) -> (Channel, Height, Width)
+    pixel_values = torch.from_numpy(np.asarray(image, dtype=np.float32)).permute(2, 0, 1)
+    # [0, 255] -> [-1, 1]
+    return pixel_values / 127.5 - 1.0
+
+def make_buckets(base_resolution=256, step=64, max_ratio=2.0):
+    # (Width, Height) buckets with about the area of a base_resolution square and aspect ratios up to max_ratio,
+    # both sides are multiples of step (a multiple of 64, so the UNET can halve the latents three times)
+    max_area = base_resolution * base_resolution
+    buckets = set()
+    width = step
+    while width <= base_resolution * max_ratio:
+        height = (max_area // width) // step * step
+        if height > 0 and max(width / height, height / width) <= max_ratio:
+            buckets.add((width, height))
+            buckets.add((height, width))
+        width += step
+    return sorted(buckets, key=lambda bucket: bucket[0] / bucket[1])
+
+def nearest_bucket(width, height, buckets):
+    # Index of the bucket with the closest aspect ratio (in log space, so 1:2 and 2:1 are equally far from 1:1)
+    log_ratio = np.log(width / height)
+    return int(np.argmin([abs(np.log(w / h) - log_ratio) for w, h in buckets]))
+
+def collate_samples(samples):
+    return {key: torch.stack([sample[key] for sample in samples]) for key in samples[0]}
+
+class BucketBatchSampler:
+    """
+        Batch sampler for map-style datasets that only puts samples of the same aspect ratio bucket in a batch.
+        bucket_ids[i] is the bucket of sample i. Samples are shuffled within the buckets and the batches are shuffled
+        across the buckets, so every batch has a single shape and no padding is needed.
+    """
+
+    def __init__(self, bucket_ids, batch_size, shuffle=True, drop_last=False, seed=0):
+        self.bucket_ids = list(bucket_ids)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        buckets = {}
+        for idx, bucket in enumerate(self.bucket_ids):
+            buckets.setdefault(bucket, []).append(idx)
+
+        batches = []
+        for bucket in sorted(buckets):
+            indices = buckets[bucket]
+            if self.shuffle:
+                rng.shuffle(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
+
+class SkipBatchSampler:
+    # The batches of batch_sampler after the first num_batches, which are skipped without loading their samples
+
+    def __init__(self, batch_sampler, num_batches):
+        self.batch_sampler = batch_sampler
+        self.num_batches = num_batches
+
+    def __iter__(self):
+        return itertools.islice(iter(self.batch_sampler), self.num_batches, None)
+
+    def __len__(self):
+        return max(0, len(self.batch_sampler) - self.num_batches)
+
+def epoch_dataloader(dataloader, epoch, seed=0, shard_offset=0, skip_batches=0):
+    """
+        Prepares dataloader for an epoch and returns the loader to iterate. The order of the batches of an epoch only
+        depends on seed and epoch, so when training resumes from a checkpoint taken within the epoch, the first
+        skip_batches batches (the ones that were already trained) are skipped.
+        shard_offset is the number of shards of the epoch that streaming datasets skip, see ShardedImageTextDataset.
+    """
+    dataset = dataloader.dataset
+    if isinstance(dataset, IterableDataset):
+        if hasattr(dataset, "set_epoch"):
+            dataset.set_epoch(epoch, shard_offset, skip_batches)
+        return dataloader
+
+    if isinstance(dataloader.sampler, RandomSampler):
+        # shuffle=True draws a new permutation from the global generator otherwise
+        dataloader.sampler.generator = torch.Generator().manual_seed(seed + epoch)
+    if hasattr(dataloader.batch_sampler, "set_epoch"):
+        dataloader.batch_sampler.set_epoch(epoch)
+    if not skip_batches:
+        return dataloader
+    return DataLoader(dataset, batch_sampler=SkipBatchSampler(dataloader.batch_sampler, skip_batches),
+                      num_workers=dataloader.num_workers, collate_fn=dataloader.collate_fn, pin_memory=dataloader.pin_memory)
+
+class ShardedImageTextDataset(IterableDataset):
+    """
+        Streaming image-caption dataset over tar shards, for datasets that are too large to list or index (e.g. CC3M).
+        Shards are shuffled per epoch and split across the DataLoader workers, samples are shuffled with a buffer.
+        The shard order only depends on the seed and the epoch, so training can be resumed by skipping
+        the first shard_offset shards of the epoch, and the stream of every worker only depends on the seed, the epoch and
+        the number of workers, so skip_batches skips the batches of the epoch that were already trained.
+        With buckets (see make_buckets), every image is resized and cropped to the bucket closest to its aspect ratio
+        and the dataset yields whole batches of batch_size samples of one bucket (use the DataLoader with batch_size=None).
+    """
+
+    def __init__(self, shards, tokenizer, image_dim=(256, 256), num_tokens=77, shuffle_buffer_size=1000,
+                 seed=0, epoch=0, shard_offset=0, center_crop=True, random_flip=False, buckets=None, batch_size=None):
+        if isinstance(shards, str):
+            shards = sorted(glob.glob(shards))
+        if not shards:
+            raise ValueError("No shards found")
+        self.shards = list(shards)
+        self.tokenizer = tokenizer
+        self.image_dim = image_dim
+        self.num_tokens = num_tokens
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = epoch
+        self.shard_offset = shard_offset
+        self.skip_batches = 0
+        self.center_crop = center_crop
+        self.random_flip = random_flip
+        self.buckets = buckets
+        self.batch_size = batch_size
+        if buckets is not None and batch_size is None:
+            raise ValueError("batch_size is required with buckets")
+
+    def set_epoch(self, epoch, shard_offset=0, skip_batches=0):
+        if skip_batches and self.batch_size is None:
+            raise ValueError("batch_size is required to skip batches")
+        self.epoch = epoch
+        self.shard_offset = shard_offset
+        self.skip_batches = skip_batches
+
+    def epoch_shards(self):
+        # Deterministic shard order of the current epoch, without the shards that were already consumed
+        shards = list(self.shards)
+        random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[self.shard_offset:]
+
+    def tokenize(self, caption):
+        return self.tokenizer(caption, padding="max_length", max_length=self.num_tokens, truncation=True).input_ids
+
+    def samples(self, shards, rng):
+        for shard in shards:
+            for sample in iterate_tar_samples(shard):
+                image_key = next((ext for ext in IMAGE_EXTENSIONS if ext in sample), None)
+                caption_key = next((ext for ext in CAPTION_EXTENSIONS if ext in sample), None)
+                if image_key is None or caption_key is None:
+                    continue
+                try:
+                    image = Image.open(io.BytesIO(sample[image_key]))
+                    bucket = None
+                    image_dim = self.image_dim
+                    if self.buckets is not None:
+                        bucket = nearest_bucket(image.width, image.height, self.buckets)
+                        image_dim = self.buckets[bucket]
+                    pixel_values = preprocess_image(image, image_dim, self.center_crop, self.random_flip, rng)
+                except (OSError, ValueError):
+                    # Skip corrupt or truncated images instead of stopping the epoch
+                    continue
+                caption = sample[caption_key].decode("utf-8").strip()
+                input_ids = torch.tensor(self.tokenize(caption), dtype=torch.long)
+                yield {"pixel_values": pixel_values, "input_ids": input_ids}, bucket
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        # Every worker reads a disjoint subset of the shards
+        shards = self.epoch_shards()[worker_id::num_workers]
+        rng = random.Random(self.seed * 1000003 + self.epoch * 1009 + worker_id)
+
+        # The DataLoader takes the batches from the workers in turn, so this worker produced every num_workers-th
+        # skipped batch. The skipped samples are still read, so the samples after them are the same as before. The
+        # remaining batches are the ones of the interrupted epoch, but the workers interleave from worker 0 again.
+        skip = len(range(worker_id, self.skip_batches, num_workers))
+
+        samples = self.shuffled(self.samples(shards, rng), rng)
+        if self.buckets is None:
+            for sample, _ in itertools.islice(samples, skip * self.batch_size, None):
+                yield sample
+            return
+        yield from itertools.islice(self.bucket_batches(samples), skip, None)
+
+    def bucket_batches(self, samples):
+        # Fill one batch per bucket and yield it as soon as it is full
+        bucket_batches = {}
+        for sample, bucket in samples:
+            batch = bucket_batches.setdefault(bucket, [])
+            batch.append(sample)
+            if len(batch) == self.batch_size:
+                yield collate_samples(batch)
+                bucket_batches[bucket] = []
+        # The last partial batches
+        for bucket in sorted(bucket_batches):
+            if bucket_batches[bucket]:
+                yield collate_samples(bucket_batches[bucket])
+
+    def shuffled(self, samples, rng):
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(sample)
+                continue
+            # Replace a random element of the full buffer with the new sample
+            idx = rng.randrange(len(buffer))
+            buffer[idx], sample = sample, buffer[idx]
+            yield sample
+
+        rng.shuffle(buffer)
+        yield from buffer
+
 
 # Parameters for the dummy dataset
 num_samples = 100
@@ -47,9 +317,33 @@ batch_size = BATCH_SIZE
 image_dim = (WIDTH, HEIGHT)
 num_tokens = 77
 
-# Create a dummy dataset and dataloader
-dummy_dataset = DummyDataset(num_samples=num_samples, image_dim=image_dim, num_tokens=num_tokens)
-train_dataloader = DataLoader(dummy_dataset, batch_size=batch_size, shuffle=True)
+# Aspect ratio buckets of about WIDTH * HEIGHT pixels, every batch has the shape of one bucket
+buckets = make_buckets(int((WIDTH * HEIGHT) ** 0.5), bucket_step, bucket_max_ratio) if aspect_ratio_buckets else None
+
+if train_shards is not None:
+    # Stream the real image-caption shards
+    from transformers import CLIPTokenizer
+    tokenizer = CLIPTokenizer(tokenizer_vocab_file, merges_file=tokenizer_merges_file)
+    train_dataset = ShardedImageTextDataset(
+        train_shards, tokenizer, image_dim=image_dim, num_tokens=num_tokens,
+        shuffle_buffer_size=shuffle_buffer_size, seed=data_seed, epoch=first_epoch, shard_offset=resume_shard_offset,
+        buckets=buckets, batch_size=batch_size,
+    )
+    if buckets is not None:
+        # The dataset yields whole batches
+        train_dataloader = DataLoader(train_dataset, batch_size=None, num_workers=num_workers, pin_memory=True)
+    else:
+        train_dataloader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
+elif buckets is not None:
+    # Create a dummy dataset with random aspect ratios and batch it by bucket
+    rng = random.Random(data_seed)
+    bucket_ids = [rng.randrange(len(buckets)) for _ in range(num_samples)]
+    dummy_dataset = DummyDataset(num_samples=num_samples, num_tokens=num_tokens, image_dims=[buckets[i] for i in bucket_ids])
+    train_dataloader = DataLoader(dummy_dataset, batch_sampler=BucketBatchSampler(bucket_ids, batch_size, seed=data_seed))
+else:
+    # Create a dummy dataset and dataloader
+    dummy_dataset = DummyDataset(num_samples=num_samples, image_dim=image_dim, num_tokens=num_tokens)
+    train_dataloader = DataLoader(dummy_dataset, batch_size=batch_size, shuffle=True)
 
 # The following lines are placeholders for the rest of your training loop and model components.
 # They should be adjusted or replaced according to your actual model implementations.
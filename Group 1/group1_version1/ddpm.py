@@ -1,9 +1,22 @@
 import torch
 import numpy as np
 
-class DDPMSampler:
-
-    def __init__(self, generator: torch.Generator, num_training_steps=1000, beta_start: float = 0.00085, beta_end: float = 0.0120):
+def randn_tensor(shape, generator, device=None, dtype=None):
+    # A list of generators draws the noise of each sample in the batch from its own generator
+    if isinstance(generator, (list, tuple)):
+        if len(generator) != shape[0]:
+            raise ValueError("Expected %d generators, got %d" % (shape[0], len(generator)))
+        return torch.cat([torch.randn((1, *shape[1:]), generator=g, device=device, dtype=dtype) for g in generator])
+    return torch.randn(shape, generator=generator, device=device, dtype=dtype)
+
+class Sampler:
+    """
+        Base class of the samplers: the noise schedule, the inference timesteps, img2img strength and add_noise.
+        The per-timestep coefficients of a sampler are computed once in set_inference_timesteps, as tables indexed by
+        the training timestep, so step() only does tensor arithmetic on the latents.
+    """
+
+    def __init__(self, generator, num_training_steps=1000, beta_start: float = 0.00085, beta_end: float = 0.0120):
         # Params "beta_start" and "beta_end" taken from: https://github.com/CompVis/stable-diffusion/blob/21f890f9da3cfbeaba8e2ac3c425ee9e998d5229/configs/stable-diffusion/v1-inference.yaml#L5C8-L5C8
         # For the naming conventions, refer to the DDPM paper (https://arxiv.org/pdf/2006.11239.pdf)
         self.betas = torch.linspace(beta_start ** 0.5, beta_end ** 0.5, num_training_steps, dtype=torch.float32) ** 2
@@ -15,84 +28,60 @@ class DDPMSampler:
 
         self.num_train_timesteps = num_training_steps
         self.timesteps = torch.from_numpy(np.arange(0, num_training_steps)[::-1].copy())
+        self.start_step = 0
 
     def set_inference_timesteps(self, num_inference_steps=50):
         self.num_inference_steps = num_inference_steps
         step_ratio = self.num_train_timesteps // self.num_inference_steps
         timesteps = (np.arange(0, num_inference_steps) * step_ratio).round()[::-1].copy().astype(np.int64)
         self.timesteps = torch.from_numpy(timesteps)
+        self.start_step = 0
+
+        # alpha_prod_t and alpha_prod_t_prev for every training timestep t
+        # (Num_Train_Timesteps,)
+        all_timesteps = torch.arange(self.num_train_timesteps)
+        prev_timesteps = all_timesteps - step_ratio
+        alpha_prod_t = self.alphas_cumprod
+        alpha_prod_t_prev = torch.where(prev_timesteps >= 0, self.alphas_cumprod[prev_timesteps.clamp(min=0)], self.one)
+        self._set_coefficients(alpha_prod_t, alpha_prod_t_prev)
+
+    def _set_coefficients(self, alpha_prod_t, alpha_prod_t_prev):
+        raise NotImplementedError
 
     def _get_previous_timestep(self, timestep: int) -> int:
         prev_t = timestep - self.num_train_timesteps // self.num_inference_steps
         return prev_t
-    
-    def _get_variance(self, timestep: int) -> torch.Tensor:
-        prev_t = self._get_previous_timestep(timestep)
-
-        alpha_prod_t = self.alphas_cumprod[timestep]
-        alpha_prod_t_prev = self.alphas_cumprod[prev_t] if prev_t >= 0 else self.one
-        current_beta_t = 1 - alpha_prod_t / alpha_prod_t_prev
-
-        # For t > 0, compute predicted variance βt (see formula (6) and (7) from https://arxiv.org/pdf/2006.11239.pdf)
-        # and sample from it to get previous sample
-        # x_{t-1} ~ N(pred_prev_sample, variance) == add variance to pred_sample
-        variance = (1 - alpha_prod_t_prev) / (1 - alpha_prod_t) * current_beta_t
 
-        # we always take the log of variance, so clamp it to ensure it's not 0
-        variance = torch.clamp(variance, min=1e-20)
-
-        return variance
-    
     def set_strength(self, strength=1):
         """
             Set how much noise to add to the input image. 
             More noise (strength ~ 1) means that the output will be further from the input image.
             Less noise (strength ~ 0) means that the output will be closer to the input image.
         """
-        # start_step is the number of noise levels to skip
-        start_step = self.num_inference_steps - int(self.num_inference_steps * strength)
+        self.set_strengths([strength])
+
+    def set_strengths(self, strengths):
+        """
+            Per-sample strength for batched img2img. The samples share the timesteps from the earliest start step,
+            returns the index of the first step of every sample in self.timesteps: (Batch_Size,)
+        """
+        # start_step is the number of noise levels to skip, every sample gets at least one step
+        start_steps = torch.tensor(
+            [self.num_inference_steps - max(1, int(self.num_inference_steps * strength)) for strength in strengths]
+        )
+        start_step = int(start_steps.min())
         self.timesteps = self.timesteps[start_step:]
         self.start_step = start_step
+        return start_steps - start_step
 
-    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor):
-        t = timestep
-        prev_t = self._get_previous_timestep(t)
-
-        # 1. compute alphas, betas
-        alpha_prod_t = self.alphas_cumprod[t]
-        alpha_prod_t_prev = self.alphas_cumprod[prev_t] if prev_t >= 0 else self.one
-        beta_prod_t = 1 - alpha_prod_t
-        beta_prod_t_prev = 1 - alpha_prod_t_prev
-        current_alpha_t = alpha_prod_t / alpha_prod_t_prev
-        current_beta_t = 1 - current_alpha_t
-
-        # 2. compute predicted original sample from predicted noise also called
-        # "predicted x_0" of formula (15) from https://arxiv.org/pdf/2006.11239.pdf
-        pred_original_sample = (latents - beta_prod_t ** (0.5) * model_output) / alpha_prod_t ** (0.5)
+    def reset_state(self, mask):
+        # The samples in mask (Batch_Size,) start at the next step, samplers that keep a history of the previous steps
+        # must not use it for them
+        pass
 
-        # 4. Compute coefficients for pred_original_sample x_0 and current sample x_t
-        # See formula (7) from https://arxiv.org/pdf/2006.11239.pdf
-        pred_original_sample_coeff = (alpha_prod_t_prev ** (0.5) * current_beta_t) / beta_prod_t
-        current_sample_coeff = current_alpha_t ** (0.5) * beta_prod_t_prev / beta_prod_t
-
-        # 5. Compute predicted previous sample µ_t
-        # See formula (7) from https://arxiv.org/pdf/2006.11239.pdf
-        pred_prev_sample = pred_original_sample_coeff * pred_original_sample + current_sample_coeff * latents
-
-        # 6. Add noise
-        variance = 0
-        if t > 0:
-            device = model_output.device
-            noise = torch.randn(model_output.shape, generator=self.generator, device=device, dtype=model_output.dtype)
-            # Compute the variance as per formula (7) from https://arxiv.org/pdf/2006.11239.pdf
-            variance = (self._get_variance(t) ** 0.5) * noise
-        
-        # sample from N(mu, sigma) = X can be obtained by X = mu + sigma * N(0, 1)
-        # the variable "variance" is already multiplied by the noise N(0, 1)
-        pred_prev_sample = pred_prev_sample + variance
+    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor):
+        raise NotImplementedError
 
-        return pred_prev_sample
-    
     def add_noise(
         self,
         original_samples: torch.FloatTensor,
@@ -114,10 +103,53 @@ class DDPMSampler:
         # Sample from q(x_t | x_0) as in equation (4) of https://arxiv.org/pdf/2006.11239.pdf
         # Because N(mu, sigma) = X can be obtained by X = mu + sigma * N(0, 1)
         # here mu = sqrt_alpha_prod * original_samples and sigma = sqrt_one_minus_alpha_prod
-        noise = torch.randn(original_samples.shape, generator=self.generator, device=original_samples.device, dtype=original_samples.dtype)
+        noise = randn_tensor(original_samples.shape, self.generator, device=original_samples.device, dtype=original_samples.dtype)
         noisy_samples = sqrt_alpha_prod * original_samples + sqrt_one_minus_alpha_prod * noise
         return noisy_samples, noise
 
-        
+    def _noise(self, model_output):
+        return randn_tensor(model_output.shape, self.generator, device=model_output.device, dtype=model_output.dtype)
+
+class DDPMSampler(Sampler):
+
+    def _set_coefficients(self, alpha_prod_t, alpha_prod_t_prev):
+        # 1. compute alphas, betas
+        beta_prod_t = 1 - alpha_prod_t
+        beta_prod_t_prev = 1 - alpha_prod_t_prev
+        current_alpha_t = alpha_prod_t / alpha_prod_t_prev
+        current_beta_t = 1 - current_alpha_t
 
-    
\ No newline at end of file
+        # 2. the predicted original sample ("predicted x_0" of formula (15) from https://arxiv.org/pdf/2006.11239.pdf)
+        # is pred_original_sample = (latents - beta_prod_t ** 0.5 * model_output) / alpha_prod_t ** 0.5
+
+        # 4. Compute coefficients for pred_original_sample x_0 and current sample x_t
+        # See formula (7) from https://arxiv.org/pdf/2006.11239.pdf
+        pred_original_sample_coeff = (alpha_prod_t_prev ** (0.5) * current_beta_t) / beta_prod_t
+        current_sample_coeff = current_alpha_t ** (0.5) * beta_prod_t_prev / beta_prod_t
+
+        # Fold the predicted original sample into the coefficients of latents and model_output
+        self.latents_coeff = pred_original_sample_coeff / alpha_prod_t ** 0.5 + current_sample_coeff
+        self.model_output_coeff = -pred_original_sample_coeff * beta_prod_t ** 0.5 / alpha_prod_t ** 0.5
+
+        # For t > 0, compute predicted variance βt (see formula (6) and (7) from https://arxiv.org/pdf/2006.11239.pdf)
+        # and sample from it to get previous sample
+        # x_{t-1} ~ N(pred_prev_sample, variance) == add variance to pred_sample
+        variance = (1 - alpha_prod_t_prev) / (1 - alpha_prod_t) * current_beta_t
+        # we always take the log of variance, so clamp it to ensure it's not 0
+        variance = torch.clamp(variance, min=1e-20)
+        self.std = variance ** 0.5
+        self.std[0] = 0
+
+    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor):
+        t = timestep
+
+        # 5. Compute predicted previous sample µ_t
+        # See formula (7) from https://arxiv.org/pdf/2006.11239.pdf
+        pred_prev_sample = self.latents_coeff[t] * latents + self.model_output_coeff[t] * model_output
+
+        # 6. Add noise
+        if t > 0:
+            # sample from N(mu, sigma) = X can be obtained by X = mu + sigma * N(0, 1)
+            pred_prev_sample = pred_prev_sample + self.std[t] * self._noise(model_output)
+
+        return pred_prev_sample
@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from attention import SelfAttention, CrossAttention
 
 class TimeEmbedding(nn.Module):
@@ -76,6 +77,9 @@ class UNET_ResidualBlock(nn.Module):
         return merged + self.residual_layer(residue)
 
 class UNET_AttentionBlock(nn.Module):
+    # Merges similar tokens before the self-attention and unmerges them after it, see token_merging.apply_token_merging
+    token_merging = None
+
     def __init__(self, n_head: int, n_embd: int, d_context=768, is_upsample=False):
         super().__init__()
         channels = n_head * n_embd
@@ -161,8 +165,14 @@ class UNET_AttentionBlock(nn.Module):
         # (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
         x = self.layernorm_1(x)
         
-        # (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
-        x = self.attention_1(x)
+        if self.token_merging is not None:
+            # (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width - r, Features)
+            merge, unmerge = self.token_merging(x, h, w)
+            # (Batch_Size, Height * Width - r, Features) -> (Batch_Size, Height * Width, Features)
+            x = unmerge(self.attention_1(merge(x)))
+        else:
+            # (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
+            x = self.attention_1(x)
         
         # (Batch_Size, Height * Width, Features) + (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width, Features)
         x += residue_short
@@ -276,15 +286,24 @@ class Upsample(nn.Module):
         return self.conv(x)
 
 class SwitchSequential(nn.Sequential):
+    # Recompute the activations of the residual and attention blocks in the backward pass instead of storing them,
+    # see set_gradient_checkpointing
+    gradient_checkpointing = False
+
+    def _call(self, layer, *args):
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint(layer, *args, use_reentrant=False)
+        return layer(*args)
+
     def forward(self, x, context, time, aug_emb=None, hidden_text_query=None, is_upsample=True):
         for layer in self:
             if isinstance(layer, UNET_AttentionBlock):
                 if aug_emb is not None and hidden_text_query is not None and not is_upsample:
-                    x, hidden_text_query = layer(x, context, aug_emb, hidden_text_query, is_upsample)
+                    x, hidden_text_query = self._call(layer, x, context, aug_emb, hidden_text_query, is_upsample)
                 else:
-                    x = layer(x, context)
+                    x = self._call(layer, x, context)
             elif isinstance(layer, UNET_ResidualBlock):
-                x = layer(x, time)
+                x = self._call(layer, x, time)
             else:
                 x = layer(x)
 
@@ -383,13 +402,26 @@ class UNET(nn.Module):
             SwitchSequential(UNET_ResidualBlock(640, 320), UNET_AttentionBlock(8, 40, is_upsample=True)),
         ])
 
-    def forward(self, x, context, time, aug_emb):
+    def forward(self, x, context, time, aug_emb, deep_cache=None, reuse_deep_cache=False):
         # x: (Batch_Size, 4, Height / 8, Width / 8)
         # context: (Batch_Size, Seq_Len, Dim) 
         # time: (1, 1280)
+        # deep_cache: dict that stores the deep features of a full forward pass, see DeepCache (https://arxiv.org/pdf/2312.00858.pdf)
+        # reuse_deep_cache: only run the shallow encoders[0] / decoders[-1] path on top of the cached deep features
 
-        skip_connections = []
         hidden_text_query = torch.zeros_like(aug_emb)
+
+        if reuse_deep_cache:
+            # (Batch_Size, 4, Height / 8, Width / 8) -> (Batch_Size, 320, Height / 8, Width / 8)
+            x, _ = self.encoders[0](x, context, time, aug_emb, hidden_text_query, is_upsample=False)
+            # (Batch_Size, 320, Height / 8, Width / 8) + (Batch_Size, 320, Height / 8, Width / 8) -> (Batch_Size, 640, Height / 8, Width / 8)
+            x = torch.cat((deep_cache["features"], x), dim=1)
+            # (Batch_Size, 640, Height / 8, Width / 8) -> (Batch_Size, 320, Height / 8, Width / 8)
+            x = self.decoders[-1](x, context, time)
+            # The text query is only updated in the encoders and the bottleneck
+            return x, deep_cache["hidden_text_query"]
+
+        skip_connections = []
         for layers in self.encoders:
             # Get the output of the attention block
             x, hidden_text_query = layers(x, context, time, aug_emb, hidden_text_query, is_upsample=False)
@@ -399,7 +431,11 @@ class UNET(nn.Module):
         x, hidden_text_query = self.bottleneck(x, context, time, aug_emb, hidden_text_query, is_upsample=False)
 
         # Get the output of the upsampling blocks
-        for layers in self.decoders:
+        for i, layers in enumerate(self.decoders):
+            if deep_cache is not None and i == len(self.decoders) - 1:
+                # (Batch_Size, 320, Height / 8, Width / 8)
+                deep_cache["features"] = x
+                deep_cache["hidden_text_query"] = hidden_text_query
             # Since we always concat with the skip connection of the encoder, the number of features increases before being sent to the decoder's layer
             x = torch.cat((x, skip_connections.pop()), dim=1) 
             x = layers(x, context, time)
@@ -436,12 +472,13 @@ class Diffusion(nn.Module):
         self.unet = UNET()
         self.final = UNET_OutputLayer(320, 4)
     
-    def forward(self, latent, context, image_time_embeddings, text_time_embeddings, text_query):
+    def forward(self, latent, context, image_time_embeddings, text_time_embeddings, text_query, deep_cache=None, reuse_deep_cache=False):
         # latent: (Batch_Size, 4, Height / 8, Width / 8)
         # context: (Batch_Size, Seq_Len, Dim)
         # image_time_embeddings: (1, 320)
         # text_time_embeddings: (1, 192)
         # text_query: (1, 768)
+        # deep_cache, reuse_deep_cache: see UNET.forward
 
         # (1, 320) -> (1, 1280)
         image_time_embeddings = self.image_time_embedding(image_time_embeddings)
@@ -453,10 +490,16 @@ class Diffusion(nn.Module):
         aug_emb = text_query + text_time_embeddings
         
         # (Batch, 4, Height / 8, Width / 8) -> (Batch, 320, Height / 8, Width / 8)
-        image_output, text_output = self.unet(latent, context, image_time_embeddings, aug_emb)
+        image_output, text_output = self.unet(latent, context, image_time_embeddings, aug_emb, deep_cache, reuse_deep_cache)
         
         # (Batch, 320, Height / 8, Width / 8) -> (Batch, 4, Height / 8, Width / 8)
         image_output = self.final(image_output)
         
         # (Batch, 4, Height / 8, Width / 8)
-        return image_output, text_output
\ No newline at end of file
+        return image_output, text_output
+
+def set_gradient_checkpointing(model, enabled=True):
+    # Enable or disable activation checkpointing of every UNET_ResidualBlock and UNET_AttentionBlock in the model
+    for module in model.modules():
+        if isinstance(module, SwitchSequential):
+            module.gradient_checkpointing = enabled
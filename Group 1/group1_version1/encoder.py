@@ -73,6 +73,15 @@ class VAE_Encoder(nn.Sequential):
         # x: (Batch_Size, Channel, Height, Width)
         # noise: (Batch_Size, 4, Height / 8, Width / 8)
 
+        # (Batch_Size, Channel, Height, Width) -> two tensors of shape (Batch_Size, 4, Height / 8, Width / 8)
+        mean, log_variance = self.encode_moments(x)
+
+        return sample_latents(mean, log_variance, noise)
+
+    def encode_moments(self, x):
+        # x: (Batch_Size, Channel, Height, Width)
+        # Returns the mean and the log variance of the latent distribution, without sampling from it
+
         for module in self:
 
             if getattr(module, 'stride', None) == (2, 2):  # Padding at downsampling should be asymmetric (see #8)
@@ -87,18 +96,23 @@ class VAE_Encoder(nn.Sequential):
         # Clamp the log variance between -30 and 20, so that the variance is between (circa) 1e-14 and 1e8. 
         # (Batch_Size, 4, Height / 8, Width / 8) -> (Batch_Size, 4, Height / 8, Width / 8)
         log_variance = torch.clamp(log_variance, -30, 20)
-        # (Batch_Size, 4, Height / 8, Width / 8) -> (Batch_Size, 4, Height / 8, Width / 8)
-        variance = log_variance.exp()
-        # (Batch_Size, 4, Height / 8, Width / 8) -> (Batch_Size, 4, Height / 8, Width / 8)
-        stdev = variance.sqrt()
-        
-        # Transform N(0, 1) -> N(mean, stdev) 
-        # (Batch_Size, 4, Height / 8, Width / 8) -> (Batch_Size, 4, Height / 8, Width / 8)
-        x = mean + stdev * noise
-        
-        # Scale by a constant
-        # Constant taken from: https://github.com/CompVis/stable-diffusion/blob/21f890f9da3cfbeaba8e2ac3c425ee9e998d5229/configs/stable-diffusion/v1-inference.yaml#L17C1-L17C1
-        x *= 0.18215
-        
-        return x
 
+        return mean, log_variance
+
+def sample_latents(mean, log_variance, noise):
+    # mean, log_variance, noise: (Batch_Size, 4, Height / 8, Width / 8)
+
+    # (Batch_Size, 4, Height / 8, Width / 8) -> (Batch_Size, 4, Height / 8, Width / 8)
+    variance = log_variance.exp()
+    # (Batch_Size, 4, Height / 8, Width / 8) -> (Batch_Size, 4, Height / 8, Width / 8)
+    stdev = variance.sqrt()
+    
+    # Transform N(0, 1) -> N(mean, stdev) 
+    # (Batch_Size, 4, Height / 8, Width / 8) -> (Batch_Size, 4, Height / 8, Width / 8)
+    x = mean + stdev * noise
+    
+    # Scale by a constant
+    # Constant taken from: https://github.com/CompVis/stable-diffusion/blob/21f890f9da3cfbeaba8e2ac3c425ee9e998d5229/configs/stable-diffusion/v1-inference.yaml#L17C1-L17C1
+    x *= 0.18215
+    
+    return x
\ No newline at end of file
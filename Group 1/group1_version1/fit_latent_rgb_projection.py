@@ -0,0 +1,97 @@
+import os
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from latent_preview import LatentRGBProjection
+from benchmark import build_models, write_results, git_commit
+
+# Fits the latent to RGB projection of latent_preview.py to the outputs of the VAE_Decoder, offline.
+# Latents are taken from images encoded with the VAE_Encoder (--images) or sampled from N(0, 1),
+# decoded with the VAE_Decoder and downsampled to the latent resolution (area averaging of every 8x8 patch).
+# The projection is the least squares solution of [latents, 1] @ W = rgb over all the latent pixels.
+# The fitted weights are written with torch.save and loaded with latent_preview.load_latent_rgb_projection.
+#   python fit_latent_rgb_projection.py --weights-dir weights --images data/images --output latent_rgb.pt
+
+def load_images(directory, size, limit):
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith((".png", ".jpg", ".jpeg", ".webp")))[:limit]
+    images = [np.array(Image.open(os.path.join(directory, name)).convert("RGB").resize((size, size))) for name in names]
+    # (N, Height, Width, Channel) -> (N, Channel, Height, Width) in [-1, 1]
+    return torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).float() / 127.5 - 1
+
+def collect(models, images, num_samples, size, batch_size, generator):
+    # Returns the latent pixels (N, 4) and the RGB of the decoded 8x8 patches (N, 3)
+    latents_size = size // 8
+    latents_list, rgb_list = [], []
+    for start in range(0, num_samples, batch_size):
+        n = min(batch_size, num_samples - start)
+        if images is not None:
+            noise = torch.randn((n, 4, latents_size, latents_size), generator=generator)
+            latents = models["encoder"](images[start:start + n], noise)
+        else:
+            latents = torch.randn((n, 4, latents_size, latents_size), generator=generator)
+        # (N, 3, Height, Width) -> (N, 3, Height / 8, Width / 8)
+        rgb = F.avg_pool2d(models["decoder"](latents.clone()).clamp(-1, 1), 8)
+        latents_list.append(latents.permute(0, 2, 3, 1).reshape(-1, 4))
+        rgb_list.append(rgb.permute(0, 2, 3, 1).reshape(-1, 3))
+    return torch.cat(latents_list).float(), torch.cat(rgb_list).float()
+
+def fit(latents, rgb):
+    # Least squares with a bias column: (N, 5) @ (5, 3) = (N, 3)
+    x = torch.cat([latents, torch.ones_like(latents[:, :1])], dim=1)
+    solution = torch.linalg.lstsq(x, rgb).solution
+    return solution[:4], solution[4]
+
+def evaluate(projection, latents, rgb):
+    # PSNR of the projected latent pixels against the decoded ones, both in [-1, 1]
+    with torch.no_grad():
+        output = projection(latents[:, :, None, None]).flatten(1).clamp(-1, 1)
+    mse = F.mse_loss(output, rgb).item()
+    return 10 * np.log10(4 / mse)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights-dir", default=None, help="Converted weights (see model_converter.py), random weights if not set")
+    parser.add_argument("--images", default=None, help="Directory of images to encode, N(0, 1) latents if not set")
+    parser.add_argument("--num-samples", type=int, default=64)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--holdout", type=float, default=0.2, help="Fraction of the samples used to evaluate the fit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="latent_rgb.pt")
+    parser.add_argument("--results", default=None)
+    args = parser.parse_args()
+
+    names = ["encoder", "decoder"] if args.images else ["decoder"]
+    if args.weights_dir:
+        from model_loader import load_converted_model
+        models = {name: load_converted_model(args.weights_dir, name, "cpu").eval() for name in names}
+    else:
+        models = build_models(names, "cpu", torch.float32, seed=args.seed)
+
+    images = load_images(args.images, args.size, args.num_samples) if args.images else None
+    num_samples = len(images) if images is not None else args.num_samples
+    generator = torch.Generator().manual_seed(args.seed)
+    with torch.no_grad():
+        latents, rgb = collect(models, images, num_samples, args.size, args.batch_size, generator)
+
+    # Hold out the last latent pixels (the last images) for the evaluation
+    split = int(len(latents) * (1 - args.holdout))
+    factors, bias = fit(latents[:split], rgb[:split])
+    projection = LatentRGBProjection(factors.tolist(), bias.tolist())
+    torch.save(projection.state_dict(), args.output)
+
+    results = {
+        "factors": factors.tolist(),
+        "bias": bias.tolist(),
+        "holdout_psnr": evaluate(projection, latents[split:], rgb[split:]),
+        "default_holdout_psnr": evaluate(LatentRGBProjection(), latents[split:], rgb[split:]),
+        "latent_pixels": len(latents),
+        "config": vars(args),
+        "commit": git_commit(),
+    }
+    write_results(results, args.results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import torch
+from torch import nn
+
+# Cheap previews of the latents during the denoising loop.
+# Every latent pixel is projected to RGB with a 1x1 convolution (a 4 -> 3 linear map) instead of running the VAE_Decoder,
+# so a preview costs a few microseconds and has 1/8 of the image resolution.
+# The default weights are the latent to RGB factors commonly used for Stable Diffusion 1.x,
+# fit_latent_rgb_projection.py fits them to the outputs of a decoder.
+
+# (4, 3): the RGB contribution of every latent channel, in [-1, 1]
+LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+class LatentRGBProjection(nn.Module):
+
+    def __init__(self, factors=LATENT_RGB_FACTORS, bias=None):
+        super().__init__()
+        self.projection = nn.Conv2d(4, 3, kernel_size=1)
+        with torch.no_grad():
+            # (4, 3) -> (3, 4, 1, 1)
+            self.projection.weight.copy_(torch.tensor(factors).t()[:, :, None, None])
+            self.projection.bias.zero_()
+            if bias is not None:
+                self.projection.bias.copy_(torch.tensor(bias))
+        self.requires_grad_(False)
+
+    def forward(self, latents):
+        # (Batch_Size, 4, Latents_Height, Latents_Width) -> (Batch_Size, 3, Latents_Height, Latents_Width), in [-1, 1]
+        weight = self.projection.weight.to(latents.device, latents.dtype)
+        bias = self.projection.bias.to(latents.device, latents.dtype)
+        return nn.functional.conv2d(latents, weight, bias)
+
+    @torch.no_grad()
+    def to_images(self, latents):
+        # (Batch_Size, 4, Latents_Height, Latents_Width) -> (Batch_Size, Latents_Height, Latents_Width, 3) uint8 array
+        images = self(latents).float()
+        images = ((images.clamp(-1, 1) + 1) * 127.5).round()
+        return images.permute(0, 2, 3, 1).to("cpu", torch.uint8).numpy()
+
+def load_latent_rgb_projection(path=None):
+    # The default factors, or the weights written by fit_latent_rgb_projection.py
+    projection = LatentRGBProjection()
+    if path is not None:
+        projection.load_state_dict(torch.load(path, map_location="cpu"))
+    return projection.eval()
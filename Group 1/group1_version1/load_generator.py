@@ -0,0 +1,96 @@
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.request
+from benchmark import percentile, write_results, git_commit
+
+# Open-loop load generator for server.py.
+# For every offered load (requests per second), requests are sent at exponentially distributed intervals (Poisson
+# arrivals) for a fixed duration, whether or not the previous ones have completed, and the end-to-end latencies are
+# reported as percentiles together with the achieved throughput and the batch sizes the server used.
+#   python load_generator.py --url http://127.0.0.1:8000 --rates 0.5 1 2 4 --duration 60 --steps 20 --output load.json
+
+def send(url, body, timeout):
+    request = urllib.request.Request(url + "/generate", data=json.dumps(body).encode(),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+        return int(response.headers.get("X-Batch-Size", 1)), float(response.headers.get("X-Queue-Ms", 0))
+
+def run_load(url, rate, duration, body, timeout=600, seed=0):
+    rng = random.Random(seed)
+    results = []
+    lock = threading.Lock()
+
+    def worker(index):
+        start_time = time.perf_counter()
+        try:
+            batch_size, queue_ms = send(url, dict(body, seed=index), timeout)
+            result = {"latency": time.perf_counter() - start_time, "batch_size": batch_size, "queue_ms": queue_ms}
+        except Exception as e:
+            result = {"error": str(e)}
+        with lock:
+            results.append(result)
+
+    threads = []
+    start_time = time.perf_counter()
+    next_time = start_time
+    index = 0
+    while next_time - start_time < duration:
+        time.sleep(max(0.0, next_time - time.perf_counter()))
+        thread = threading.Thread(target=worker, args=(index,))
+        thread.start()
+        threads.append(thread)
+        index += 1
+        next_time += rng.expovariate(rate)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+
+    latencies = [result["latency"] for result in results if "latency" in result]
+    batch_sizes = [result["batch_size"] for result in results if "batch_size" in result]
+    return {
+        "offered_rps": rate,
+        "sent": len(results),
+        "completed": len(latencies),
+        "errors": len(results) - len(latencies),
+        "achieved_rps": len(latencies) / elapsed,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p95_ms": percentile(latencies, 95) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "queue_p50_ms": percentile([result["queue_ms"] for result in results if "queue_ms" in result], 50),
+        "mean_batch_size": sum(batch_sizes) / max(len(batch_sizes), 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--rates", type=float, nargs="+", default=[0.5, 1, 2, 4], help="Offered loads in requests per second")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load per rate")
+    parser.add_argument("--prompt", default="a photograph of an astronaut riding a horse")
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--sampler", default="ddim")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    body = {"prompt": args.prompt, "width": args.width, "height": args.height, "sampler_name": args.sampler,
+            "n_inference_steps": args.steps}
+    results = {"loads": []}
+    for rate in args.rates:
+        result = run_load(args.url, rate, args.duration, body, timeout=args.timeout)
+        print(json.dumps(result))
+        results["loads"].append(result)
+
+    with urllib.request.urlopen(args.url + "/stats") as response:
+        results["server_stats"] = json.loads(response.read())
+    results["config"] = vars(args)
+    results["commit"] = git_commit()
+    write_results(results, args.output)
+
+if __name__ == "__main__":
+    main()
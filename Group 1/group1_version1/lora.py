@@ -0,0 +1,165 @@
+import math
+import argparse
+import torch
+from torch import nn
+from diffusion import UNET_AttentionBlock
+
+# Low-rank adapters (LoRA, https://arxiv.org/pdf/2106.09685.pdf) for fine-tuning the UNET.
+# Every nn.Linear of the UNET_AttentionBlocks (the SelfAttention / CrossAttention projections, the GEGLU linears and the
+# text query linears) is wrapped in a LoRALinear: the base weight W is frozen and the update is the low-rank product
+# W + (alpha / rank) * up @ down. Only up and down are trained and saved, and up starts at zero, so the adapted model
+# starts as the base model. merge_lora folds the update into W for inference, which removes the extra matmuls.
+# The DiffDis layers are not in the SD checkpoint: a base parameter that was not loaded has no pretrained value to
+# adapt, so it is trained and saved with the adapters (inject_lora(trainable=model.unloaded_parameters)). Otherwise the
+# adapters would be trained on random weights that are different in every process that loads them.
+
+class LoRALinear(nn.Module):
+
+    def __init__(self, base: nn.Linear, rank=4, alpha=None, dropout=0.0):
+        super().__init__()
+        self.base = base
+        self.rank = rank
+        self.scale = (alpha if alpha is not None else rank) / rank
+        factory = {"device": base.weight.device, "dtype": base.weight.dtype}
+        # (In_Features) -> (Rank) -> (Out_Features)
+        self.lora_down = nn.Linear(base.in_features, rank, bias=False, **factory)
+        self.lora_up = nn.Linear(rank, base.out_features, bias=False, **factory)
+        self.dropout = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
+        nn.init.kaiming_uniform_(self.lora_down.weight, a=math.sqrt(5))
+        nn.init.zeros_(self.lora_up.weight)
+
+    @property
+    def in_features(self):
+        return self.base.in_features
+
+    @property
+    def out_features(self):
+        return self.base.out_features
+
+    def forward(self, x):
+        return self.base(x) + self.lora_up(self.lora_down(self.dropout(x))) * self.scale
+
+    def merged(self):
+        # The base linear with the update folded into its weight: W + scale * up @ down
+        with torch.no_grad():
+            update = self.lora_up.weight.float() @ self.lora_down.weight.float() * self.scale
+            self.base.weight += update.to(self.base.weight.dtype)
+        return self.base
+
+def _lora_targets(model):
+    # (parent module, attribute name, linear) of every nn.Linear inside the UNET_AttentionBlocks that is not already
+    # wrapped, the linears of the LoRALinears (base, lora_down and lora_up) are not targets
+    targets = []
+
+    def visit(module):
+        for name, child in module.named_children():
+            if isinstance(child, LoRALinear):
+                continue
+            if isinstance(child, nn.Linear):
+                targets.append((module, name, child))
+            else:
+                visit(child)
+
+    for block in model.modules():
+        if isinstance(block, UNET_AttentionBlock):
+            visit(block)
+    return targets
+
+def inject_lora(model, rank=4, alpha=None, dropout=0.0, trainable=()):
+    """
+        Freezes every parameter of the model (a Diffusion or a UNET) except the ones named in trainable, and wraps the
+        linears of the UNET_AttentionBlocks in LoRALinear adapters, in place. Returns the trainable parameters: the
+        adapters and the trainable base parameters, which lora_state_dict saves with the adapters.
+        trainable are the parameter names before the injection, e.g. model.unloaded_parameters (see model_loader).
+        The linears that already have an adapter keep it, so injecting twice does not wrap the adapters themselves.
+    """
+    # The parameter objects stay the same when their linear is wrapped, their names get a ".base"
+    named_parameters = dict(model.named_parameters())
+    unknown = set(trainable) - set(named_parameters)
+    if unknown:
+        raise ValueError(f"The model has no parameters {', '.join(sorted(unknown))}")
+    model.requires_grad_(False)
+    base_parameters = [named_parameters[name] for name in trainable]
+    for parameter in base_parameters:
+        parameter.requires_grad_(True)
+    for module, name, linear in _lora_targets(model):
+        setattr(module, name, LoRALinear(linear, rank=rank, alpha=alpha, dropout=dropout))
+    # The adapters are trained, also the ones of a previous injection
+    parameters = list(base_parameters)
+    for module in model.modules():
+        if isinstance(module, LoRALinear):
+            for linear in (module.lora_down, module.lora_up):
+                linear.requires_grad_(True)
+                parameters.extend(linear.parameters())
+    return parameters
+
+def lora_state_dict(model):
+    # The adapter tensors and the trainable base parameters of a model with injected adapters, see inject_lora
+    trained = {name for name, parameter in model.named_parameters() if parameter.requires_grad and ".lora_" not in name}
+    return {key: value for key, value in model.state_dict().items() if ".lora_" in key or key in trained}
+
+def load_lora(model, state_dict):
+    # Loads tensors saved with lora_state_dict into a model with injected adapters
+    # All the adapters and trainable base parameters of the model must be in state_dict, which can have other base
+    # parameters too (a model for inference has no trainable base parameters)
+    missing = set(lora_state_dict(model)) - set(state_dict)
+    unexpected = set(state_dict) - set(model.state_dict())
+    if missing or unexpected:
+        raise ValueError(f"The LoRA state dict does not match the model: {len(missing)} missing and {len(unexpected)} unexpected keys")
+    model.load_state_dict(state_dict, strict=False)
+    return model
+
+def save_lora(model, path):
+    torch.save(lora_state_dict(model), path)
+
+def merge_lora(model):
+    # Replaces every LoRALinear of the model with its base linear with the update merged in, in place
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, LoRALinear):
+                setattr(module, name, child.merged())
+    return model
+
+def parameter_bytes(parameters):
+    return sum(parameter.numel() * parameter.element_size() for parameter in parameters)
+
+if __name__ == "__main__":
+    import io
+    import json
+    from diffusion import Diffusion
+
+    # Memory and checkpoint size of full fine-tuning against LoRA, computed on a meta UNET (no weights are allocated)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ranks", type=int, nargs="+", default=[4, 8, 16, 64])
+    args = parser.parse_args()
+
+    with torch.device("meta"):
+        diffusion = Diffusion()
+    num_parameters = sum(parameter.numel() for parameter in diffusion.parameters())
+    # fp32 weights + gradients + the two AdamW moments of every trained parameter
+    results = {"full": {
+        "trainable_parameters": num_parameters,
+        "checkpoint_bytes": parameter_bytes(diffusion.parameters()),
+        "training_state_bytes": 4 * parameter_bytes(diffusion.parameters()),
+    }}
+
+    for rank in args.ranks:
+        with torch.device("meta"):
+            diffusion = Diffusion()
+        trainable = inject_lora(diffusion, rank=rank)
+        frozen = [parameter for parameter in diffusion.parameters() if not parameter.requires_grad]
+        # The size of the saved adapters, with real (zero) tensors of the same shapes
+        buffer = io.BytesIO()
+        torch.save({key: torch.zeros(value.shape, dtype=value.dtype) for key, value in lora_state_dict(diffusion).items()}, buffer)
+        results[f"lora_rank_{rank}"] = {
+            "trainable_parameters": sum(parameter.numel() for parameter in trainable),
+            "checkpoint_bytes": buffer.tell(),
+            # The frozen weights need no gradients and no optimizer state
+            "training_state_bytes": parameter_bytes(frozen) + 4 * parameter_bytes(trainable),
+        }
+        results[f"lora_rank_{rank}"]["checkpoint_reduction"] = results["full"]["checkpoint_bytes"] / buffer.tell()
+        results[f"lora_rank_{rank}"]["training_state_reduction"] = (
+            results["full"]["training_state_bytes"] / results[f"lora_rank_{rank}"]["training_state_bytes"]
+        )
+
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+import torch
+from benchmark import synchronize, reset_peak_memory, peak_memory, peak_rss_bytes, git_commit
+
+# Per-step throughput metrics and an optional profiler window for the training loop.
+# Every optimizer step is split into phases (data wait, encode, forward, backward, optimizer, checkpoint). The device is
+# synchronized once at the end of every step, so the step time and the throughput include the asynchronous CUDA kernels.
+# Synchronizing at every phase boundary attributes the kernel time to the phase that launched it, but drains the stream
+# between the phases and slows the training down, so it is only done every phase_sync_interval steps. On the other
+# steps the phase times are the host time of the phases (the kernel launches on CUDA), "phases_synchronized" tells
+# which one a record has. The records are appended to a JSONL file, one line per step, so runs can be compared.
+
+class JSONLSink:
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a")
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        # Flushed every step, so a crashed run keeps its metrics
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class StepMetrics:
+
+    def __init__(self, device, sink=None, run_info=None, phase_sync_interval=None):
+        self.device = device
+        self.sink = sink
+        self.phase_sync_interval = phase_sync_interval
+        self.num_steps = 0
+        self.sync_phases = self._sync_phases()
+        self.times = {}
+        self.num_samples = 0
+        self.step_start = None
+        self.data_start = time.perf_counter()
+        if sink is not None:
+            # The first line describes the run
+            sink.write({"run": run_info or {}, "commit": git_commit(), "torch": torch.__version__, "time": time.time()})
+        reset_peak_memory(device)
+
+    def _sync_phases(self):
+        return bool(self.phase_sync_interval) and self.num_steps % self.phase_sync_interval == 0
+
+    def _add(self, name, elapsed):
+        self.times[name] = self.times.get(name, 0.0) + elapsed
+
+    def data_ready(self):
+        # Called when a batch arrives: the time since the previous batch was consumed is data wait
+        now = time.perf_counter()
+        if self.step_start is None:
+            self.step_start = self.data_start
+        self._add("data", now - self.data_start)
+
+    def batch_done(self, num_samples):
+        # Called at the end of every batch (micro batch with gradient accumulation)
+        self.num_samples += num_samples
+        self.data_start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        if self.sync_phases:
+            synchronize(self.device)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync_phases:
+                synchronize(self.device)
+            self._add(name, time.perf_counter() - start_time)
+
+    def end_step(self, step, **values):
+        # Writes the record of the optimizer step and starts the next one
+        synchronize(self.device)
+        now = time.perf_counter()
+        step_time = now - self.step_start
+        record = {"step": step, "step_time": step_time, "samples": self.num_samples,
+                  "samples_per_second": self.num_samples / step_time}
+        record.update({f"{name}_time": elapsed for name, elapsed in self.times.items()})
+        record["phases_synchronized"] = self.sync_phases
+        memory = peak_memory(self.device)
+        # Peak memory of the tensors on CUDA, peak resident memory of the process otherwise
+        record["peak_memory_bytes"] = memory if memory is not None else peak_rss_bytes()
+        record.update(values)
+        if self.sink is not None:
+            self.sink.write(record)
+
+        self.times = {}
+        self.num_samples = 0
+        self.num_steps += 1
+        self.sync_phases = self._sync_phases()
+        self.step_start = now
+        self.data_start = now
+        reset_peak_memory(self.device)
+        return record
+
+def format_record(record):
+    # One line summary of a step record
+    phases = " ".join(f"{key[:-5]}={value * 1000:.0f}ms" for key, value in record.items()
+                      if key.endswith("_time") and key != "step_time")
+    return (f"step {record['step']}: {record['step_time'] * 1000:.0f}ms ({phases}) "
+            f"{record['samples_per_second']:.2f} samples/s peak memory {record['peak_memory_bytes'] / 1024 ** 3:.2f} GB"
+            + (f" loss {record['loss']:.4f}" if "loss" in record else ""))
+
+class ProfilerWindow:
+    """
+        Runs torch.profiler from start_step (included) to stop_step (excluded) and writes a Chrome trace
+        (chrome://tracing or https://ui.perfetto.dev) and a table of the most expensive operators to output_dir.
+        step(global_step) must be called at the start of every optimizer step.
+    """
+
+    def __init__(self, output_dir, start_step=None, stop_step=None, device="cpu", profile_memory=False):
+        self.output_dir = output_dir
+        self.start_step = start_step
+        self.stop_step = stop_step
+        self.profiler = None
+        self.enabled = start_step is not None and stop_step is not None and stop_step > start_step
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.device(device).type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.activities = activities
+        self.profile_memory = profile_memory
+
+    def step(self, global_step):
+        if not self.enabled:
+            return
+        if global_step == self.start_step and self.profiler is None:
+            self.profiler = torch.profiler.profile(activities=self.activities, record_shapes=True,
+                                                   profile_memory=self.profile_memory, with_stack=False)
+            self.profiler.start()
+        elif global_step == self.stop_step and self.profiler is not None:
+            self.stop()
+
+    def stop(self):
+        # Also called at the end of training, in case stop_step was not reached
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = f"trace-{self.start_step}-{self.stop_step}"
+        self.profiler.export_chrome_trace(os.path.join(self.output_dir, name + ".json"))
+        sort_by = "cuda_time_total" if torch.profiler.ProfilerActivity.CUDA in self.activities else "cpu_time_total"
+        with open(os.path.join(self.output_dir, name + ".txt"), "w") as f:
+            f.write(self.profiler.key_averages().table(sort_by=sort_by, row_limit=50))
+        self.profiler = None
+        self.enabled = False
@@ -1,3 +1,5 @@
+import os
+import argparse
 import torch
 
 def load_from_standard_weights(input_file: str, device: str) -> dict[str, torch.Tensor]:
@@ -1053,4 +1055,24 @@ def load_from_standard_weights(input_file: str, device: str) -> dict[str, torch.
     converted['clip']['layers.11.attention.in_proj.weight'] = torch.cat((original_model['cond_stage_model.transformer.text_model.encoder.layers.11.self_attn.q_proj.weight'], original_model['cond_stage_model.transformer.text_model.encoder.layers.11.self_attn.k_proj.weight'], original_model['cond_stage_model.transformer.text_model.encoder.layers.11.self_attn.v_proj.weight']), 0)
     converted['clip']['layers.11.attention.in_proj.bias'] = torch.cat((original_model['cond_stage_model.transformer.text_model.encoder.layers.11.self_attn.q_proj.bias'], original_model['cond_stage_model.transformer.text_model.encoder.layers.11.self_attn.k_proj.bias'], original_model['cond_stage_model.transformer.text_model.encoder.layers.11.self_attn.v_proj.bias']), 0)
 
-    return converted
\ No newline at end of file
+    return converted
+
+def save_converted_weights(input_file: str, output_dir: str) -> None:
+    # One-time conversion of the standard checkpoint into one file per submodel (clip.pt, encoder.pt, decoder.pt, diffusion.pt).
+    # The files are loaded with torch.load(mmap=True), see model_loader.load_converted_models
+    converted = load_from_standard_weights(input_file, "cpu")
+    os.makedirs(output_dir, exist_ok=True)
+    for name, state_dict in converted.items():
+        # Many converted tensors are views into the storages of the original checkpoint, and torch.save would write the
+        # whole storage for each of them. Clone them so every file only contains its own tensors.
+        state_dict = {key: value.contiguous().clone() for key, value in state_dict.items()}
+        torch.save(state_dict, os.path.join(output_dir, f"{name}.pt"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", default="./data/v1-5-pruned.ckpt")
+    parser.add_argument("--output-dir", default="./data/converted")
+    args = parser.parse_args()
+
+    save_converted_weights(args.ckpt, args.output_dir)
+    print(f"Saved converted weights to {args.output_dir}")
@@ -1,16 +1,32 @@
+import os
+import torch
+from collections.abc import Mapping
 from clip import CLIP
 from encoder import VAE_Encoder
 from decoder import VAE_Decoder
 from diffusion import Diffusion
+from text_cache import TextEmbeddingCache
 
 import model_converter
 
+MODEL_CLASSES = {
+    'clip': CLIP,
+    'encoder': VAE_Encoder,
+    'decoder': VAE_Decoder,
+    'diffusion': Diffusion,
+}
+
 def load_state_dict_ignore_size_mismatch(model, state_dict):
+    # Returns the names of the parameters that were not loaded and keep their initialization (e.g. the DiffDis layers)
+    unloaded = []
     for name, param in model.named_parameters():
         if name in state_dict and param.size() == state_dict[name].size():
             param.data = state_dict[name].data
+        else:
+            unloaded.append(name)
+    return unloaded
 
-def preload_models_from_standard_weights(ckpt_path, device):
+def preload_models_from_standard_weights(ckpt_path, device, tokenizer=None, warmup_prompts=("",)):
     state_dict = model_converter.load_from_standard_weights(ckpt_path, device)
 
     encoder = VAE_Encoder().to(device)
@@ -21,14 +37,135 @@ def preload_models_from_standard_weights(ckpt_path, device):
 
     diffusion = Diffusion().to(device)
     # diffusion.load_state_dict(state_dict['diffusion'], strict=False)
-    load_state_dict_ignore_size_mismatch(diffusion, state_dict['diffusion'])
+    # The parameters that are not in the SD checkpoint have to be trained, see lora.inject_lora
+    diffusion.unloaded_parameters = load_state_dict_ignore_size_mismatch(diffusion, state_dict['diffusion'])
 
     clip = CLIP().to(device)
     clip.load_state_dict(state_dict['clip'], strict=False)
 
-    return {
+    models = {
         'clip': clip,
         'encoder': encoder,
         'decoder': decoder,
         'diffusion': diffusion,
-    }
\ No newline at end of file
+    }
+
+    if tokenizer is not None:
+        models['text_cache'] = build_text_cache(clip, tokenizer, warmup_prompts)
+
+    return models
+
+def build_text_cache(clip, tokenizer, warmup_prompts=("",), **kwargs):
+    # The empty prompt is the default negative prompt, so it is encoded once at load time
+    text_cache = TextEmbeddingCache(clip, tokenizer, **kwargs)
+    text_cache.warmup(warmup_prompts)
+    return text_cache
+
+def _set_tensor(module, name, tensor, value):
+    # Replaces the parameter or buffer name of module with value, keeping its kind
+    if isinstance(tensor, torch.nn.Parameter):
+        if not isinstance(value, torch.nn.Parameter):
+            value = torch.nn.Parameter(value, requires_grad=tensor.requires_grad)
+        setattr(module, name, value)
+    else:
+        module.register_buffer(name, value, persistent=name not in module._non_persistent_buffers_set)
+
+def _materialize_meta_tensors(model, mismatched=()):
+    """
+        Initializes the tensors that were not loaded from the checkpoint, which are still on the meta device.
+        A layer without any loaded tensor (e.g. the DiffDis layers of the diffusion model, or a layer whose shape changed)
+        gets its default initialization. A layer with some loaded tensors must not have a shape mismatch (mismatched are
+        the keys of the checkpoint with another shape than in the model), and its missing tensors get the default
+        initialization of the layer, the loaded ones are kept.
+    """
+    mismatched = set(mismatched)
+    missing_keys = []
+    for module_name, module in model.named_modules():
+        tensors = list(module.named_parameters(recurse=False)) + list(module.named_buffers(recurse=False))
+        missing = [(name, tensor) for name, tensor in tensors if tensor.is_meta]
+        if not missing:
+            continue
+        prefix = f"{module_name}." if module_name else ""
+        keys = [prefix + name for name, _ in missing]
+        missing_keys.extend(f"{key} (shape mismatch)" if key in mismatched else key for key in keys)
+
+        loaded = [(name, tensor) for name, tensor in tensors if not tensor.is_meta]
+        if loaded and mismatched.intersection(keys):
+            raise ValueError(f"The checkpoint has another shape for {', '.join(sorted(mismatched.intersection(keys)))} "
+                             f"than the model, but the other tensors of {module_name} were loaded")
+
+        # reset_parameters initializes every tensor of the layer, so it runs on placeholders of the loaded tensors
+        # (which may be memory-mapped) and the loaded tensors are put back afterwards
+        for name, tensor in tensors:
+            _set_tensor(module, name, tensor, torch.empty(tensor.shape, dtype=tensor.dtype))
+        if hasattr(module, 'reset_parameters'):
+            module.reset_parameters()
+        else:
+            print(f"{type(module).__name__} has no reset_parameters, {', '.join(keys)} are initialized with zeros")
+            for name, _ in missing:
+                getattr(module, name).data.zero_()
+        for name, tensor in loaded:
+            _set_tensor(module, name, tensor, tensor)
+
+    if missing_keys:
+        print(f"{len(missing_keys)} tensors of {type(model).__name__} were not loaded from the checkpoint and were "
+              f"initialized: {', '.join(missing_keys)}")
+
+def load_converted_model(weights_dir, name, device):
+    # mmap=True maps the file instead of reading it into memory, assign=True makes the model use the mapped tensors
+    # directly instead of copying them into freshly initialized parameters
+    state_dict = torch.load(os.path.join(weights_dir, f"{name}.pt"), map_location="cpu", mmap=True, weights_only=True)
+
+    # Build the model without allocating or initializing its weights
+    with torch.device("meta"):
+        model = MODEL_CLASSES[name]()
+
+    # Same as load_state_dict_ignore_size_mismatch: only the tensors with a matching name and shape are loaded
+    expected = model.state_dict()
+    mismatched = [key for key, value in state_dict.items() if key in expected and expected[key].shape != value.shape]
+    state_dict = {key: value for key, value in state_dict.items() if key in expected and expected[key].shape == value.shape}
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    # Same as preload_models_from_standard_weights: the parameters that still have to be trained
+    model.unloaded_parameters = [name for name, parameter in model.named_parameters() if parameter.is_meta]
+    _materialize_meta_tensors(model, mismatched)
+
+    return model.to(device)
+
+class LazyModels(Mapping):
+    """
+        Drop-in replacement for the dictionary returned by preload_models_from_standard_weights.
+        Each model is only loaded the first time it is accessed, so a process that only uses clip and diffusion
+        never reads the VAE weights.
+    """
+
+    def __init__(self, weights_dir, device, names=None):
+        self.weights_dir = weights_dir
+        self.device = device
+        self.names = tuple(names) if names is not None else tuple(MODEL_CLASSES)
+        self._models = {}
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        if name not in self._models:
+            self._models[name] = load_converted_model(self.weights_dir, name, self.device)
+        return self._models[name]
+
+    def __setitem__(self, name, model):
+        # Allows adding already built objects such as the text cache: models['text_cache'] = build_text_cache(...)
+        self._models[name] = model
+        if name not in self.names:
+            self.names += (name,)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def loaded(self):
+        return tuple(self._models)
+
+def load_converted_models(weights_dir, device, names=None):
+    # Load the files written by model_converter.save_converted_weights
+    return LazyModels(weights_dir, device, names)
@@ -0,0 +1,168 @@
+import torch
+from diffusion import SwitchSequential, UNET
+from residency import _tensor_slots, _set_tensor, model_bytes
+
+# Sequential block offload of the UNET for low-memory inference.
+# The SwitchSequential blocks (encoders, bottleneck and decoders) stay on the offload device and are copied to the compute
+# device just before they run, then released right after. Everything else (time embeddings, output layer) is small and
+# stays on the compute device. On CUDA the next block is copied on a side stream while the current block runs, so the
+# peak footprint is the resident layers plus about two blocks, at the cost of one host to device copy of the UNET weights
+# per step. Only meant for inference: the weights are never copied back to the offload device.
+# The next block is the next one in the order of the step: every block, or only encoders[0] and decoders[-1] when the
+# step reuses the DeepCache features, which the UNET call tells (reuse_deep_cache). Both orders start with encoders[0],
+# which is what the last block of a step prefetches for the next step.
+
+class SequentialOffload:
+
+    def __init__(self, model, device, offload_device="cpu", prefetch=True, pin_memory=True):
+        self.model = model
+        self.device = torch.device(device)
+        self.offload_device = torch.device(offload_device)
+        self.pin_memory = pin_memory and self.device.type == "cuda" and self.offload_device.type == "cpu"
+        # Prefetching overlaps the copy of the next block with the current block, which needs CUDA streams
+        self.stream = torch.cuda.Stream(self.device) if prefetch and self.device.type == "cuda" else None
+
+        # The modules are registered in execution order: encoders, bottleneck, decoders
+        self.blocks = [module for module in model.modules() if isinstance(module, SwitchSequential)]
+        self.block_index = {id(block): i for i, block in enumerate(self.blocks)}
+        self.block_bytes = [model_bytes(block) for block in self.blocks]
+        self.block_slots = [_tensor_slots(block) for block in self.blocks]
+        # Host copies of the tensors of every block, in the order of _tensor_slots
+        self.host_tensors = [
+            [self._to_host(tensors[key]) for _, tensors, key in slots] for slots in self.block_slots
+        ]
+        for slots, host_tensors in zip(self.block_slots, self.host_tensors):
+            for (_, tensors, key), host_tensor in zip(slots, host_tensors):
+                _set_tensor(tensors, key, host_tensor)
+
+        # The layers outside of the blocks stay on the device
+        in_blocks = {id(module) for block in self.blocks for module in block.modules()}
+        self.resident_slots = []
+        for module in model.modules():
+            if id(module) in in_blocks:
+                continue
+            for tensors in (module._parameters, module._buffers):
+                for key, tensor in tensors.items():
+                    if tensor is not None:
+                        _set_tensor(tensors, key, tensor.to(self.device))
+                        self.resident_slots.append((module, tensors, key))
+
+        # block index -> (device tensors, event) of the blocks copied ahead on the side stream
+        self.pending = {}
+        self.loaded = set()
+        self.transfers = 0
+        self.peak_loaded_bytes = 0
+
+        unet = next(module for module in model.modules() if isinstance(module, UNET))
+        self.full_order = list(range(len(self.blocks)))
+        self.reuse_order = [self.block_index[id(unet.encoders[0])], self.block_index[id(unet.decoders[-1])]]
+        # block index -> block index prefetched when it runs, for the order of the current step
+        self.next_block = self._next_blocks(self.full_order)
+
+        self.handles = [unet.register_forward_pre_hook(self._step_hook, with_kwargs=True)]
+        for block in self.blocks:
+            self.handles.append(block.register_forward_pre_hook(self._pre_hook))
+            self.handles.append(block.register_forward_hook(self._post_hook))
+
+    def _to_host(self, tensor):
+        tensor = tensor.detach().to(self.offload_device)
+        if self.pin_memory:
+            tensor = tensor.pin_memory()
+        return tensor
+
+    def _copy_to_device(self, index):
+        return [host_tensor.to(self.device, non_blocking=self.pin_memory) for host_tensor in self.host_tensors[index]]
+
+    def _prefetch(self, index):
+        if index in self.pending or index in self.loaded:
+            return
+        with torch.cuda.stream(self.stream):
+            device_tensors = self._copy_to_device(index)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.pending[index] = (device_tensors, event)
+        self.transfers += 1
+
+    def _load(self, index):
+        if index in self.pending:
+            device_tensors, event = self.pending.pop(index)
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            # The tensors were allocated on the side stream, do not let the allocator reuse them before the block ran
+            for tensor in device_tensors:
+                tensor.record_stream(current_stream)
+        else:
+            device_tensors = self._copy_to_device(index)
+            self.transfers += 1
+
+        for (_, tensors, key), device_tensor in zip(self.block_slots[index], device_tensors):
+            _set_tensor(tensors, key, device_tensor)
+        self.loaded.add(index)
+
+    def _release(self, index):
+        # Point the block back to the host copies, the device copies are freed
+        for (_, tensors, key), host_tensor in zip(self.block_slots[index], self.host_tensors[index]):
+            _set_tensor(tensors, key, host_tensor)
+        self.loaded.discard(index)
+
+    @staticmethod
+    def _next_blocks(order):
+        # The last block of the order prefetches the first block of the next step
+        return {index: order[(i + 1) % len(order)] for i, index in enumerate(order)}
+
+    def _step_hook(self, unet, args, kwargs):
+        # UNET.forward(x, context, time, aug_emb, deep_cache, reuse_deep_cache)
+        reuse = kwargs.get("reuse_deep_cache", args[5] if len(args) > 5 else False)
+        order = self.reuse_order if reuse else self.full_order
+        self.next_block = self._next_blocks(order)
+        # Free the blocks that an interrupted or differently ordered step left on the device
+        for index in list(self.pending):
+            if index != order[0]:
+                del self.pending[index]
+        for index in list(self.loaded):
+            self._release(index)
+
+    def _pre_hook(self, block, args):
+        index = self.block_index[id(block)]
+        self._load(index)
+        if self.stream is not None:
+            self._prefetch(self.next_block[index])
+
+        loaded_bytes = sum(self.block_bytes[i] for i in self.loaded | set(self.pending))
+        self.peak_loaded_bytes = max(self.peak_loaded_bytes, loaded_bytes)
+
+    def _post_hook(self, block, args, output):
+        self._release(self.block_index[id(block)])
+
+    def stats(self):
+        return {
+            "blocks": len(self.blocks),
+            "transfers": self.transfers,
+            "block_bytes": sum(self.block_bytes),
+            "peak_loaded_bytes": self.peak_loaded_bytes,
+        }
+
+    def remove(self):
+        # Remove the hooks, the whole model is left on the offload device
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.pending = {}
+        for index in list(self.loaded):
+            self._release(index)
+        for _, tensors, key in self.resident_slots:
+            _set_tensor(tensors, key, tensors[key].to(self.offload_device))
+        self.model.sequential_offload = None
+
+def enable_sequential_offload(model, device, offload_device="cpu", prefetch=True, pin_memory=True):
+    disable_sequential_offload(model)
+    model.sequential_offload = SequentialOffload(model, device, offload_device, prefetch=prefetch, pin_memory=pin_memory)
+    return model.sequential_offload
+
+def disable_sequential_offload(model):
+    if is_offloaded(model):
+        model.sequential_offload.remove()
+
+def is_offloaded(model):
+    # The pipeline must not move an offloaded model, the offload hooks place its weights
+    return getattr(model, "sequential_offload", None) is not None
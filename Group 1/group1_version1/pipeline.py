@@ -1,13 +1,24 @@
 import torch
 import numpy as np
 from tqdm import tqdm
-from ddpm import DDPMSampler
+from ddpm import randn_tensor
+from samplers import get_sampler
+from attention import set_kv_cache
+from vae_tiling import tiled_encode, tiled_decode
+from offload import is_offloaded
+from latent_preview import LatentRGBProjection
+from collections import namedtuple
 import torch.nn.functional as F
 
 WIDTH = 512
 HEIGHT = 512
 LATENTS_WIDTH = WIDTH // 8
 LATENTS_HEIGHT = HEIGHT // 8
+# Images with more pixels than this go through the VAE in overlapping tiles, see vae_tiling.py
+VAE_TILING_THRESHOLD = 768 * 768
+
+# Yielded by generate_batch_stream: a preview after step of num_steps, or the final images
+GenerationUpdate = namedtuple("GenerationUpdate", ["step", "num_steps", "images", "final"])
 
 def generate(
     prompt,
@@ -23,98 +34,274 @@ def generate(
     device=None,
     idle_device=None,
     tokenizer=None,
+    width=WIDTH,
+    height=HEIGHT,
+    residency=None,
+    deep_cache_interval=None,
+    mask=None,
+):
+    images = generate_batch(
+        prompts=[prompt],
+        uncond_prompts=[uncond_prompt] if uncond_prompt is not None else None,
+        input_images=[input_image] if input_image is not None else None,
+        strength=strength,
+        masks=[mask] if mask is not None else None,
+        do_cfg=do_cfg,
+        cfg_scale=cfg_scale,
+        sampler_name=sampler_name,
+        n_inference_steps=n_inference_steps,
+        models=models,
+        seeds=[seed],
+        device=device,
+        idle_device=idle_device,
+        tokenizer=tokenizer,
+        width=width,
+        height=height,
+        residency=residency,
+        deep_cache_interval=deep_cache_interval,
+    )
+    return images[0]
+
+def generate_stream(prompt, uncond_prompt=None, input_image=None, mask=None, seed=None, preview_interval=5, **kwargs):
+    # Single prompt version of generate_batch_stream, the images of the updates are (Height, Width, Channel)
+    updates = generate_batch_stream(
+        prompts=[prompt],
+        uncond_prompts=[uncond_prompt] if uncond_prompt is not None else None,
+        input_images=[input_image] if input_image is not None else None,
+        masks=[mask] if mask is not None else None,
+        seeds=[seed],
+        preview_interval=preview_interval,
+        **kwargs,
+    )
+    for update in updates:
+        yield update._replace(images=update.images[0])
+
+def generate_batch(
+    prompts,
+    uncond_prompts=None,
+    input_images=None,
+    strength=0.8,
+    do_cfg=True,
+    cfg_scale=7.5,
+    sampler_name="ddpm",
+    n_inference_steps=50,
+    models={},
+    seeds=None,
+    device=None,
+    idle_device=None,
+    tokenizer=None,
+    use_kv_cache=True,
+    width=WIDTH,
+    height=HEIGHT,
+    vae_tiling_threshold=VAE_TILING_THRESHOLD,
+    residency=None,
+    deep_cache_interval=None,
+    masks=None,
+):
+    # Runs generate_batch_stream without previews and returns the final images, a uint8 array of shape
+    # (Batch_Size, Height, Width, Channel)
+    updates = generate_batch_stream(
+        prompts,
+        uncond_prompts=uncond_prompts,
+        input_images=input_images,
+        strength=strength,
+        do_cfg=do_cfg,
+        cfg_scale=cfg_scale,
+        sampler_name=sampler_name,
+        n_inference_steps=n_inference_steps,
+        models=models,
+        seeds=seeds,
+        device=device,
+        idle_device=idle_device,
+        tokenizer=tokenizer,
+        use_kv_cache=use_kv_cache,
+        width=width,
+        height=height,
+        vae_tiling_threshold=vae_tiling_threshold,
+        residency=residency,
+        deep_cache_interval=deep_cache_interval,
+        masks=masks,
+    )
+    for update in updates:
+        pass
+    return update.images
+
+@torch.no_grad()
+def generate_batch_stream(
+    prompts,
+    uncond_prompts=None,
+    input_images=None,
+    strength=0.8,
+    do_cfg=True,
+    cfg_scale=7.5,
+    sampler_name="ddpm",
+    n_inference_steps=50,
+    models={},
+    seeds=None,
+    device=None,
+    idle_device=None,
+    tokenizer=None,
+    use_kv_cache=True,
+    width=WIDTH,
+    height=HEIGHT,
+    vae_tiling_threshold=VAE_TILING_THRESHOLD,
+    residency=None,
+    deep_cache_interval=None,
+    masks=None,
+    preview_interval=None,
+    previewer=None,
 ):
-    with torch.no_grad():
-        if not 0 < strength <= 1:
-            raise ValueError("strength must be between 0 and 1")
+    """
+        Generate one image per prompt with a single batched denoising loop.
+        Every sample gets its own generator, so an image generated in a batch with a given seed
+        uses the same noise as the image generated on its own with that seed.
+        With use_kv_cache the keys and values of the cross-attention layers are projected from the context once
+        and reused for all the denoising steps.
+        Images with more than vae_tiling_threshold pixels are encoded and decoded in tiles to bound the VAE memory.
+        With a residency.ResidencyManager the models stay on the device between calls instead of being moved
+        to idle_device after use.
+        With deep_cache_interval=N the UNET is fully computed every N steps, the steps in between reuse its cached
+        deep features and only compute the shallow encoders[0] / decoders[-1] path.
+        For img2img, input_images are encoded in one VAE batch and strength is a float or one strength per sample:
+        the samples with a lower strength join the denoising loop at a later step.
+        With masks (one per input image, 1 where the image is repainted, see preprocess_masks) the latents outside of
+        the mask are replaced with the noised input image latents after every step (latent-space inpainting).
+        Yields GenerationUpdate(step, num_steps, images, final). With preview_interval=k, every k steps the images are
+        previews of the current latents projected to RGB by previewer (a latent_preview.LatentRGBProjection,
+        the default factors if None), uint8 arrays of shape (Batch_Size, Height / 8, Width / 8, Channel).
+        The last update (final=True) holds the decoded images, a uint8 array of shape (Batch_Size, Height, Width, Channel).
+    """
+    strengths = [strength] * len(prompts) if isinstance(strength, (int, float)) else list(strength)
+    if len(strengths) != len(prompts):
+        raise ValueError("prompts and strength must have the same length")
+    if not all(0 < s <= 1 for s in strengths):
+        raise ValueError("strength must be between 0 and 1")
+    if width % 8 != 0 or height % 8 != 0:
+        raise ValueError("width and height must be multiples of 8")
+
+    batch_size = len(prompts)
 
+    if uncond_prompts is None:
+        uncond_prompts = [""] * batch_size
+    if seeds is None:
+        seeds = [None] * batch_size
+    if len(uncond_prompts) != batch_size or len(seeds) != batch_size:
+        raise ValueError("prompts, uncond_prompts and seeds must have the same length")
+    if input_images is not None and len(input_images) != batch_size:
+        raise ValueError("prompts and input_images must have the same length")
+    if masks is not None and (input_images is None or len(masks) != batch_size):
+        raise ValueError("masks need one input image per mask")
+
+    if residency is not None:
+        # The residency manager decides which models stay on the device
+        load = lambda name: residency.acquire(name, models[name])
+        to_idle = lambda x: x
+    else:
+        load = lambda name: models[name].to(device)
         if idle_device:
-            to_idle = lambda x: x.to(idle_device)
+            to_idle = lambda x: x if is_offloaded(x) else x.to(idle_device)
         else:
             to_idle = lambda x: x
+    # The weights of a model with sequential offload are placed block by block, see offload.py
+    to_device = lambda name: models[name] if is_offloaded(models[name]) else load(name)
 
-        # Initialize random number generator according to the seed specified
+    # Initialize one random number generator per sample according to the seeds specified
+    generators = []
+    for seed in seeds:
         generator = torch.Generator(device=device)
         if seed is None:
             generator.seed()
         else:
             generator.manual_seed(seed)
+        generators.append(generator)
 
-        clip = models["clip"]
-        clip.to(device)
-        
-        if do_cfg:
-            # Convert into a list of length Seq_Len=77
-            cond_tokens = tokenizer.batch_encode_plus(
-                [prompt], padding="max_length", max_length=77
-            ).input_ids
-            # (Batch_Size, Seq_Len)
-            cond_tokens = torch.tensor(cond_tokens, dtype=torch.long, device=device)
-            # (Batch_Size, Seq_Len) -> (Batch_Size, Seq_Len, Dim)
-            cond_context = clip(cond_tokens)
-            # Convert into a list of length Seq_Len=77
-            uncond_tokens = tokenizer.batch_encode_plus(
-                [uncond_prompt], padding="max_length", max_length=77
-            ).input_ids
-            # (Batch_Size, Seq_Len)
-            uncond_tokens = torch.tensor(uncond_tokens, dtype=torch.long, device=device)
-            # (Batch_Size, Seq_Len) -> (Batch_Size, Seq_Len, Dim)
-            uncond_context = clip(uncond_tokens)
-            # (Batch_Size, Seq_Len, Dim) + (Batch_Size, Seq_Len, Dim) -> (2 * Batch_Size, Seq_Len, Dim)
-            context = torch.cat([cond_context, uncond_context])
-        else:
-            # Convert into a list of length Seq_Len=77
-            tokens = tokenizer.batch_encode_plus(
-                [prompt], padding="max_length", max_length=77
-            ).input_ids
-            # (Batch_Size, Seq_Len)
-            tokens = torch.tensor(tokens, dtype=torch.long, device=device)
-            # (Batch_Size, Seq_Len) -> (Batch_Size, Seq_Len, Dim)
-            context = clip(tokens)
-        to_idle(clip)
-
-        if sampler_name == "ddpm":
-            sampler = DDPMSampler(generator)
-            sampler.set_inference_timesteps(n_inference_steps)
-        else:
-            raise ValueError("Unknown sampler value %s. ")
-
-        latents_shape = (1, 4, LATENTS_HEIGHT, LATENTS_WIDTH)
-
-        if input_image:
-            encoder = models["encoder"]
-            encoder.to(device)
-
-            input_image_tensor = input_image.resize((WIDTH, HEIGHT))
-            # (Height, Width, Channel)
-            input_image_tensor = np.array(input_image_tensor)
-            # (Height, Width, Channel) -> (Height, Width, Channel)
-            input_image_tensor = torch.tensor(input_image_tensor, dtype=torch.float32, device=device)
-            # (Height, Width, Channel) -> (Height, Width, Channel)
-            input_image_tensor = rescale(input_image_tensor, (0, 255), (-1, 1))
-            # (Height, Width, Channel) -> (Batch_Size, Height, Width, Channel)
-            input_image_tensor = input_image_tensor.unsqueeze(0)
-            # (Batch_Size, Height, Width, Channel) -> (Batch_Size, Channel, Height, Width)
-            input_image_tensor = input_image_tensor.permute(0, 3, 1, 2)
+    clip = to_device("clip")
 
-            # (Batch_Size, 4, Latents_Height, Latents_Width)
-            encoder_noise = torch.randn(latents_shape, generator=generator, device=device)
-            # (Batch_Size, 4, Latents_Height, Latents_Width)
-            latents = encoder(input_image_tensor, encoder_noise)
+    # Cached CLIP embeddings of previously seen prompts, see model_loader.build_text_cache
+    text_cache = models.get("text_cache")
 
-            # Add noise to the latents (the encoded input image)
-            # (Batch_Size, 4, Latents_Height, Latents_Width)
-            sampler.set_strength(strength=strength)
-            latents = sampler.add_noise(latents, sampler.timesteps[0])
+    if text_cache is not None:
+        # (Batch_Size, Seq_Len, Dim) or (2 * Batch_Size, Seq_Len, Dim) when using classifier-free guidance
+        context = text_cache.encode(list(prompts) + list(uncond_prompts) if do_cfg else prompts, device=device)
+    elif do_cfg:
+        # Convert into a list of length Seq_Len=77
+        cond_tokens = tokenizer.batch_encode_plus(
+            list(prompts), padding="max_length", max_length=77
+        ).input_ids
+        # (Batch_Size, Seq_Len)
+        cond_tokens = torch.tensor(cond_tokens, dtype=torch.long, device=device)
+        # Convert into a list of length Seq_Len=77
+        uncond_tokens = tokenizer.batch_encode_plus(
+            list(uncond_prompts), padding="max_length", max_length=77
+        ).input_ids
+        # (Batch_Size, Seq_Len)
+        uncond_tokens = torch.tensor(uncond_tokens, dtype=torch.long, device=device)
+        # Encode the conditional and unconditional prompts in one forward pass
+        # (Batch_Size, Seq_Len) + (Batch_Size, Seq_Len) -> (2 * Batch_Size, Seq_Len) -> (2 * Batch_Size, Seq_Len, Dim)
+        context = clip(torch.cat([cond_tokens, uncond_tokens]))
+    else:
+        # Convert into a list of length Seq_Len=77
+        tokens = tokenizer.batch_encode_plus(
+            list(prompts), padding="max_length", max_length=77
+        ).input_ids
+        # (Batch_Size, Seq_Len)
+        tokens = torch.tensor(tokens, dtype=torch.long, device=device)
+        # (Batch_Size, Seq_Len) -> (Batch_Size, Seq_Len, Dim)
+        context = clip(tokens)
+    to_idle(clip)
+
+    # "ddpm", "ddim", "dpm++2m" or "euler_a", see samplers.py
+    sampler = get_sampler(sampler_name, generators, n_inference_steps)
+
+    latents_shape = (batch_size, 4, height // 8, width // 8)
+    use_vae_tiling = vae_tiling_threshold is not None and width * height > vae_tiling_threshold
+
+    # Index of the first denoising step of every sample (img2img with different strengths)
+    start_steps = None
+    # (Batch_Size, 1, Latents_Height, Latents_Width), 1 where the latents are denoised
+    masks_tensor = None
+
+    if input_images is not None:
+        encoder = to_device("encoder")
+
+        # (Batch_Size, Channel, Height, Width)
+        input_images_tensor = preprocess_images(input_images, width, height, device)
 
-            to_idle(encoder)
+        # (Batch_Size, 4, Latents_Height, Latents_Width)
+        encoder_noise = randn_tensor(latents_shape, generators, device=device)
+        # (Batch_Size, 4, Latents_Height, Latents_Width)
+        if use_vae_tiling:
+            init_latents = tiled_encode(encoder, input_images_tensor, encoder_noise)
         else:
-            # (Batch_Size, 4, Latents_Height, Latents_Width)
-            latents = torch.randn(latents_shape, generator=generator, device=device)
+            init_latents = encoder(input_images_tensor, encoder_noise)
+
+        # Add noise to the latents (the encoded input images), every sample up to the noise level of its first step
+        # (Batch_Size, 4, Latents_Height, Latents_Width)
+        start_steps = sampler.set_strengths(strengths)
+        latents, _ = sampler.add_noise(init_latents, sampler.timesteps[start_steps])
+
+        if masks is not None:
+            masks_tensor = preprocess_masks(masks, height // 8, width // 8, device)
+
+        to_idle(encoder)
+    else:
+        # (Batch_Size, 4, Latents_Height, Latents_Width)
+        latents = randn_tensor(latents_shape, generators, device=device)
+
+    # The samples with a lower strength wait until their first step
+    staggered = start_steps is not None and bool(start_steps.max() > 0)
+
+    diffusion = to_device("diffusion")
+    set_kv_cache(diffusion, use_kv_cache)
 
-        diffusion = models["diffusion"]
-        diffusion.to(device)
+    # Deep features of the last full UNET pass, see UNET.forward
+    deep_cache = {} if deep_cache_interval and deep_cache_interval > 1 else None
 
+    num_steps = len(sampler.timesteps)
+    if preview_interval and previewer is None:
+        previewer = LatentRGBProjection()
+
+    try:
         timesteps = tqdm(sampler.timesteps)
         for i, timestep in enumerate(timesteps):
             # (1, 320)
@@ -134,29 +321,143 @@ def generate(
 
             # model_output is the predicted noise
             # (Batch_Size, 4, Latents_Height, Latents_Width) -> (Batch_Size, 4, Latents_Height, Latents_Width)
-            model_output, text_output = diffusion(model_input, context, time_embedding, text_time_embeddings, text_query)
+            if deep_cache is not None:
+                reuse_deep_cache = i % deep_cache_interval != 0
+                model_output, text_output = diffusion(
+                    model_input, context, time_embedding, text_time_embeddings, text_query,
+                    deep_cache=deep_cache, reuse_deep_cache=reuse_deep_cache,
+                )
+            else:
+                model_output, text_output = diffusion(model_input, context, time_embedding, text_time_embeddings, text_query)
 
             if do_cfg:
                 output_cond, output_uncond = model_output.chunk(2)
                 model_output = cfg_scale * (output_cond - output_uncond) + output_uncond
 
+            if staggered:
+                # The samples that join at this step have no previous step
+                sampler.reset_state(start_steps == i)
+
             # (Batch_Size, 4, Latents_Height, Latents_Width) -> (Batch_Size, 4, Latents_Height, Latents_Width)
-            latents = sampler.step(timestep, latents, model_output)
+            new_latents = sampler.step(timestep, latents, model_output)
+
+            if masks_tensor is not None:
+                # Outside of the mask, keep the input image at the noise level of the next step
+                if i + 1 < len(sampler.timesteps):
+                    known_latents, _ = sampler.add_noise(init_latents, sampler.timesteps[i + 1])
+                else:
+                    known_latents = init_latents
+                new_latents = masks_tensor * new_latents + (1 - masks_tensor) * known_latents
+
+            if staggered:
+                # (Batch_Size,) -> (Batch_Size, 1, 1, 1)
+                active = (start_steps <= i).to(device).view(-1, 1, 1, 1)
+                latents = torch.where(active, new_latents, latents)
+            else:
+                latents = new_latents
 
+            if preview_interval and (i + 1) % preview_interval == 0 and i + 1 < num_steps:
+                # (Batch_Size, Latents_Height, Latents_Width, 3)
+                yield GenerationUpdate(i + 1, num_steps, previewer.to_images(latents), False)
+    finally:
+        # Release the cached keys and values, also when the caller stops early
+        set_kv_cache(diffusion, False)
         to_idle(diffusion)
 
-        decoder = models["decoder"]
-        decoder.to(device)
-        # (Batch_Size, 4, Latents_Height, Latents_Width) -> (Batch_Size, 3, Height, Width)
+    decoder = to_device("decoder")
+    # (Batch_Size, 4, Latents_Height, Latents_Width) -> (Batch_Size, 3, Height, Width)
+    if use_vae_tiling:
+        images = tiled_decode(decoder, latents)
+    else:
         images = decoder(latents)
-        to_idle(decoder)
+    to_idle(decoder)
 
-        images = rescale(images, (-1, 1), (0, 255), clamp=True)
-        # (Batch_Size, Channel, Height, Width) -> (Batch_Size, Height, Width, Channel)
-        images = images.permute(0, 2, 3, 1)
-        images = images.to("cpu", torch.uint8).numpy()
-        return images[0]
+    images = rescale(images, (-1, 1), (0, 255), clamp=True)
+    # (Batch_Size, Channel, Height, Width) -> (Batch_Size, Height, Width, Channel)
+    images = images.permute(0, 2, 3, 1)
+    images = images.to("cpu", torch.uint8).numpy()
+    yield GenerationUpdate(num_steps, num_steps, images, True)
     
+def img2img(prompts, input_images, strengths=0.8, masks=None, **kwargs):
+    # Batched img2img / inpainting, see generate_batch
+    return generate_batch(prompts, input_images=input_images, strength=strengths, masks=masks, **kwargs)
+
+def _to_array(image):
+    # PIL image, numpy array or tensor -> numpy array
+    return image.cpu().numpy() if isinstance(image, torch.Tensor) else np.asarray(image)
+
+def _resize_by_size(arrays, size, mode, device):
+    # Stacks the arrays of the same size and resizes every stack with one interpolate call, keeps the order of the arrays
+    # arrays: list of (Height, Width, Channel) -> (Batch_Size, Channel, size[0], size[1])
+    groups = {}
+    for index, array in enumerate(arrays):
+        groups.setdefault(array.shape, []).append(index)
+
+    output = None
+    for shape, indices in groups.items():
+        # (N, Height, Width, Channel) -> (N, Channel, Height, Width)
+        x = torch.from_numpy(np.stack([arrays[index] for index in indices])).to(device)
+        x = x.permute(0, 3, 1, 2).float()
+        if tuple(shape[:2]) != tuple(size):
+            if mode == "area":
+                x = F.interpolate(x, size=size, mode="area")
+            else:
+                x = F.interpolate(x, size=size, mode=mode, align_corners=False, antialias=True)
+        if output is None:
+            output = torch.empty((len(arrays), x.shape[1], *size), device=device)
+        output[indices] = x
+    return output
+
+def preprocess_images(images, width, height, device=None):
+    """
+        Input images for img2img as one tensor: a list of PIL images or (Height, Width, Channel) uint8 arrays of any size,
+        or a uint8 array / tensor of shape (Batch_Size, Height, Width, Channel).
+        Returns (Batch_Size, 3, height, width) in [-1, 1].
+    """
+    if isinstance(images, np.ndarray) and images.ndim == 4:
+        images = torch.from_numpy(images)
+    if isinstance(images, torch.Tensor) and images.dim() == 4:
+        # (Batch_Size, Height, Width, Channel) -> (Batch_Size, Channel, Height, Width)
+        x = images[..., :3].to(device).permute(0, 3, 1, 2).float()
+        if x.shape[-2:] != (height, width):
+            x = F.interpolate(x, size=(height, width), mode="bicubic", align_corners=False, antialias=True)
+    else:
+        arrays = []
+        for image in images:
+            if hasattr(image, "convert"):
+                image = image.convert("RGB")
+            array = _to_array(image)
+            if array.ndim == 2:
+                # Grayscale
+                array = np.repeat(array[..., None], 3, axis=-1)
+            arrays.append(np.ascontiguousarray(array[..., :3]))
+        x = _resize_by_size(arrays, (height, width), "bicubic", device)
+
+    # Bicubic overshoots, clamp before mapping to [-1, 1]
+    return rescale(x.clamp_(0, 255), (0, 255), (-1, 1))
+
+def preprocess_masks(masks, latents_height, latents_width, device=None):
+    """
+        Inpainting masks as one tensor in latent space: a list of PIL "L" images, uint8 arrays in [0, 255] or
+        float arrays / tensors in [0, 1] of shape (Height, Width), 1 (white) where the image is repainted.
+        None keeps the whole image of that sample repainted (plain img2img).
+        Returns (Batch_Size, 1, latents_height, latents_width) in [0, 1].
+    """
+    arrays = []
+    for mask in masks:
+        if mask is None:
+            array = np.ones((latents_height, latents_width), dtype=np.float32)
+        else:
+            if hasattr(mask, "convert"):
+                mask = mask.convert("L")
+            array = _to_array(mask)
+            if array.ndim == 3:
+                array = array[..., 0]
+            array = array.astype(np.float32) / 255 if array.dtype == np.uint8 else array.astype(np.float32)
+        arrays.append(array[..., None])
+    # Area averaging keeps the soft edges of the mask at the lower resolution
+    return _resize_by_size(arrays, (latents_height, latents_width), "area", device).clamp_(0, 1)
+
 def rescale(x, old_range, new_range, clamp=False):
     old_min, old_max = old_range
     new_min, new_max = new_range
@@ -0,0 +1,152 @@
+import os
+import json
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+from encoder import sample_latents
+
+# The VAE encoder and the CLIP text encoder are frozen during training, so their outputs only depend on the dataset.
+# precompute() runs them once over the dataset and writes the results to sharded .npy files:
+#   shard-XXXXX-mean.npy                  (Shard_Size, 4, Height / 8, Width / 8)
+#   shard-XXXXX-log_variance.npy          (Shard_Size, 4, Height / 8, Width / 8)
+#   shard-XXXXX-encoder_hidden_states.npy (Shard_Size, Seq_Len, Dim)
+# and an index.json with the number of valid samples in every shard.
+# PrecomputedDataset memory-maps the shards, so reading a sample does not copy it out of the page cache.
+
+FIELDS = ("mean", "log_variance", "encoder_hidden_states")
+
+def _shard_path(data_dir, shard, field):
+    return os.path.join(data_dir, "shard-%05d-%s.npy" % (shard, field))
+
+def precompute(dataloader, vae, text_encoder, data_dir, shard_size=4096, device="cpu", dtype=np.float16):
+    os.makedirs(data_dir, exist_ok=True)
+
+    vae.to(device).eval()
+    text_encoder.to(device).eval()
+
+    shards = []
+    arrays = None
+    sample_shapes = None
+    count = 0
+
+    with torch.no_grad():
+        for batch in tqdm(dataloader, desc="Precompute"):
+            pixel_values = batch["pixel_values"].to(device)
+            input_ids = batch["input_ids"].to(device)
+
+            # (Batch_Size, Channel, Height, Width) -> two tensors of shape (Batch_Size, 4, Height / 8, Width / 8)
+            mean, log_variance = vae.encode_moments(pixel_values)
+            # (Batch_Size, Seq_Len) -> (Batch_Size, Seq_Len, Dim)
+            encoder_hidden_states = text_encoder(input_ids)
+
+            outputs = {
+                "mean": mean.cpu().numpy(),
+                "log_variance": log_variance.cpu().numpy(),
+                "encoder_hidden_states": encoder_hidden_states.cpu().numpy(),
+            }
+
+            # The shards hold samples of a single shape, which is the shape of the first batch
+            shapes = {field: outputs[field].shape[1:] for field in FIELDS}
+            if sample_shapes is None:
+                sample_shapes = shapes
+            elif shapes != sample_shapes:
+                raise ValueError(f"Precomputed samples must all have the same shape, got {shapes['mean']} after "
+                                 f"{sample_shapes['mean']} (aspect ratio buckets are not supported)")
+
+            start = 0
+            batch_size = pixel_values.shape[0]
+            while start < batch_size:
+                if arrays is None:
+                    # Open the next shard, the files are allocated up front and filled batch by batch
+                    arrays = {
+                        field: np.lib.format.open_memmap(
+                            _shard_path(data_dir, len(shards), field), mode="w+", dtype=dtype,
+                            shape=(shard_size, *outputs[field].shape[1:]),
+                        )
+                        for field in FIELDS
+                    }
+                    count = 0
+
+                n = min(batch_size - start, shard_size - count)
+                for field in FIELDS:
+                    arrays[field][count:count + n] = outputs[field][start:start + n]
+                count += n
+                start += n
+
+                if count == shard_size:
+                    for array in arrays.values():
+                        array.flush()
+                    shards.append(count)
+                    arrays = None
+
+    if arrays is not None:
+        # The last shard keeps its allocated size, only its first `count` samples are valid
+        for array in arrays.values():
+            array.flush()
+        shards.append(count)
+
+    with open(os.path.join(data_dir, "index.json"), "w") as f:
+        json.dump({"fields": list(FIELDS), "shards": shards}, f)
+
+    return sum(shards)
+
+class PrecomputedDataset(Dataset):
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        with open(os.path.join(data_dir, "index.json")) as f:
+            self.shard_sizes = json.load(f)["shards"]
+        self.offsets = np.cumsum([0] + self.shard_sizes)
+        # The shards are opened lazily, so that every DataLoader worker maps them itself
+        self._shards = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            # Copy-on-write mapping: the arrays are writable for torch.from_numpy, but the files are never modified
+            self._shards[shard] = {field: np.load(_shard_path(self.data_dir, shard, field), mmap_mode="c") for field in FIELDS}
+        return self._shards[shard]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        shard = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        arrays = self._shard(shard)
+        local_idx = idx - int(self.offsets[shard])
+        return {field: torch.from_numpy(arrays[field][local_idx]) for field in FIELDS}
+
+    def __getstate__(self):
+        # Do not send the mapped arrays to the worker processes
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+def sample_batch_latents(batch, device, dtype=torch.float32):
+    # Sample the VAE latents of a precomputed batch, with fresh noise every time the sample is seen
+    mean = batch["mean"].to(device, dtype)
+    log_variance = batch["log_variance"].to(device, dtype)
+    noise = torch.randn_like(mean)
+    # (Batch_Size, 4, Latents_Height, Latents_Width)
+    return sample_latents(mean, log_variance, noise)
+
+if __name__ == "__main__":
+    import model_loader
+    from dataloader import train_dataloader
+    from config import precomputed_dir, aspect_ratio_buckets
+
+    if aspect_ratio_buckets:
+        raise ValueError("precompute does not support aspect_ratio_buckets, the precomputed latents have a single shape")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", default="./data/v1-5-pruned.ckpt")
+    parser.add_argument("--data-dir", default=precomputed_dir or "precomputed")
+    parser.add_argument("--shard-size", type=int, default=4096)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    models = model_loader.preload_models_from_standard_weights(args.ckpt, args.device)
+    num_samples = precompute(train_dataloader, models["encoder"], models["clip"], args.data_dir, shard_size=args.shard_size, device=args.device)
+    print(f"Precomputed {num_samples} samples to {args.data_dir}")
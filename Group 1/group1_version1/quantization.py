@@ -0,0 +1,143 @@
+import argparse
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+# int8 inference mode for CPU.
+# The linear layers (CLIPLayer, the SelfAttention/CrossAttention projections, the GEGLU linears of UNET_AttentionBlock)
+# are quantized dynamically: the weights are stored in int8 and the activations are quantized on the fly,
+# so the matrix multiplications run in int8 and no calibration data is needed.
+# The convolutions can optionally store their weights in int8 (per output channel), which cuts their memory by 4x
+# but still computes in floating point.
+# The quantized models only run on CPU.
+
+class Int8WeightConv2d(nn.Module):
+    # Weight-only int8 Conv2d: the weights are dequantized right before the convolution
+
+    def __init__(self, conv: nn.Conv2d):
+        super().__init__()
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+
+        weight = conv.weight.detach().float()
+        # Symmetric per output channel quantization: (Out_Channels, 1, 1, 1)
+        scale = weight.abs().amax(dim=(1, 2, 3), keepdim=True).clamp(min=1e-8) / 127
+        self.register_buffer("weight_int8", torch.round(weight / scale).clamp(-127, 127).to(torch.int8))
+        self.register_buffer("weight_scale", scale.to(conv.weight.dtype))
+        self.bias = None if conv.bias is None else nn.Parameter(conv.bias.detach(), requires_grad=False)
+
+    def forward(self, x):
+        weight = self.weight_int8.to(x.dtype) * self.weight_scale.to(x.dtype)
+        return F.conv2d(x, weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+
+def quantize_linear_dynamic(model):
+    # Replace every nn.Linear of the model (in place) with a dynamically quantized int8 linear
+    from torch.ao.quantization import quantize_dynamic
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def quantize_conv_weights(model):
+    # Replace every nn.Conv2d of the model (in place) with Int8WeightConv2d
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Conv2d) and child.padding_mode == "zeros":
+                setattr(module, name, Int8WeightConv2d(child))
+    return model
+
+def quantize_for_cpu_inference(models, names=("clip", "diffusion"), quantize_convs=False):
+    """
+        Quantize the given models of a models dict (see model_loader) in place for int8 CPU inference.
+        The models are moved to the CPU and set to eval mode first.
+    """
+    for name in names:
+        model = models[name].to("cpu", torch.float32).eval()
+        quantize_linear_dynamic(model)
+        if quantize_convs:
+            quantize_conv_weights(model)
+    return models
+
+def state_dict_bytes(model):
+    # Size of the weights, including the packed int8 weights of the quantized linears which are not parameters
+    def nbytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(nbytes(v) for v in value)
+        return 0
+    return sum(nbytes(value) for value in model.state_dict().values())
+
+def compare_outputs(reference, output):
+    # Accuracy of the quantized output against the fp32 reference
+    reference = reference.float().flatten()
+    output = output.float().flatten()
+    error = (output - reference).abs()
+    return {
+        "max_abs_error": error.max().item(),
+        "mean_abs_error": error.mean().item(),
+        "relative_error": (error.norm() / reference.norm().clamp(min=1e-12)).item(),
+        "cosine_similarity": F.cosine_similarity(output, reference, dim=0).item(),
+    }
+
+if __name__ == "__main__":
+    from pipeline import get_time_embedding
+    from benchmark import build_models, time_call, summarize, write_results, git_commit
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--components", nargs="+", default=["clip", "diffusion"], choices=["clip", "diffusion"])
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--quantize-convs", action="store_true")
+    parser.add_argument("--weights-dir", default=None, help="Converted weights (see model_converter.py), random weights if not set")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    tokens = torch.randint(0, 49408, (args.batch_size, 77))
+    latents = torch.randn((args.batch_size, 4, args.height // 8, args.width // 8))
+    context = torch.randn((args.batch_size, 77, 768))
+    time_embedding = get_time_embedding(torch.tensor(500))
+    text_time_embeddings = torch.zeros((1, 192))
+    text_query = F.normalize(context.mean(dim=1), p=2, dim=-1)
+
+    inputs = {
+        "clip": lambda model: model(tokens),
+        "diffusion": lambda model: model(latents, context, time_embedding, text_time_embeddings, text_query)[0],
+    }
+
+    results = {}
+    for name in args.components:
+        # One model at a time, the UNET is quantized in place to keep a single copy in memory
+        if args.weights_dir:
+            from model_loader import load_converted_model
+            model = load_converted_model(args.weights_dir, name, "cpu").eval()
+        else:
+            model = build_models([name], "cpu", torch.float32)[name]
+
+        result = {}
+        with torch.no_grad():
+            for precision in ("fp32", "int8"):
+                if precision == "int8":
+                    quantize_for_cpu_inference({name: model}, names=[name], quantize_convs=args.quantize_convs)
+                # Warmup
+                output = inputs[name](model)
+                times = []
+                for _ in range(args.repeats):
+                    output, elapsed = time_call(lambda: inputs[name](model), "cpu")
+                    times.append(elapsed)
+                result[precision] = summarize(times)
+                result[precision]["weight_bytes"] = state_dict_bytes(model)
+                if precision == "fp32":
+                    reference = output
+
+        result["accuracy"] = compare_outputs(reference, output)
+        result["speedup"] = result["fp32"]["p50_ms"] / result["int8"]["p50_ms"]
+        results[name] = result
+        del model
+
+    results["config"] = vars(args)
+    results["torch"] = torch.__version__
+    results["commit"] = git_commit()
+    write_results(results, args.output)
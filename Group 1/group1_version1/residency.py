@@ -0,0 +1,134 @@
+from collections import OrderedDict
+import torch
+
+# Keeps the pipeline models on the device across generate calls.
+# A model is moved to the device the first time it is used and stays there while the total size of the resident models
+# fits in the memory budget. When a model does not fit, the least recently used models are evicted to the idle device.
+# The weights are not modified during inference, so every model keeps a host copy of its tensors (in pinned memory
+# when the device is a GPU): evicting a model only points its parameters back to the host copy, and loading it again
+# is a single non-blocking copy from pinned memory.
+
+def _tensor_slots(model):
+    # (module, dict, key) of every parameter and buffer of the model
+    slots = []
+    for module in model.modules():
+        for tensors in (module._parameters, module._buffers):
+            for key, tensor in tensors.items():
+                if tensor is not None:
+                    slots.append((module, tensors, key))
+    return slots
+
+def _set_tensor(tensors, key, value):
+    # Same as nn.Module._apply: keep the Parameter object when the tensor types allow it
+    tensor = tensors[key]
+    if not isinstance(tensor, torch.nn.Parameter):
+        tensors[key] = value
+    elif torch._has_compatible_shallow_copy_type(tensor, value):
+        tensor.data = value
+    else:
+        tensors[key] = torch.nn.Parameter(value, requires_grad=tensor.requires_grad)
+
+def _resolve_device(device):
+    # Tensors on "cuda" are on a numbered device ("cuda:0"), the device of the manager is compared with theirs
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return device
+
+def model_bytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+class ResidencyManager:
+
+    def __init__(self, device, budget_bytes=None, idle_device="cpu", pin_memory=True):
+        # budget_bytes=None keeps every model resident once it has been loaded
+        self.device = _resolve_device(device)
+        self.idle_device = _resolve_device(idle_device)
+        self.budget_bytes = budget_bytes
+        self.pin_memory = pin_memory and self.device.type == "cuda" and self.idle_device.type == "cpu"
+
+        # name -> model, ordered from the least to the most recently used resident model
+        self.resident = OrderedDict()
+        self.sizes = {}
+        self.models = {}
+        # name -> host copies of the tensors of the model, in the order of _tensor_slots
+        self.host_tensors = {}
+
+        self.transfers = 0
+        self.evictions = 0
+        self.bytes_transferred = 0
+
+    def resident_bytes(self):
+        return sum(self.sizes[name] for name in self.resident)
+
+    def acquire(self, name, model):
+        """
+            Return the model on the device, loading it (and evicting other models if needed) if it is not resident.
+        """
+        if self.models.get(name) is not model:
+            # A new model, or a different model registered under the same name
+            if name in self.resident:
+                del self.resident[name]
+            self.host_tensors.pop(name, None)
+            self.models[name] = model
+            self.sizes[name] = model_bytes(model)
+
+        if name in self.resident:
+            self.resident.move_to_end(name)
+            return model
+
+        if self.budget_bytes is not None:
+            # Evict the least recently used models until the model fits, a model larger than the budget evicts all the others
+            while self.resident and self.resident_bytes() + self.sizes[name] > self.budget_bytes:
+                self.evict(next(iter(self.resident)))
+
+        self._load(name, model)
+        self.resident[name] = model
+        return model
+
+    def evict(self, name):
+        model = self.resident.pop(name)
+        slots = _tensor_slots(model)
+
+        if name not in self.host_tensors:
+            # First eviction of a model that was created on the device
+            self.host_tensors[name] = [self._to_host(tensors[key]) for _, tensors, key in slots]
+            self.bytes_transferred += self.sizes[name]
+
+        for (_, tensors, key), host_tensor in zip(slots, self.host_tensors[name]):
+            _set_tensor(tensors, key, host_tensor)
+        self.evictions += 1
+
+    def evict_all(self):
+        for name in list(self.resident):
+            self.evict(name)
+
+    def _to_host(self, tensor):
+        tensor = tensor.detach().to(self.idle_device)
+        if self.pin_memory:
+            tensor = tensor.pin_memory()
+        return tensor
+
+    def _load(self, name, model):
+        slots = _tensor_slots(model)
+        if all(tensors[key].device == self.device for _, tensors, key in slots):
+            return
+
+        if name not in self.host_tensors:
+            # Keep the idle copy of the weights, the next eviction does not need to copy them back
+            self.host_tensors[name] = [self._to_host(tensors[key]) for _, tensors, key in slots]
+
+        for (_, tensors, key), host_tensor in zip(slots, self.host_tensors[name]):
+            _set_tensor(tensors, key, host_tensor.to(self.device, non_blocking=self.pin_memory))
+        self.transfers += 1
+        self.bytes_transferred += self.sizes[name]
+
+    def stats(self):
+        return {
+            "resident": list(self.resident),
+            "resident_bytes": self.resident_bytes(),
+            "budget_bytes": self.budget_bytes,
+            "transfers": self.transfers,
+            "evictions": self.evictions,
+            "bytes_transferred": self.bytes_transferred,
+        }
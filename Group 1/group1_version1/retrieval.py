@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from attention import set_kv_cache
+from classification import DiffDisEncoder
+
+# Text to image retrieval with the DiffDis text branch.
+# The images of a corpus are embedded once (DiffDisEncoder.encode_images: the text query predicted by the UNET at a
+# fixed timestep) into a memory-mapped (Images, Dim) float16 matrix. A text query is the normalized CLIP average of the
+# prompt, and the images are ranked by the cosine similarity, so a query costs a matrix product instead of a UNET forward
+# per image. An optional IVF partition (spherical k-means over the features) restricts every query to the images of
+# its nprobe closest centroids.
+#   python retrieval.py --shards "./data/cc3m/*.tar" --index-dir ./index --num-images 10000 --ivf-lists 64 --nprobe 8
+
+FEATURES_FILE = "features.npy"
+IVF_FILE = "ivf.npz"
+META_FILE = "meta.json"
+
+def build_index(encoder, batches, num_images, index_dir, dtype=np.float16):
+    """
+        Embeds the images of batches (an iterable of (Batch_Size, Channel, Height, Width) tensors in [-1, 1]) into
+        index_dir/features.npy, a (num_images, Dim) matrix written through a memory map, one batch at a time.
+        meta.json records the number of rows that were filled, if batches has fewer than num_images images.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    generator = torch.Generator(device=encoder.device)
+    generator.manual_seed(encoder.seed)
+
+    diffusion = encoder.models["diffusion"]
+    set_kv_cache(diffusion, True)
+
+    dim = encoder.uncond_context.shape[-1]
+    features = np.lib.format.open_memmap(os.path.join(index_dir, FEATURES_FILE), mode="w+", dtype=dtype, shape=(num_images, dim))
+    count = 0
+    start_time = time.time()
+    for images in tqdm(batches, desc="Index"):
+        images = images[:num_images - count]
+        # (Batch_Size, Dim)
+        features[count:count + len(images)] = encoder.encode_images(images, generator).float().cpu().numpy()
+        count += len(images)
+        if count == num_images:
+            break
+    elapsed = time.time() - start_time
+    set_kv_cache(diffusion, False)
+    features.flush()
+    del features
+
+    meta = {"images": count, "dim": dim, "timesteps": encoder.timesteps, "seed": encoder.seed}
+    with open(os.path.join(index_dir, META_FILE), "w") as f:
+        json.dump(meta, f)
+    return {"images": count, "images_per_second": count / elapsed}
+
+def load_features(index_dir):
+    # The memory-mapped features of the indexed images. The file has num_images rows, but a smaller corpus only fills
+    # the first meta["images"] of them, the rows after are zeros and are not images
+    features = np.load(os.path.join(index_dir, FEATURES_FILE), mmap_mode="r")
+    with open(os.path.join(index_dir, META_FILE)) as f:
+        meta = json.load(f)
+    return features[:meta["images"]]
+
+def spherical_kmeans(features, num_lists, iterations=10, sample_size=None, seed=0):
+    # k-means with the cosine similarity on the rows of a (N, Dim) matrix, trained on a random sample of the rows
+    # Returns the normalized centroids (min(Num_Lists, N), Dim), there cannot be more lists than rows
+    rng = np.random.default_rng(seed)
+    n = len(features)
+    if n == 0:
+        raise ValueError("Cannot cluster an empty index")
+    num_lists = min(num_lists, n)
+    sample_size = min(n, sample_size or 256 * num_lists)
+    sample = torch.from_numpy(np.asarray(features[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32))
+    sample = F.normalize(sample, dim=-1)
+
+    centroids = sample[torch.from_numpy(rng.choice(sample_size, num_lists, replace=False))]
+    for _ in range(iterations):
+        # (Sample_Size,)
+        assignments = (sample @ centroids.T).argmax(dim=-1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, sample)
+        counts = torch.bincount(assignments, minlength=num_lists)
+        # Empty lists keep their centroid
+        centroids = torch.where(counts[:, None] > 0, F.normalize(sums, dim=-1), centroids)
+    return centroids
+
+def assign_lists(features, centroids, chunk_size=65536):
+    # Closest centroid of every row: (N,)
+    assignments = []
+    for start in range(0, len(features), chunk_size):
+        chunk = torch.from_numpy(np.asarray(features[start:start + chunk_size], dtype=np.float32))
+        assignments.append((chunk @ centroids.T).argmax(dim=-1))
+    return torch.cat(assignments)
+
+def build_ivf(index_dir, num_lists, iterations=10, seed=0):
+    # Partitions the features of index_dir into num_lists inverted lists, stored as the row ids sorted by list
+    # (ascending within a list, so a list is read in file order) and the offset of every list (compressed sparse rows)
+    features = load_features(index_dir)
+    centroids = spherical_kmeans(features, num_lists, iterations=iterations, seed=seed)
+    # Fewer lists than asked for a small index
+    num_lists = len(centroids)
+    assignments = assign_lists(features, centroids)
+    order = torch.argsort(assignments, stable=True)
+    offsets = torch.zeros(num_lists + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(torch.bincount(assignments, minlength=num_lists), dim=0)
+    np.savez(os.path.join(index_dir, IVF_FILE), centroids=centroids.numpy(), order=order.numpy(), offsets=offsets.numpy())
+
+class RetrievalIndex:
+
+    def __init__(self, index_dir, block_size=65536):
+        # The features stay on disk, the search reads them block by block (exact) or list by list (IVF)
+        self.features = load_features(index_dir)
+        self.block_size = block_size
+        self.centroids = None
+        ivf_path = os.path.join(index_dir, IVF_FILE)
+        if os.path.exists(ivf_path):
+            ivf = np.load(ivf_path)
+            self.centroids = torch.from_numpy(ivf["centroids"])
+            self.order = ivf["order"]
+            self.offsets = ivf["offsets"]
+
+    def __len__(self):
+        return len(self.features)
+
+    @staticmethod
+    def _merge_top_k(scores, ids, new_scores, new_ids, k):
+        # Keeps the k best of the current and the new candidates of every query
+        scores = torch.cat([scores, new_scores], dim=1)
+        ids = torch.cat([ids, new_ids], dim=1)
+        scores, indices = scores.topk(min(k, scores.shape[1]), dim=1)
+        return scores, torch.gather(ids, 1, indices)
+
+    def _rows(self, ids):
+        return torch.from_numpy(np.asarray(self.features[ids], dtype=np.float32))
+
+    def search(self, queries, k=10, nprobe=None):
+        """
+            Top-k images of every query: (Queries, Dim) -> scores and image ids, both (Queries, k).
+            With nprobe (and an IVF partition) only the images of the nprobe closest lists of every query are scored.
+        """
+        queries = F.normalize(queries.float().cpu(), dim=-1)
+        num_queries = queries.shape[0]
+        scores = torch.full((num_queries, 0), -float("inf"))
+        ids = torch.zeros((num_queries, 0), dtype=torch.long)
+
+        if nprobe is None or self.centroids is None:
+            # Exact search, one block of rows for all the queries at a time
+            for start in range(0, len(self.features), self.block_size):
+                block = torch.from_numpy(np.asarray(self.features[start:start + self.block_size], dtype=np.float32))
+                # (Queries, Dim) @ (Dim, Block_Size) -> (Queries, Block_Size)
+                block_scores = queries @ block.T
+                block_ids = torch.arange(start, start + block.shape[0]).expand(num_queries, -1)
+                scores, ids = self._merge_top_k(scores, ids, block_scores, block_ids, k)
+            return scores, ids
+
+        # (Queries, Num_Lists) -> (Queries, Nprobe)
+        probes = (queries @ self.centroids.T).topk(min(nprobe, len(self.centroids)), dim=1).indices
+        # Every list is read once and scored against all the queries that probe it
+        scores = torch.full((num_queries, k), -float("inf"))
+        ids = torch.full((num_queries, k), -1, dtype=torch.long)
+        for list_id in torch.unique(probes).tolist():
+            list_queries = (probes == list_id).any(dim=1).nonzero().squeeze(1)
+            rows = self.order[self.offsets[list_id]:self.offsets[list_id + 1]]
+            if len(rows) == 0:
+                continue
+            # (List_Queries, Dim) @ (Dim, List_Size) -> (List_Queries, List_Size)
+            list_scores = queries[list_queries] @ self._rows(rows).T
+            list_ids = torch.from_numpy(rows).expand(len(list_queries), -1)
+            scores[list_queries], ids[list_queries] = self._merge_top_k(
+                scores[list_queries], ids[list_queries], list_scores, list_ids, k
+            )
+        return scores, ids
+
+def recall_at_k(ids, targets, ks=(1, 5, 10)):
+    # Fraction of the queries whose target image is in the top k: ids (Queries, K), targets (Queries,)
+    hits = ids == targets[:, None]
+    return {f"recall@{k}": hits[:, :k].any(dim=1).float().mean().item() for k in ks}
+
+def evaluate(index, queries, targets, k=10, nprobe=None, batch_size=256):
+    # Recall@k and queries per second of batched searches
+    all_ids = []
+    start_time = time.time()
+    for start in range(0, len(queries), batch_size):
+        _, ids = index.search(queries[start:start + batch_size], k=k, nprobe=nprobe)
+        all_ids.append(ids)
+    elapsed = time.time() - start_time
+    results = recall_at_k(torch.cat(all_ids), targets, ks=[x for x in (1, 5, 10) if x <= k])
+    results["queries_per_second"] = len(queries) / elapsed
+    return results
+
+if __name__ == "__main__":
+    import io
+    import glob
+    import model_loader
+    from PIL import Image
+    from transformers import CLIPTokenizer
+    from dataloader import iterate_tar_samples, preprocess_image, IMAGE_EXTENSIONS, CAPTION_EXTENSIONS
+    from config import WIDTH, HEIGHT
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", required=True, help="Glob of tar shards of image-caption pairs, see dataloader.py")
+    parser.add_argument("--index-dir", default="./index")
+    parser.add_argument("--num-images", type=int, default=10000)
+    parser.add_argument("--ckpt", default="./data/v1-5-pruned.ckpt")
+    parser.add_argument("--timestep", type=int, default=500, help="Fixed timestep of the image embedding")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--ivf-lists", type=int, default=0)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    tokenizer = CLIPTokenizer("./data/vocab.json", merges_file="./data/merges.txt")
+    models = model_loader.preload_models_from_standard_weights(args.ckpt, args.device, tokenizer=tokenizer)
+    encoder = DiffDisEncoder(models, tokenizer, timesteps=[args.timestep], device=args.device)
+
+    # The caption of every indexed image is its query, the target of the query is the row of the image
+    captions = []
+    def batches():
+        images = []
+        for path in sorted(glob.glob(args.shards)):
+            for sample in iterate_tar_samples(path):
+                image_key = next((e for e in IMAGE_EXTENSIONS if e in sample), None)
+                caption_key = next((e for e in CAPTION_EXTENSIONS if e in sample), None)
+                if image_key is None or caption_key is None:
+                    continue
+                images.append(preprocess_image(Image.open(io.BytesIO(sample[image_key])), (WIDTH, HEIGHT)))
+                captions.append(sample[caption_key].decode("utf-8").strip())
+                if len(images) == args.batch_size:
+                    yield torch.stack(images)
+                    images = []
+        if images:
+            yield torch.stack(images)
+
+    results = {"index": build_index(encoder, batches(), args.num_images, args.index_dir)}
+    if args.ivf_lists:
+        build_ivf(args.index_dir, args.ivf_lists)
+
+    index = RetrievalIndex(args.index_dir)
+    captions = captions[:len(index)]
+    queries = torch.cat([
+        encoder.encode_text_queries([[caption] for caption in captions[start:start + 256]]).cpu()
+        for start in range(0, len(captions), 256)
+    ])
+    targets = torch.arange(len(captions))
+    results["exact"] = evaluate(index, queries, targets, k=args.k)
+    if args.ivf_lists:
+        results["ivf"] = evaluate(index, queries, targets, k=args.k, nprobe=args.nprobe)
+    results["config"] = vars(args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
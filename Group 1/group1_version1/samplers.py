@@ -0,0 +1,114 @@
+import torch
+from ddpm import Sampler, DDPMSampler
+
+# Samplers that reach the quality of 50 DDPM steps in 15-25 steps.
+# All of them take the latents and the predicted noise in the DDPM parametrization, like DDPMSampler,
+# so they can be swapped in the pipeline without any other change.
+
+class DDIMSampler(Sampler):
+    # Deterministic DDIM (eta = 0), see formula (12) from https://arxiv.org/pdf/2010.02502.pdf
+    # x_{t-1} = sqrt(alpha_prod_t_prev) * x_0 + sqrt(1 - alpha_prod_t_prev) * eps
+
+    def _set_coefficients(self, alpha_prod_t, alpha_prod_t_prev):
+        # x_0 = (x_t - sqrt(1 - alpha_prod_t) * eps) / sqrt(alpha_prod_t), folded into the coefficients of x_t and eps
+        self.latents_coeff = (alpha_prod_t_prev / alpha_prod_t) ** 0.5
+        self.model_output_coeff = (1 - alpha_prod_t_prev) ** 0.5 - self.latents_coeff * (1 - alpha_prod_t) ** 0.5
+
+    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor):
+        t = timestep
+        return self.latents_coeff[t] * latents + self.model_output_coeff[t] * model_output
+
+class DPMSolverMultistepSampler(Sampler):
+    # DPM-Solver++(2M), see Algorithm 2 from https://arxiv.org/pdf/2211.01095.pdf
+    # With alpha_t = sqrt(alpha_prod_t), sigma_t = sqrt(1 - alpha_prod_t) and lambda_t = log(alpha_t / sigma_t),
+    # a step from s to t with the step size h = lambda_t - lambda_s is
+    # x_t = sigma_t / sigma_s * x_s - alpha_t * (exp(-h) - 1) * D
+    # where D is the predicted x_0, corrected with the x_0 predicted at the previous step.
+
+    def _set_coefficients(self, alpha_prod_t, alpha_prod_t_prev):
+        alpha_t, sigma_t = alpha_prod_t ** 0.5, (1 - alpha_prod_t) ** 0.5
+        alpha_prev, sigma_prev = alpha_prod_t_prev ** 0.5, (1 - alpha_prod_t_prev) ** 0.5
+
+        # Predicted x_0 from x_t and eps
+        self.pred_original_latents_coeff = 1 / alpha_t
+        self.pred_original_model_output_coeff = -sigma_t / alpha_t
+
+        self.latents_coeff = sigma_prev / sigma_t
+        # -alpha_prev * (exp(-h) - 1) with exp(-h) = alpha_t * sigma_prev / (sigma_t * alpha_prev)
+        self.pred_original_coeff = alpha_prev - alpha_t * sigma_prev / sigma_t
+        # The last step goes to sigma = 0, where lambda is infinite, so it is always a first order step
+        self.step_size = torch.log(alpha_prev / sigma_prev) - torch.log(alpha_t / sigma_t)
+
+        self.prev_pred_original_sample = None
+        self.prev_step_size = None
+        self.reset_mask = None
+
+    def set_strengths(self, strengths):
+        start_steps = super().set_strengths(strengths)
+        self.prev_pred_original_sample = None
+        self.prev_step_size = None
+        return start_steps
+
+    def reset_state(self, mask):
+        # Only used by the next step
+        self.reset_mask = mask
+
+    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor):
+        t = timestep
+        pred_original_sample = self.pred_original_latents_coeff[t] * latents + self.pred_original_model_output_coeff[t] * model_output
+
+        step_size = self.step_size[t]
+        if self.prev_pred_original_sample is None or not torch.isfinite(step_size):
+            # First order step (DPM-Solver++(1), which is DDIM)
+            d = pred_original_sample
+        else:
+            # Second order step: extrapolate x_0 with the ratio of the previous and the current step sizes
+            r = self.prev_step_size / step_size
+            d = (1 + 1 / (2 * r)) * pred_original_sample - (1 / (2 * r)) * self.prev_pred_original_sample
+            if self.reset_mask is not None:
+                # The samples that start at this step have no previous step
+                mask = self.reset_mask.to(d.device).view(-1, *([1] * (d.dim() - 1)))
+                d = torch.where(mask, pred_original_sample, d)
+
+        self.prev_pred_original_sample = pred_original_sample
+        self.prev_step_size = step_size
+        self.reset_mask = None
+
+        return self.latents_coeff[t] * latents + self.pred_original_coeff[t] * d
+
+class EulerAncestralSampler(Sampler):
+    # Euler ancestral sampling from https://github.com/crowsonkb/k-diffusion, in the DDPM parametrization.
+    # k-diffusion works on x / sqrt(alpha_prod_t) with the noise level sigma_t = sqrt((1 - alpha_prod_t) / alpha_prod_t),
+    # the step is x' = x + eps * (sigma_down - sigma_t) + sigma_up * noise, where sigma_up is the part of the next noise
+    # level that is sampled fresh. The latents are scaled back with sqrt(alpha_prod_t_prev) after the step.
+
+    def _set_coefficients(self, alpha_prod_t, alpha_prod_t_prev):
+        sigma_t = ((1 - alpha_prod_t) / alpha_prod_t) ** 0.5
+        sigma_prev = ((1 - alpha_prod_t_prev) / alpha_prod_t_prev) ** 0.5
+        sigma_up = torch.minimum(sigma_prev, (sigma_prev ** 2 * (sigma_t ** 2 - sigma_prev ** 2) / sigma_t ** 2) ** 0.5)
+        sigma_down = (sigma_prev ** 2 - sigma_up ** 2) ** 0.5
+
+        self.latents_coeff = (alpha_prod_t_prev / alpha_prod_t) ** 0.5
+        self.model_output_coeff = alpha_prod_t_prev ** 0.5 * (sigma_down - sigma_t)
+        self.std = alpha_prod_t_prev ** 0.5 * sigma_up
+
+    def step(self, timestep: int, latents: torch.Tensor, model_output: torch.Tensor):
+        t = timestep
+        prev_sample = self.latents_coeff[t] * latents + self.model_output_coeff[t] * model_output
+        if self.std[t] > 0:
+            prev_sample = prev_sample + self.std[t] * self._noise(model_output)
+        return prev_sample
+
+SAMPLERS = {
+    "ddpm": DDPMSampler,
+    "ddim": DDIMSampler,
+    "dpm++2m": DPMSolverMultistepSampler,
+    "euler_a": EulerAncestralSampler,
+}
+
+def get_sampler(name, generator, n_inference_steps=50):
+    if name not in SAMPLERS:
+        raise ValueError("Unknown sampler value %s. Expected one of %s" % (name, ", ".join(SAMPLERS)))
+    sampler = SAMPLERS[name](generator)
+    sampler.set_inference_timesteps(n_inference_steps)
+    return sampler
@@ -0,0 +1,278 @@
+import io
+import json
+import math
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+from PIL import Image
+from pipeline import generate_batch, WIDTH, HEIGHT
+from samplers import SAMPLERS
+
+# Micro-batching generation server.
+# Requests go through an in-process queue to a single worker thread that owns the models. The worker groups the
+# compatible requests (same width, height, sampler, number of steps and guidance) and runs every group through one
+# batched denoising loop (pipeline.generate_batch), so N requests cost about one UNET forward per step with a batch of N
+# instead of N forwards. A group is started as soon as it has max_batch_size requests, or when its oldest request has
+# waited max_wait_ms. Every request keeps its own seed, so its image does not depend on the batch it ran in.
+#   python server.py --ckpt ./data/v1-5-pruned.ckpt --max-batch-size 4 --max-wait-ms 100
+#   curl -X POST localhost:8000/generate -d '{"prompt": "a photo of a cat", "seed": 42}' -o cat.png
+
+class GenerationRequest:
+
+    def __init__(self, prompt, uncond_prompt="", seed=None, width=WIDTH, height=HEIGHT, sampler_name="ddpm",
+                 n_inference_steps=50, do_cfg=True, cfg_scale=7.5):
+        # Checked here, so a bad request is rejected on its own instead of failing the batch it would join
+        if not isinstance(prompt, str) or not isinstance(uncond_prompt, str):
+            raise TypeError("prompt and uncond_prompt must be strings")
+        if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or not 0 <= seed < 2 ** 64):
+            raise ValueError("seed must be an integer between 0 and 2 ** 64 - 1")
+        for name, value in (("width", width), ("height", height), ("n_inference_steps", n_inference_steps)):
+            if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+                raise ValueError(f"{name} must be a positive integer")
+        if width % 8 != 0 or height % 8 != 0:
+            raise ValueError("width and height must be multiples of 8")
+        if n_inference_steps > 1000:
+            raise ValueError("n_inference_steps must be at most 1000")
+        if sampler_name not in SAMPLERS:
+            raise ValueError(f"sampler_name must be one of {', '.join(SAMPLERS)}")
+        if not isinstance(do_cfg, bool):
+            raise TypeError("do_cfg must be a boolean")
+        if isinstance(cfg_scale, bool) or not isinstance(cfg_scale, (int, float)) or not math.isfinite(cfg_scale):
+            raise ValueError("cfg_scale must be a finite number")
+        self.prompt = prompt
+        self.uncond_prompt = uncond_prompt
+        self.seed = seed
+        self.width = width
+        self.height = height
+        self.sampler_name = sampler_name
+        self.n_inference_steps = n_inference_steps
+        self.do_cfg = do_cfg
+        self.cfg_scale = cfg_scale
+        self.future = Future()
+        self.arrival_time = time.perf_counter()
+
+    def key(self):
+        # Requests with the same key can share a denoising loop
+        return (self.width, self.height, self.sampler_name, self.n_inference_steps, self.do_cfg, self.cfg_scale)
+
+class DynamicBatcher:
+
+    def __init__(self, models, tokenizer, device=None, max_batch_size=4, max_wait_ms=50, **pipeline_kwargs):
+        self.models = models
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # Passed on to generate_batch, e.g. idle_device, residency or deep_cache_interval
+        self.pipeline_kwargs = pipeline_kwargs
+
+        self.queue = queue.Queue()
+        # Requests taken from the queue that wait for their group to start, per key in arrival order
+        self.pending = {}
+        self.stats = {"requests": 0, "batches": 0, "batch_sizes": {}, "errors": 0, "batch_retries": 0}
+        self.stats_lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="generation-worker", daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt, **kwargs):
+        # Returns a Future of the (Height, Width, Channel) uint8 image, see GenerationRequest for the arguments
+        return self.submit_request(GenerationRequest(prompt, **kwargs))
+
+    def submit_request(self, request):
+        self.queue.put(request)
+        return request.future
+
+    def generate(self, prompt, timeout=None, **kwargs):
+        return self.submit(prompt, **kwargs).result(timeout)
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats, batch_sizes=dict(self.stats["batch_sizes"]))
+        stats["queued"] = self.queue.qsize()
+        return stats
+
+    def close(self):
+        self.running = False
+        self.queue.put(None)
+        self.thread.join()
+
+    def _add(self, request):
+        if request is not None:
+            self.pending.setdefault(request.key(), []).append(request)
+
+    def _next_batch(self):
+        # Blocks until a group is full or its oldest request has waited max_wait, returns the requests of the group
+        while self.running and not self.pending:
+            self._add(self.queue.get())
+        while self.running:
+            # Take everything that arrived in the meantime
+            while True:
+                try:
+                    self._add(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # The group of the oldest request goes first, unless another group is already full
+            key = min(self.pending, key=lambda k: self.pending[k][0].arrival_time)
+            full = [k for k, requests in self.pending.items() if len(requests) >= self.max_batch_size]
+            if full:
+                key = min(full, key=lambda k: self.pending[k][0].arrival_time)
+            remaining = self.pending[key][0].arrival_time + self.max_wait - time.perf_counter()
+            if full or remaining <= 0:
+                requests = self.pending[key][:self.max_batch_size]
+                self.pending[key] = self.pending[key][self.max_batch_size:]
+                if not self.pending[key]:
+                    del self.pending[key]
+                return requests
+
+            try:
+                self._add(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                pass
+        return []
+
+    def _run(self):
+        while self.running:
+            requests = self._next_batch()
+            if requests:
+                self._generate(requests)
+        # Fail what is left when the server stops
+        while True:
+            try:
+                self._add(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        for requests in self.pending.values():
+            for request in requests:
+                request.future.set_exception(RuntimeError("The server was stopped"))
+
+    def _generate(self, requests):
+        start_time = time.perf_counter()
+        try:
+            images = self._generate_batch(requests)
+        except Exception as e:
+            if len(requests) == 1:
+                with self.stats_lock:
+                    self.stats["errors"] += 1
+                requests[0].future.set_exception(e)
+                return
+            # One bad request must not fail the others of its batch: run them one at a time
+            with self.stats_lock:
+                self.stats["batch_retries"] += 1
+            for request in requests:
+                self._generate([request])
+            return
+
+        elapsed = time.perf_counter() - start_time
+        with self.stats_lock:
+            self.stats["requests"] += len(requests)
+            self.stats["batches"] += 1
+            self.stats["batch_sizes"][len(requests)] = self.stats["batch_sizes"].get(len(requests), 0) + 1
+        for request, image in zip(requests, images):
+            # The callers see how their request was served
+            request.batch_size = len(requests)
+            request.queue_seconds = start_time - request.arrival_time
+            request.generation_seconds = elapsed
+            request.future.set_result(image)
+
+    def _generate_batch(self, requests):
+        first = requests[0]
+        return generate_batch(
+            prompts=[request.prompt for request in requests],
+            uncond_prompts=[request.uncond_prompt for request in requests],
+            seeds=[request.seed for request in requests],
+            do_cfg=first.do_cfg,
+            cfg_scale=first.cfg_scale,
+            sampler_name=first.sampler_name,
+            n_inference_steps=first.n_inference_steps,
+            width=first.width,
+            height=first.height,
+            models=self.models,
+            tokenizer=self.tokenizer,
+            device=self.device,
+            **self.pipeline_kwargs,
+        )
+
+def make_handler(batcher, timeout=600):
+
+    class GenerationHandler(BaseHTTPRequestHandler):
+        # POST /generate with a JSON body of GenerationRequest arguments returns a PNG, GET /stats the batcher stats
+
+        def _send(self, status, body, content_type="application/json", headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/stats":
+                return self._send(404, b'{"error": "not found"}')
+            self._send(200, json.dumps(batcher.get_stats()).encode())
+
+        def do_POST(self):
+            if self.path != "/generate":
+                return self._send(404, b'{"error": "not found"}')
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                arguments = json.loads(self.rfile.read(length) or b"{}")
+                request = GenerationRequest(**arguments)
+            except (ValueError, TypeError) as e:
+                return self._send(400, json.dumps({"error": str(e)}).encode())
+
+            try:
+                image = batcher.submit_request(request).result(timeout)
+            except Exception as e:
+                return self._send(500, json.dumps({"error": str(e)}).encode())
+
+            buffer = io.BytesIO()
+            Image.fromarray(image).save(buffer, format="PNG")
+            self._send(200, buffer.getvalue(), "image/png", {
+                "X-Batch-Size": str(request.batch_size),
+                "X-Queue-Ms": f"{request.queue_seconds * 1000:.1f}",
+                "X-Generation-Ms": f"{request.generation_seconds * 1000:.1f}",
+            })
+
+        def log_message(self, format, *args):
+            # One line per request is too much under load
+            pass
+
+    return GenerationHandler
+
+def serve(batcher, host="127.0.0.1", port=8000):
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    print(f"Serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+if __name__ == "__main__":
+    import model_loader
+    from transformers import CLIPTokenizer
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", default="./data/v1-5-pruned.ckpt")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=4)
+    parser.add_argument("--max-wait-ms", type=float, default=50)
+    parser.add_argument("--deep-cache-interval", type=int, default=None)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    tokenizer = CLIPTokenizer("./data/vocab.json", merges_file="./data/merges.txt")
+    models = model_loader.preload_models_from_standard_weights(args.ckpt, args.device, tokenizer=tokenizer)
+    batcher = DynamicBatcher(models, tokenizer, device=args.device, max_batch_size=args.max_batch_size,
+                             max_wait_ms=args.max_wait_ms, deep_cache_interval=args.deep_cache_interval)
+    serve(batcher, args.host, args.port)
@@ -0,0 +1,74 @@
+import torch
+from torch import nn
+from diffusion import UNET_AttentionBlock
+from model_loader import load_state_dict_ignore_size_mismatch
+from lora import inject_lora, lora_state_dict, load_lora, save_lora
+
+# A small UNET_AttentionBlock with the DiffDis inputs, loaded from a "pretrained" checkpoint without the DiffDis layers
+
+class TinyUNET(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.block = UNET_AttentionBlock(2, 8, d_context=16)
+
+    def forward(self, x, context, aug_emb, text_query):
+        # The latent and the text query outputs in one tensor
+        latent, text_query = self.block(x, context, aug_emb, text_query, is_upsample=False)
+        return torch.cat([latent.flatten(1), text_query.flatten(1)], dim=1)
+
+DIFFDIS_LAYERS = ("text_linear_geglu", "linearLayer")
+
+def _pretrained_checkpoint():
+    torch.manual_seed(0)
+    return {key: value for key, value in TinyUNET().state_dict().items()
+            if not any(layer in key for layer in DIFFDIS_LAYERS)}
+
+def _load(checkpoint, seed):
+    # The layers that are not in the checkpoint get another random initialization in every process
+    torch.manual_seed(seed)
+    model = TinyUNET()
+    unloaded = load_state_dict_ignore_size_mismatch(model, checkpoint)
+    parameters = inject_lora(model, rank=2, trainable=unloaded)
+    return model, unloaded, parameters
+
+def _inputs():
+    generator = torch.Generator().manual_seed(1)
+    return (torch.randn(2, 16, 4, 4, generator=generator), torch.randn(2, 5, 16, generator=generator),
+            torch.randn(2, 16, generator=generator), torch.randn(2, 16, generator=generator))
+
+def test_lora_checkpoint_resumes_with_the_same_outputs(tmp_path):
+    checkpoint = _pretrained_checkpoint()
+    model, unloaded, parameters = _load(checkpoint, seed=1)
+    assert unloaded and all(any(layer in name for layer in DIFFDIS_LAYERS) for name in unloaded)
+
+    optimizer = torch.optim.Adam(parameters, lr=1e-2)
+    inputs = _inputs()
+    for _ in range(3):
+        loss = model(*inputs).pow(2).mean()
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    path = tmp_path / "lora.pt"
+    save_lora(model, path)
+    state_dict = torch.load(path)
+    # The DiffDis layers are saved with the adapters, the pretrained weights are not
+    assert any(".lora_" in key for key in state_dict)
+    assert any("linearLayer" in key for key in state_dict)
+    assert not any("attention_2" in key and ".lora_" not in key for key in state_dict)
+
+    resumed, _, _ = _load(checkpoint, seed=2)
+    load_lora(resumed, state_dict)
+    model.eval()
+    resumed.eval()
+    with torch.no_grad():
+        assert torch.equal(model(*inputs), resumed(*inputs))
+
+def test_inject_lora_twice_keeps_the_trainable_parameters():
+    model, unloaded, parameters = _load(_pretrained_checkpoint(), seed=1)
+    again = inject_lora(model, rank=2, trainable=[name.replace(".weight", ".base.weight").replace(".bias", ".base.bias")
+                                                  for name in unloaded])
+    # The same parameters are trainable, the adapters are not wrapped again
+    assert {id(parameter) for parameter in again} == {id(parameter) for parameter in parameters}
+    assert set(lora_state_dict(model)) == {name for name, parameter in model.named_parameters() if parameter.requires_grad}
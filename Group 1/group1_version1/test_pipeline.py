@@ -0,0 +1,80 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+import pipeline
+
+# Small stand-in models with the call signatures of the pipeline, so the batched img2img runs on the CPU in seconds
+
+class StubTokenizer:
+
+    def batch_encode_plus(self, texts, padding="max_length", max_length=77):
+        class Encoding:
+            input_ids = [[(sum(map(ord, text)) + i) % 100 for i in range(max_length)] for text in texts]
+        return Encoding()
+
+class StubCLIP(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(100, 8)
+
+    def forward(self, tokens):
+        return self.embedding(tokens)
+
+class StubEncoder(nn.Module):
+
+    def forward(self, x, noise):
+        # (Batch_Size, 3, Height, Width) -> (Batch_Size, 4, Height / 8, Width / 8)
+        return F.avg_pool2d(x, 8).repeat(1, 2, 1, 1)[:, :4] + 0.1 * noise
+
+class StubDiffusion(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(4, 4, 3, padding=1)
+
+    def forward(self, latent, context, time, text_time, text_query, **kwargs):
+        return self.conv(latent) + context.mean(), text_query
+
+class StubDecoder(nn.Module):
+
+    def forward(self, latents):
+        return F.interpolate(latents[:, :3], scale_factor=8).tanh()
+
+def _generate_kwargs():
+    torch.manual_seed(0)
+    models = {"clip": StubCLIP(), "encoder": StubEncoder(), "diffusion": StubDiffusion(), "decoder": StubDecoder()}
+    return dict(models=models, tokenizer=StubTokenizer(), seeds=[1, 2], sampler_name="ddim", n_inference_steps=5,
+                width=32, height=32, device="cpu")
+
+def _input_images():
+    return np.random.RandomState(0).randint(0, 256, (2, 48, 40, 3), dtype=np.uint8)
+
+def test_img2img_numpy_batch():
+    kwargs = _generate_kwargs()
+    images = pipeline.img2img(["a cat", "a dog"], _input_images(), strengths=[0.6, 0.9], **kwargs)
+    assert images.shape == (2, 32, 32, 3) and images.dtype == np.uint8
+
+    # The same images as a list of arrays
+    expected = pipeline.img2img(["a cat", "a dog"], list(_input_images()), strengths=[0.6, 0.9], **kwargs)
+    assert (images == expected).all()
+
+def test_img2img_tensor_batch():
+    kwargs = _generate_kwargs()
+    images = pipeline.img2img(["a cat", "a dog"], torch.from_numpy(_input_images()), strengths=0.8, **kwargs)
+    expected = pipeline.img2img(["a cat", "a dog"], _input_images(), strengths=0.8, **kwargs)
+    assert (images == expected).all()
+
+def test_generate_array_input_image():
+    kwargs = _generate_kwargs()
+    kwargs["seed"] = kwargs.pop("seeds")[0]
+    image = pipeline.generate("a cat", input_image=_input_images()[0], strength=0.8, **kwargs)
+    assert image.shape == (32, 32, 3)
+
+def test_generate_batch_positional_arguments():
+    kwargs = _generate_kwargs()
+    images = pipeline.generate_batch(["a cat", "a dog"], None, None, 0.8, True, 7.5, kwargs["sampler_name"],
+                                     kwargs["n_inference_steps"], kwargs["models"], kwargs["seeds"], "cpu", None,
+                                     kwargs["tokenizer"], width=32, height=32)
+    assert (images == pipeline.generate_batch(["a cat", "a dog"], **kwargs)).all()
@@ -0,0 +1,15 @@
+import torch
+from token_merging import bipartite_soft_matching_2d
+
+def test_latent_smaller_than_a_window_is_not_merged():
+    # A 1 x N latent has no full 2 x 2 window, so there is no dst token to merge into
+    x = torch.randn(2, 7, 16)
+    merge, unmerge = bipartite_soft_matching_2d(x, 1, 7, r=3)
+    assert torch.equal(unmerge(merge(x)), x)
+
+def test_merge_removes_r_tokens_and_unmerge_restores_the_shape():
+    x = torch.randn(2, 4 * 6, 16)
+    merge, unmerge = bipartite_soft_matching_2d(x, 4, 6, r=5)
+    merged = merge(x)
+    assert merged.shape == (2, 4 * 6 - 5, 16)
+    assert unmerge(merged).shape == x.shape
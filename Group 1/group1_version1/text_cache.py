@@ -0,0 +1,96 @@
+import torch
+from collections import OrderedDict
+
+class TextEmbeddingCache:
+    """
+        LRU cache of CLIP context embeddings keyed by the token ids of the prompt.
+        The cache is bounded both by the number of entries and by the number of bytes held by the cached tensors.
+        Only use it with a frozen text encoder: the cached embeddings are not invalidated if the CLIP weights change.
+    """
+
+    def __init__(self, clip, tokenizer, max_entries=1024, max_bytes=256 * 1024 ** 2, max_length=77):
+        self.clip = clip
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_length = max_length
+
+        self._entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def tokenize(self, prompts):
+        # Convert each prompt into a tuple of length Seq_Len=77 that can be used as a dictionary key
+        token_ids = self.tokenizer.batch_encode_plus(
+            list(prompts), padding="max_length", max_length=self.max_length
+        ).input_ids
+        return [tuple(ids) for ids in token_ids]
+
+    def encode(self, prompts, device=None):
+        # Returns the context of every prompt: (Batch_Size, Seq_Len, Dim)
+        token_ids = self.tokenize(prompts)
+
+        # Look up the cached prompts first, so that inserting the missing ones cannot evict them
+        contexts = {}
+        for ids in token_ids:
+            if ids in self._entries:
+                contexts[ids] = self._entries[ids]
+                # Mark the entry as the most recently used one
+                self._entries.move_to_end(ids)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        # Every distinct prompt that is not cached yet is encoded in a single CLIP forward pass
+        missing = [ids for ids in dict.fromkeys(token_ids) if ids not in contexts]
+        if missing:
+            clip_device = next(self.clip.parameters()).device
+            with torch.no_grad():
+                # (Missing, Seq_Len) -> (Missing, Seq_Len, Dim)
+                missing_contexts = self.clip(torch.tensor(missing, dtype=torch.long, device=clip_device))
+            for ids, context in zip(missing, missing_contexts):
+                contexts[ids] = context
+                self._insert(ids, context)
+
+        # (Seq_Len, Dim) -> (Batch_Size, Seq_Len, Dim)
+        return torch.stack([contexts[ids] for ids in token_ids]).to(device)
+
+    def warmup(self, prompts=("",)):
+        # Pre-compute the embeddings of prompts that are known to be hot, e.g. the empty negative prompt
+        # Warming up should not show up in the hit rate
+        hits, misses = self.hits, self.misses
+        self.encode(prompts)
+        self.hits, self.misses = hits, misses
+
+    def clear(self):
+        self._entries.clear()
+        self.num_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _insert(self, ids, context):
+        # Clone so that the cached tensor does not keep the whole CLIP output batch alive
+        context = context.detach().clone()
+        size = context.numel() * context.element_size()
+        if size > self.max_bytes:
+            return
+
+        self._entries[ids] = context
+        self.num_bytes += size
+
+        # Evict the least recently used entries until both bounds hold again
+        while len(self._entries) > self.max_entries or self.num_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.num_bytes -= evicted.numel() * evicted.element_size()
@@ -0,0 +1,147 @@
+import torch
+from torch import nn
+from diffusion import UNET_AttentionBlock, Upsample
+
+# Token merging for the self-attention of the UNET at inference time, see ToMe for Stable Diffusion
+# (https://arxiv.org/pdf/2303.17604.pdf).
+# Before attention_1, the tokens are split into dst tokens (one per sy x sx window of the latent) and src tokens (the rest).
+# The r src tokens most similar to a dst token are averaged into it, attention runs over the remaining tokens,
+# and afterwards every merged token gets a copy of the output of the dst token it was merged into.
+# The self-attention cost is quadratic in the number of tokens, so merging half of the tokens cuts it by about 4x.
+
+def bipartite_soft_matching_2d(metric, height, width, r, sx=2, sy=2):
+    # metric: (Batch_Size, Height * Width, Features)
+    # Returns the merge and unmerge functions of the tokens
+    batch_size, num_tokens, _ = metric.shape
+    hsy, wsx = height // sy, width // sx
+    num_dst = hsy * wsx
+    # A latent smaller than a window has no dst token (and a 1 x 1 window no src token), there is nothing to merge
+    if r <= 0 or num_dst == 0 or num_dst == num_tokens:
+        return (lambda x: x), (lambda x: x)
+
+    with torch.no_grad():
+        device = metric.device
+
+        # The first token of every sy x sx window is a dst token (-1), all the other tokens are src tokens (0)
+        # (Height / sy, Width / sx, sy * sx)
+        window = torch.zeros((hsy, wsx, sy * sx), device=device, dtype=torch.int64)
+        window[:, :, 0] = -1
+        # (Height / sy, Width / sx, sy * sx) -> (Height / sy * sy, Width / sx * sx)
+        window = window.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+        # Tokens outside of a full window (odd sizes) are src tokens
+        # (Height, Width)
+        token_type = torch.zeros((height, width), device=device, dtype=torch.int64)
+        token_type[:hsy * sy, :wsx * sx] = window
+
+        # The dst tokens come first: (1, Height * Width, 1)
+        order = token_type.reshape(1, -1, 1).argsort(dim=1)
+        # (1, Num_Src, 1)
+        src_order = order[:, num_dst:, :]
+        # (1, Num_Dst, 1)
+        dst_order = order[:, :num_dst, :]
+
+        def split(x):
+            features = x.shape[-1]
+            src = torch.gather(x, dim=1, index=src_order.expand(x.shape[0], num_tokens - num_dst, features))
+            dst = torch.gather(x, dim=1, index=dst_order.expand(x.shape[0], num_dst, features))
+            return src, dst
+
+        # Cosine similarity of every src token with every dst token
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        # (Batch_Size, Num_Src, Num_Dst)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+        # Best dst token of every src token: (Batch_Size, Num_Src)
+        node_max, node_idx = scores.max(dim=-1)
+        # Src tokens sorted by the similarity to their best dst token: (Batch_Size, Num_Src, 1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        # (Batch_Size, Num_Src - r, 1)
+        unmerged_idx = edge_idx[..., r:, :]
+        # (Batch_Size, r, 1)
+        src_idx = edge_idx[..., :r, :]
+        # (Batch_Size, r, 1)
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x):
+        # (Batch_Size, Height * Width, Features) -> (Batch_Size, Height * Width - r, Features)
+        src, dst = split(x)
+        n, num_src, features = src.shape
+        unmerged = torch.gather(src, dim=-2, index=unmerged_idx.expand(n, num_src - r, features))
+        src = torch.gather(src, dim=-2, index=src_idx.expand(n, r, features))
+        # Average the merged src tokens into their dst token
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, features), src, reduce="mean")
+        return torch.cat([unmerged, dst], dim=1)
+
+    def unmerge(x):
+        # (Batch_Size, Height * Width - r, Features) -> (Batch_Size, Height * Width, Features)
+        num_unmerged = unmerged_idx.shape[1]
+        unmerged, dst = x[..., :num_unmerged, :], x[..., num_unmerged:, :]
+        n, _, features = unmerged.shape
+        # Every merged src token takes the output of its dst token
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(n, r, features))
+
+        out = torch.zeros((n, num_tokens, features), device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=dst_order.expand(n, num_dst, features), src=dst)
+        src_positions = src_order.expand(n, num_tokens - num_dst, 1)
+        out.scatter_(dim=-2, index=torch.gather(src_positions, dim=1, index=unmerged_idx).expand(n, num_unmerged, features), src=unmerged)
+        out.scatter_(dim=-2, index=torch.gather(src_positions, dim=1, index=src_idx).expand(n, r, features), src=src)
+        return out
+
+    return merge, unmerge
+
+class TokenMerging:
+
+    def __init__(self, ratio=0.5, sx=2, sy=2):
+        if not 0 <= ratio < 1:
+            raise ValueError("ratio must be in [0, 1)")
+        self.ratio = ratio
+        self.sx = sx
+        self.sy = sy
+
+    def __call__(self, x, height, width):
+        # x: (Batch_Size, Height * Width, Features), used as the similarity metric
+        r = int(x.shape[1] * self.ratio)
+        return bipartite_soft_matching_2d(x, height, width, r, sx=self.sx, sy=self.sy)
+
+def attention_block_levels(diffusion):
+    # Resolution level of every UNET_AttentionBlock: 0 at Height / 8, 1 at Height / 16, 2 at Height / 32, 3 at Height / 64
+    unet = diffusion.unet
+    levels = {}
+
+    level = 0
+    for layers in unet.encoders:
+        for layer in layers:
+            if isinstance(layer, nn.Conv2d) and layer.stride[0] == 2:
+                level += 1
+            elif isinstance(layer, UNET_AttentionBlock):
+                levels[layer] = level
+
+    for layer in unet.bottleneck:
+        if isinstance(layer, UNET_AttentionBlock):
+            levels[layer] = level
+
+    for layers in unet.decoders:
+        for layer in layers:
+            if isinstance(layer, Upsample):
+                level -= 1
+            elif isinstance(layer, UNET_AttentionBlock):
+                levels[layer] = level
+
+    return levels
+
+def apply_token_merging(diffusion, ratio=0.5, levels=(0,), sx=2, sy=2):
+    """
+        Merge the given ratio of the tokens in the self-attention of the UNET_AttentionBlocks at the given resolution levels
+        (0 is the highest resolution, Height / 8). Blocks at the other levels are left unchanged.
+    """
+    token_merging = TokenMerging(ratio, sx=sx, sy=sy)
+    for block, level in attention_block_levels(diffusion).items():
+        block.token_merging = token_merging if level in levels and ratio > 0 else None
+    return diffusion
+
+def remove_token_merging(diffusion):
+    for block in attention_block_levels(diffusion):
+        block.token_merging = None
+    return diffusion
@@ -3,10 +3,15 @@ import torch.nn.functional as F
 import os
 from tqdm import tqdm
 from ddpm import DDPMSampler
+from diffusion import set_gradient_checkpointing
 from pipeline import get_time_embedding
-from dataloader import train_dataloader
+from dataloader import train_dataloader, epoch_dataloader
+from precompute import PrecomputedDataset, sample_batch_latents
+from lora import inject_lora, lora_state_dict, load_lora
+from checkpointing import AsyncCheckpointWriter, load_latest_checkpoint
+from metrics import StepMetrics, JSONLSink, ProfilerWindow, format_record
+from torch.utils.data import DataLoader
 import model_loader
-import time
 from config import *
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
@@ -31,7 +36,31 @@ for param in text_encoder.parameters():
 vae.eval()
 text_encoder.eval()
 
-optimizer = torch.optim.Adam(unet.parameters(), lr=learning_rate, betas=(adam_beta1, adam_beta2), weight_decay=adam_weight_decay, eps=adam_epsilon)
+# With precomputed latents and hidden states, the VAE and the text encoder are not needed in the training step
+if precomputed_dir is not None:
+    if aspect_ratio_buckets:
+        raise ValueError("precomputed_dir does not support aspect_ratio_buckets, the precomputed latents have a single shape")
+    train_dataloader = DataLoader(PrecomputedDataset(precomputed_dir), batch_size=BATCH_SIZE, shuffle=True, num_workers=2)
+
+# LoRA trains low-rank adapters of the attention block linears, the pretrained UNET weights are frozen. The weights
+# that are not in the SD checkpoint (the DiffDis layers) have nothing to adapt, they are trained and saved with the adapters
+if lora_rank is not None:
+    trainable_parameters = inject_lora(unet, rank=lora_rank, alpha=lora_alpha, dropout=lora_dropout,
+                                       trainable=getattr(unet, "unloaded_parameters", ()))
+else:
+    trainable_parameters = list(unet.parameters())
+print("trainable parameters:", sum(parameter.numel() for parameter in trainable_parameters))
+
+optimizer = torch.optim.Adam(trainable_parameters, lr=learning_rate, betas=(adam_beta1, adam_beta2), weight_decay=adam_weight_decay, eps=adam_epsilon)
+
+# Trade compute for memory by recomputing the UNET block activations in the backward pass
+set_gradient_checkpointing(unet, gradient_checkpointing)
+
+# Mixed precision: the forward pass runs under autocast, fp16 additionally needs a loss scaler to avoid gradient underflow
+MIXED_PRECISION_DTYPES = {"no": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+if mixed_precision not in MIXED_PRECISION_DTYPES:
+    raise ValueError(f"Unknown mixed_precision value {mixed_precision}, expected one of {', '.join(MIXED_PRECISION_DTYPES)}")
+autocast_dtype = MIXED_PRECISION_DTYPES[mixed_precision]
 
 
 def train(num_train_epochs, device="cuda", save_steps=1000, max_train_steps=10000):
@@ -41,27 +70,100 @@ def train(num_train_epochs, device="cuda", save_steps=1000, max_train_steps=1000
     os.makedirs(output_dir, exist_ok=True)
 
     # move models to the device
-    vae.to(device)
-    text_encoder.to(device)
+    if precomputed_dir is None:
+        vae.to(device)
+        text_encoder.to(device)
     unet.to(device)
-
-    num_train_epochs = tqdm(range(first_epoch, num_train_epochs), desc="Epoch")
+    unet.train()
+
+    device_type = torch.device(device).type
+    scaler = torch.amp.GradScaler(device_type, enabled=mixed_precision == "fp16")
+    optimizer.zero_grad(set_to_none=True)
+
+    # Resume from the given checkpoint, or from the latest complete one of output_dir with "latest"
+    start_epoch = first_epoch
+    # Batches of start_epoch that were trained before the checkpoint, and the shard offset its stream started from
+    start_batch = 0
+    start_shard_offset = resume_shard_offset
+    if resume_from_checkpoint is not None:
+        if resume_from_checkpoint == "latest":
+            checkpoint_path, state = load_latest_checkpoint(output_dir)
+        else:
+            checkpoint_path, state = resume_from_checkpoint, torch.load(resume_from_checkpoint, map_location="cpu")
+        if state is None:
+            print(f"No checkpoint found in {output_dir}, starting from scratch")
+        else:
+            if state.get("lora_rank") != lora_rank:
+                raise ValueError(f"{checkpoint_path} was saved with lora_rank={state.get('lora_rank')}, not {lora_rank}")
+            if lora_rank is not None:
+                load_lora(unet, state["model_state_dict"])
+            else:
+                unet.load_state_dict(state["model_state_dict"])
+            optimizer.load_state_dict(state["optimizer_state_dict"])
+            if "scaler_state_dict" in state:
+                scaler.load_state_dict(state["scaler_state_dict"])
+            # The epoch of the checkpoint goes on after its last trained batch
+            global_step = state["global_step"] + 1
+            start_epoch = state["epoch"]
+            start_batch = state.get("batch_in_epoch", 0)
+            start_shard_offset = state.get("shard_offset", 0)
+            if state.get("num_workers", num_workers) != num_workers and hasattr(train_dataloader.dataset, "set_epoch"):
+                # The streams of the workers depend on their number
+                print(f"{checkpoint_path} was saved with num_workers={state['num_workers']}, the skipped batches differ")
+            print(f"Resumed from {checkpoint_path} at step {global_step}")
+            del state
+
+    # The checkpoints are written in the background, keeping the checkpoints_total_limit most recent ones
+    checkpoint_writer = AsyncCheckpointWriter(output_dir, total_limit=checkpoints_total_limit)
+
+    # Per-step phase timings, throughput and peak memory, appended to a JSONL file of the output directory
+    sink = JSONLSink(os.path.join(output_dir, metrics_file)) if metrics_file else None
+    run_info = {"batch_size": BATCH_SIZE, "width": WIDTH, "height": HEIGHT, "mixed_precision": mixed_precision,
+                "gradient_accumulation_steps": gradient_accumulation_steps, "gradient_checkpointing": gradient_checkpointing,
+                "lora_rank": lora_rank, "precomputed": precomputed_dir is not None, "device": device}
+    metrics = StepMetrics(device, sink=sink, run_info=run_info, phase_sync_interval=phase_sync_interval)
+    profiler = ProfilerWindow(os.path.join(output_dir, "profile"), profile_start_step, profile_stop_step, device)
+
+    num_train_epochs = tqdm(range(start_epoch, num_train_epochs), desc="Epoch")
     for epoch in num_train_epochs:
         train_loss = 0.0
-        for step, batch in enumerate(train_dataloader):
-            start_time = time.time()
 
-            # batch consists of images and texts, we need to extract the images and texts
+        # The batches are reshuffled every epoch, the first epoch skips the batches trained before the checkpoint
+        skip_batches = start_batch if epoch == start_epoch else 0
+        shard_offset = start_shard_offset if epoch == start_epoch else 0
+        epoch_loader = epoch_dataloader(train_dataloader, epoch, data_seed, shard_offset, skip_batches)
 
-            # move batch to the device
-            batch["pixel_values"] = batch["pixel_values"].to(device)
-            batch["input_ids"] = batch["input_ids"].to(device)
+        # The step numbers go on after the skipped batches, so the gradient accumulation stays aligned
+        step = skip_batches - 1
+        for step, batch in enumerate(epoch_loader, start=skip_batches):
+            metrics.data_ready()
+            # The weights are updated once every gradient_accumulation_steps batches
+            if step % gradient_accumulation_steps == 0:
+                profiler.step(global_step)
+
+            # batch consists of images and texts, we need to extract the images and texts
 
-            # (Batch_Size, 4, Latents_Height, Latents_Width)
-            encoder_noise = torch.randn(latents_shape, device=device)
-            encoder_noise = encoder_noise.to(device)
-            # (Batch_Size, 4, Latents_Height, Latents_Width)
-            latents = vae(batch["pixel_values"], encoder_noise)
+            with metrics.phase("encode"):
+                if precomputed_dir is not None:
+                    # Sample the latents from the precomputed mean and log variance with fresh noise
+                    # (Batch_Size, 4, Latents_Height, Latents_Width)
+                    latents = sample_batch_latents(batch, device)
+                    # (Batch_Size, Seq_Len, Dim)
+                    encoder_hidden_states = batch["encoder_hidden_states"].to(device, torch.float32)
+                else:
+                    # move batch to the device
+                    batch["pixel_values"] = batch["pixel_values"].to(device)
+                    batch["input_ids"] = batch["input_ids"].to(device)
+
+                    # The latent shape follows the batch, which changes with the aspect ratio bucket
+                    batch_size, _, height, width = batch["pixel_values"].shape
+                    # (Batch_Size, 4, Latents_Height, Latents_Width)
+                    encoder_noise = torch.randn((batch_size, 4, height // 8, width // 8), device=device)
+                    # (Batch_Size, 4, Latents_Height, Latents_Width)
+                    latents = vae(batch["pixel_values"], encoder_noise)
+
+                    # Get the text embedding for conditioning
+                    encoder_hidden_states = text_encoder(batch["input_ids"])
 
             # Sample noise that we'll add to the latents -> it is done inside the add noise method
             # noise = torch.randn_like(latents)
@@ -77,9 +179,6 @@ def train(num_train_epochs, device="cuda", save_steps=1000, max_train_steps=1000
             # Add noise to the latents according to the noise magnitude at each timestep (this is the forward diffusion process)
             noisy_latents, image_noise = ddpm.add_noise(latents, timesteps)
 
-            # Get the text embedding for conditioning
-            encoder_hidden_states = text_encoder(batch["input_ids"])
-
             # Add noise to the text query according to the noise magnitude at each timestep
             noisy_text_query, text_noise = ddpm.add_noise(encoder_hidden_states, text_timesteps)
 
@@ -94,62 +193,77 @@ def train(num_train_epochs, device="cuda", save_steps=1000, max_train_steps=1000
             image_target = image_noise
             text_target = text_query
 
-            # Predict the noise residual and compute loss
-            image_pred, text_pred = unet(noisy_latents, encoder_hidden_states, image_time_embeddings, text_time_embeddings, text_query)
+            with metrics.phase("forward"):
+                # Predict the noise residual and compute loss
+                with torch.autocast(device_type=device_type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                    image_pred, text_pred = unet(noisy_latents, encoder_hidden_states, image_time_embeddings, text_time_embeddings, text_query)
 
-            image_loss = F.mse_loss(image_pred.float(), image_target.float(), reduction="mean")
-            text_loss = F.mse_loss(text_pred.float(), text_target.float(), reduction="mean")
-            
-            train_loss += image_loss + Lambda * text_loss
+                image_loss = F.mse_loss(image_pred.float(), image_target.float(), reduction="mean")
+                text_loss = F.mse_loss(text_pred.float(), text_target.float(), reduction="mean")
+
+                loss = image_loss + Lambda * text_loss
+            train_loss += loss.detach().item()
+
+            # Backpropagate, the loss is averaged over the accumulated batches
+            with metrics.phase("backward"):
+                scaler.scale(loss / gradient_accumulation_steps).backward()
+            metrics.batch_done(bsz)
 
-            # Backpropagate
-            loss = image_loss + Lambda * text_loss
-            loss.backward()
+            if (step + 1) % gradient_accumulation_steps != 0:
+                continue
 
-            optimizer.zero_grad()
-            optimizer.step()
+            with metrics.phase("optimizer"):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
             # lr_scheduler.step() # maybe linear scheduler can be added
 
             if global_step % save_steps == 0:
-                # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
-                if checkpoints_total_limit is not None:
-                    checkpoints = os.listdir(output_dir)
-                    checkpoints = [d for d in checkpoints if d.startswith("checkpoint")]
-                    checkpoints = sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
-
-                    # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
-                    if len(checkpoints) >= checkpoints_total_limit:
-                        num_to_remove = len(checkpoints) - checkpoints_total_limit + 1
-                        removing_checkpoints = checkpoints[0:num_to_remove]
-
-                        print(
-                            f"{len(checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints"
-                        )
-                        print(f"removing checkpoints: {', '.join(removing_checkpoints)}")
-
-                        for removing_checkpoint in removing_checkpoints:
-                            removing_checkpoint = os.path.join(output_dir, removing_checkpoint)
-                            os.remove(removing_checkpoint)
-
-                save_path = os.path.join(output_dir, f"checkpoint-{global_step}")
-
-                # Save model state and optimizer state
-                torch.save({
-                    'model_state_dict': unet.state_dict(),
-                    'optimizer_state_dict': optimizer.state_dict(),
-                }, save_path)
-
-                print(f"Saved state to {save_path}")
-
-            end_time = time.time()
-            print("step_loss:", loss.detach().item(), "time per step:", (end_time - start_time) / bsz, "step per second:", bsz / (end_time - start_time))
+                with metrics.phase("checkpoint"):
+                    # Only the copy to host memory blocks the training, the file is written in the background
+                    checkpoint_writer.save(global_step, {
+                        'model_state_dict': lora_state_dict(unet) if lora_rank is not None else unet.state_dict(),
+                        'optimizer_state_dict': optimizer.state_dict(),
+                        'scaler_state_dict': scaler.state_dict(),
+                        'lora_rank': lora_rank,
+                        'global_step': global_step,
+                        'epoch': epoch,
+                        'batch_in_epoch': step + 1,
+                        'shard_offset': shard_offset,
+                        'num_workers': num_workers,
+                    })
+
+            record = metrics.end_step(global_step, loss=loss.detach().item(), epoch=epoch)
+            print(format_record(record))
             
             if global_step >= max_train_steps:
                 break
 
             global_step += 1
 
-        print("Average loss over epoch:", train_loss / (step + 1))
+        # The last batches of the epoch that do not fill gradient_accumulation_steps get their own optimizer step,
+        # otherwise their gradients would be added to the first step of the next epoch
+        leftover = (step + 1) % gradient_accumulation_steps
+        if leftover:
+            with metrics.phase("optimizer"):
+                # The losses were divided by gradient_accumulation_steps, average over the leftover batches instead
+                for parameter in trainable_parameters:
+                    if parameter.grad is not None:
+                        parameter.grad.mul_(gradient_accumulation_steps / leftover)
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+            record = metrics.end_step(global_step, loss=loss.detach().item(), epoch=epoch)
+            print(format_record(record))
+            global_step += 1
+
+        print("Average loss over epoch:", train_loss / max(1, step + 1 - skip_batches))
+
+    profiler.stop()
+    # Wait for the last checkpoint
+    checkpoint_writer.close()
+    if sink is not None:
+        sink.close()
 
 
 if __name__ == "__main__":
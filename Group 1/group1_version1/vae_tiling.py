@@ -0,0 +1,93 @@
+import torch
+
+# Tiled encoding and decoding for images that are too large to go through the VAE in one pass.
+# The tiles overlap and are blended with weights that fall off linearly towards the tile borders, which hides the seams
+# caused by the group norms and the attention block only seeing one tile at a time.
+# Peak activation memory depends on the tile size only; the output is accumulated tile by tile.
+
+def _tile_starts(size, tile_size, overlap):
+    # Start positions of the tiles along one dimension, the last tile is aligned with the end
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, size - tile_size, stride))
+    starts.append(size - tile_size)
+    return starts
+
+def _blend_weights(height, width, overlap, device, dtype):
+    # Linear ramp from 1 / (overlap + 1) at the border to 1 at a distance of overlap pixels from it
+    # (Height, Width)
+    if overlap <= 0:
+        return torch.ones((height, width), device=device, dtype=dtype)
+    ramp_h = torch.arange(height, device=device, dtype=dtype)
+    ramp_h = torch.minimum(ramp_h + 1, height - ramp_h).clamp(max=overlap + 1) / (overlap + 1)
+    ramp_w = torch.arange(width, device=device, dtype=dtype)
+    ramp_w = torch.minimum(ramp_w + 1, width - ramp_w).clamp(max=overlap + 1) / (overlap + 1)
+    return ramp_h[:, None] * ramp_w[None, :]
+
+def tiled_decode(decoder, latents, tile_size=64, overlap=16):
+    # latents: (Batch_Size, 4, Height / 8, Width / 8)
+    # tile_size and overlap are in latent pixels
+
+    if overlap >= tile_size:
+        raise ValueError("overlap must be smaller than tile_size")
+
+    batch_size, _, latents_height, latents_width = latents.shape
+    height, width = latents_height * 8, latents_width * 8
+
+    # (Batch_Size, 3, Height, Width)
+    output = None
+    weight_sum = torch.zeros((height, width), device=latents.device, dtype=latents.dtype)
+
+    for top in _tile_starts(latents_height, tile_size, overlap):
+        for left in _tile_starts(latents_width, tile_size, overlap):
+            # The decoder divides its input in place, so every tile gets its own copy
+            # (Batch_Size, 4, Tile_Height, Tile_Width)
+            tile = latents[:, :, top:top + tile_size, left:left + tile_size].clone()
+            # (Batch_Size, 4, Tile_Height, Tile_Width) -> (Batch_Size, 3, Tile_Height * 8, Tile_Width * 8)
+            tile = decoder(tile)
+
+            if output is None:
+                output = torch.zeros((batch_size, tile.shape[1], height, width), device=tile.device, dtype=tile.dtype)
+
+            tile_height, tile_width = tile.shape[-2:]
+            weights = _blend_weights(tile_height, tile_width, overlap * 8, tile.device, tile.dtype)
+            output[:, :, top * 8:top * 8 + tile_height, left * 8:left * 8 + tile_width] += tile * weights
+            weight_sum[top * 8:top * 8 + tile_height, left * 8:left * 8 + tile_width] += weights
+
+    # (Batch_Size, 3, Height, Width)
+    return output / weight_sum
+
+def tiled_encode(encoder, images, noise, tile_size=512, overlap=64):
+    # images: (Batch_Size, Channel, Height, Width)
+    # noise: (Batch_Size, 4, Height / 8, Width / 8)
+    # tile_size and overlap are in image pixels and must be multiples of 8
+
+    if tile_size % 8 != 0 or overlap % 8 != 0:
+        raise ValueError("tile_size and overlap must be multiples of 8")
+    if overlap >= tile_size:
+        raise ValueError("overlap must be smaller than tile_size")
+
+    height, width = images.shape[-2:]
+
+    # (Batch_Size, 4, Height / 8, Width / 8)
+    output = torch.zeros_like(noise)
+    weight_sum = torch.zeros(noise.shape[-2:], device=noise.device, dtype=noise.dtype)
+
+    for top in _tile_starts(height, tile_size, overlap):
+        for left in _tile_starts(width, tile_size, overlap):
+            # (Batch_Size, Channel, Tile_Height, Tile_Width)
+            tile = images[:, :, top:top + tile_size, left:left + tile_size]
+            # Every tile uses the slice of the global noise it covers, so overlapping tiles sample the same noise
+            # (Batch_Size, 4, Tile_Height / 8, Tile_Width / 8)
+            tile_noise = noise[:, :, top // 8:(top + tile.shape[-2]) // 8, left // 8:(left + tile.shape[-1]) // 8]
+            # (Batch_Size, Channel, Tile_Height, Tile_Width) -> (Batch_Size, 4, Tile_Height / 8, Tile_Width / 8)
+            tile = encoder(tile, tile_noise)
+
+            tile_height, tile_width = tile.shape[-2:]
+            weights = _blend_weights(tile_height, tile_width, overlap // 8, noise.device, noise.dtype)
+            output[:, :, top // 8:top // 8 + tile_height, left // 8:left // 8 + tile_width] += tile * weights
+            weight_sum[top // 8:top // 8 + tile_height, left // 8:left // 8 + tile_width] += weights
+
+    # (Batch_Size, 4, Height / 8, Width / 8)
+    return output / weight_sum